@@ -17,8 +17,9 @@ from pages.explore.dual_task import (
     dual_task_graphs,
 )
 from components.layout import filter_button, tag_component, get_tags, filter_data
-from style.colors import rgb_to_hex, get_color_mapping, SECONDARY_COLOR
+from style.colors import rgb_to_hex, get_color_mapping, get_color, SECONDARY_COLOR
 from data.queries import get_studies_details, get_filtered_study_ids, get_time_data, nr_studies, get_all_labels
+from data.probabilities import default_threshold
 
 STYLE_NORMAL = {'border': '1px solid #ccc'}
 STYLE_ERROR = {'border': '2px solid red'}
@@ -36,6 +37,13 @@ def log_time(func):
     return wrapper
 
 
+def moved_threshold(task: str, value: float) -> float:
+    """The slider value if it differs from the task's default threshold, else None (counts from paper_label)."""
+    if value is None or abs(value - default_threshold(task)) < 1e-6:
+        return None
+    return value
+
+
 def register_callbacks(app):
     register_time_view_callbacks(app)
     register_studyview_callbacks(app)
@@ -44,6 +52,7 @@ def register_callbacks(app):
     register_modal_callbacks(app)
     register_download_csv_callback(app)
     register_filter_callback(app)
+    register_insight_threshold_callbacks(app)
 
 
 def register_time_view_callbacks(app):
@@ -85,23 +94,29 @@ def register_dual_task_view_callbacks(app):
             Input('jux_dropdown1', 'value'),
             Input('jux_dropdown2', 'value'),
             Input('task1-pie-graph', 'clickData'),
+            Input('task1-threshold', 'value'),
+            Input('task2-threshold', 'value'),
         ],
         prevent_initial_call=True
     )
-    def update_dual_task_view(dropdown1_value, dropdown2_value, click_data):
+    def update_dual_task_view(dropdown1_value, dropdown2_value, click_data, threshold1, threshold2):
         ctx = callback_context
-        # Reset click data if dropdown value changes
-        if 'dropdown' in ctx.triggered_id:
+        # Reset click data and thresholds if dropdown value changes
+        dropdown_changed = 'dropdown' in ctx.triggered_id
+        if dropdown_changed:
             click_data = None
+            threshold1 = threshold2 = None
         if dropdown1_value == dropdown2_value:
             return "Choose two different tasks.", no_update, no_update, no_update, no_update, no_update
+        threshold1 = moved_threshold(dropdown1_value, threshold1)
+        threshold2 = moved_threshold(dropdown2_value, threshold2)
 
         if click_data:
             label = click_data['points'][0]['label']
             color = click_data['points'][0]['color']
 
             task1_data, task2_data, ids, tags = get_dual_task_data(
-                dropdown1_value, dropdown2_value, label)
+                dropdown1_value, dropdown2_value, label, threshold1, threshold2)
             task1_all_labels = get_all_labels(dropdown1_value)
             col_map = get_color_mapping(dropdown1_value, task1_all_labels)
 
@@ -118,12 +133,44 @@ def register_dual_task_view_callbacks(app):
             return "", no_update, pie_chart, bar_chart, filters, dual_study_grid(ids, tags)
 
         df_task1, df_task2, ids, tags = get_dual_task_data(
-            dropdown1_value, dropdown2_value)
+            dropdown1_value, dropdown2_value, threshold1=threshold1, threshold2=threshold2)
+        if not dropdown_changed:
+            # Only the counts change with a threshold, the sliders stay in place
+            col_map = get_color_mapping(dropdown1_value, get_all_labels(dropdown1_value))
+            pie_chart = create_pie_chart(df_task1, dropdown1_value, col_map)
+            bar_chart = create_bar_chart(df_task2, dropdown2_value, get_color(dropdown2_value, 'hex'))
+            return "", no_update, pie_chart, bar_chart, get_dual_filters(), dual_study_grid(ids, tags)
         graph = dual_task_graphs(
             df_task1, df_task2, dropdown1_value, dropdown2_value)
         return "", graph, no_update, no_update, get_dual_filters(), dual_study_grid(ids, tags)
 
 
+def register_insight_threshold_callbacks(app):
+    # The insight views import rgb_to_hex from this module
+    from pages.insights.views import GROUPED_VIEWS, STUDY_PROTOCOL_VIEW, STUDY_PROTOCOL_TASK, insight_content
+
+    @app.callback(
+        Output({"type": "insight-content", "index": ALL}, "children"),
+        Output({"type": "studies-grid", "index": ALL},
+               "getRowsResponse", allow_duplicate=True),
+        Output("count-filtered", "children", allow_duplicate=True),
+        Output("filtered-study-ids", "data", allow_duplicate=True),
+        Input({"type": "insight-threshold", "index": ALL}, "value"),
+        State("filter-tags", "data"),
+        prevent_initial_call=True
+    )
+    def update_insight_threshold(values, tags):
+        index = callback_context.triggered_id['index']
+        task = STUDY_PROTOCOL_TASK if index == STUDY_PROTOCOL_VIEW else GROUPED_VIEWS[index]['task']
+        content, ids = insight_content(index, moved_threshold(task, values[0]))
+        # No ids would list all studies
+        studies = get_studies_details(ids=ids, tags=tags) if ids else []
+        return [content], [{
+            "rowData": studies,
+            "rowCount": len(ids)
+        }], len(ids), ids
+
+
 def register_studyview_callbacks(app):
     @app.callback(
         Output({'type': 'collapse', 'index': ALL}, 'is_open'),
@@ -109,6 +109,16 @@ def content_layout(list_of_children: list, id: str = "content"):
     )
 
 
+def threshold_slider(id, task: str, value: float):
+    """Slider for the decision threshold of a task, for single-label tasks the minimum probability of the top label."""
+    return html.Div([
+        html.Label(f"Decision threshold: {task}", className="mt-2 text-secondary"),
+        dcc.Slider(0, 1, 0.01, value=value, id=id,
+                   marks={0: '0', 0.25: '0.25', 0.5: '0.5', 0.75: '0.75', 1: '1'},
+                   tooltip={"placement": "bottom"}),
+    ], style={'width': '75%'})
+
+
 def filter_component(filter_buttons: list[dbc.Button] = [], info_buttons: list[dbc.Button] = None, id: 'str' = 'active-filters'):
     children = [
         dbc.Row(
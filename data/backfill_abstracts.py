@@ -0,0 +1,116 @@
+"""
+Backfill missing abstracts of fetched PubMed records from Semantic Scholar.
+
+PubMed returns some records without an abstract, those are skipped by populate.py.
+This stage looks them up in batches of up to 500 ids via the Semantic Scholar
+paper/batch endpoint and writes the abstracts (and the prediction input text)
+back into the studies CSV before prediction.
+"""
+
+import os
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data.data_pulling_helpers import get_semantic_scholar_abstracts_batch, SEMANTIC_SCHOLAR_BATCH_SIZE
+from data.rate_limit import TokenBucket
+from pipeline.telemetry import record, http_metrics
+
+PUBMED_DATA_DIR = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'pubmed_fetch_results')
+
+
+def semantic_scholar_id(row: pd.Series) -> str:
+    """Semantic Scholar id of a record, prefer the pubmed id over the DOI."""
+    if pd.notna(row.get('pubmed_id')) and str(row['pubmed_id']).strip():
+        return f"PMID:{int(float(row['pubmed_id']))}"
+    if pd.notna(row.get('doi')) and str(row['doi']).strip():
+        doi = str(row['doi']).strip()
+        if doi.startswith("https://doi.org/"):
+            doi = doi.split("https://doi.org/")[1]
+        return f"DOI:{doi}"
+    return ''
+
+
+def backfill_abstracts(studies_file: str, max_workers: int = 4, requests_per_second: float = 1.0,
+                       batch_size: int = SEMANTIC_SCHOLAR_BATCH_SIZE) -> int:
+    """Fill in missing abstracts in studies_file in place, returns the number of backfilled abstracts."""
+    df = pd.read_csv(studies_file)
+    if df.empty:
+        return 0
+
+    missing = df['abstract'].isna() | (df['abstract'].astype(str).str.strip() == '')
+    ids = df.loc[missing].apply(semantic_scholar_id, axis=1) if missing.any() else pd.Series(dtype=str)
+    ids = ids[ids != '']
+    print(f"{int(missing.sum())} records without abstract, {len(ids)} of them can be looked up")
+    if ids.empty:
+        return 0
+
+    unique_ids = ids.unique().tolist()
+    batches = [unique_ids[i:i + batch_size]
+               for i in range(0, len(unique_ids), batch_size)]
+
+    # All workers share one bucket, so the rate limit holds across the whole pool
+    bucket = TokenBucket(requests_per_second)
+
+    def fetch(batch):
+        try:
+            return get_semantic_scholar_abstracts_batch(batch, bucket=bucket)
+        except requests.exceptions.RequestException as e:
+            print(f"Semantic Scholar batch of {len(batch)} ids failed: {e}")
+            return {}
+
+    abstracts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(fetch, batches):
+            abstracts.update({k: v for k, v in result.items() if v})
+
+    found = ids.map(abstracts).dropna()
+    if found.empty:
+        print("No abstracts found on Semantic Scholar")
+        return 0
+
+    df[['abstract', 'text']] = df[['abstract', 'text']].astype(object)
+    df.loc[found.index, 'abstract'] = found
+    df.loc[found.index, 'text'] = df.loc[found.index, 'title'] + '^\n' + found
+
+    # Replace the file atomically, the prediction step must never read a half written CSV
+    tmp_file = studies_file + '.tmp'
+    df.to_csv(tmp_file, index=False, encoding='utf-8')
+    os.replace(tmp_file, studies_file)
+    print(f"Backfilled {len(found)} abstracts in {studies_file}")
+    return len(found)
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Backfill missing abstracts from Semantic Scholar')
+    arg_parser.add_argument('-s', '--studies_file', type=str, required=False,
+                            help='Path to the studies file, defaults to the latest PubMed fetch result')
+    arg_parser.add_argument('--max_workers', type=int, default=4,
+                            help='Number of concurrent batch requests')
+    arg_parser.add_argument('--requests_per_second', type=float, default=1.0,
+                            help='Rate limit for the Semantic Scholar API')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    parser = init_args_parser()
+    args = parser.parse_args()
+
+    if not args.studies_file:
+        from pipeline.predict import get_latest_data
+        args.studies_file = get_latest_data(PUBMED_DATA_DIR)
+
+    backfilled = backfill_abstracts(args.studies_file, max_workers=args.max_workers,
+                                    requests_per_second=args.requests_per_second)
+    record('backfill', rows=backfilled, **http_metrics())
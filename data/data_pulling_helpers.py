@@ -1,8 +1,19 @@
 import requests
 import csv
-import time
+import json
+import os
+import sys
+import queue
+import threading
 from typing import Optional
-import requests
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data import http_cache
+from data.rate_limit import TokenBucket, request_with_backoff
 
 
 # Extracted from pubmed search string
@@ -60,7 +71,10 @@ substance_terms = [
 ]
 ""
 OPEN_ALEX_API = "https://api.openalex.org/"
-SEMANTIC_SCHOLAR_API = "https://api.semanticscholar.org/graph/v1/"
+# Can be pointed to a local stub server for testing
+SEMANTIC_SCHOLAR_API = os.getenv("SEMANTIC_SCHOLAR_API", "https://api.semanticscholar.org/graph/v1/")
+SEMANTIC_SCHOLAR_API_KEY = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
+SEMANTIC_SCHOLAR_BATCH_SIZE = 500  # max ids per paper/batch call
 
 
 # Semantic Scholar API
@@ -75,19 +89,38 @@ def get_semantic_scholar_abstract(doi_or_url: str) -> Optional[str]:
     else:
         doi = doi_or_url
 
-    base_url = "https://api.semanticscholar.org/graph/v1/paper/"
+    base_url = f"{SEMANTIC_SCHOLAR_API}paper/"
     paper_id = f"DOI:{doi}"
     params = {"fields": "abstract"}
 
     try:
-        response = requests.get(f"{base_url}{paper_id}", params=params, timeout=10)
+        response = http_cache.get(f"{base_url}{paper_id}", params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
         return data.get("abstract")
     except requests.exceptions.RequestException as e:
         print(f"Request failed: {e}")
         return None
-    
+
+
+def get_semantic_scholar_abstracts_batch(paper_ids: list[str], bucket: Optional[TokenBucket] = None) -> dict[str, Optional[str]]:
+    """
+    Fetch abstracts for up to 500 papers in one call to the paper/batch endpoint.
+    Ids use the Semantic Scholar prefixes, e.g. "PMID:12345678" or "DOI:10.1056/nejmoa2032994".
+    Returns a mapping from requested id to abstract (None if unknown or without abstract).
+    """
+    if len(paper_ids) > SEMANTIC_SCHOLAR_BATCH_SIZE:
+        raise ValueError(
+            f"At most {SEMANTIC_SCHOLAR_BATCH_SIZE} ids per batch, got {len(paper_ids)}")
+    headers = {"x-api-key": SEMANTIC_SCHOLAR_API_KEY} if SEMANTIC_SCHOLAR_API_KEY else {}
+    response = request_with_backoff(
+        'POST', f"{SEMANTIC_SCHOLAR_API}paper/batch", bucket=bucket,
+        params={"fields": "abstract"}, json={"ids": paper_ids}, headers=headers, timeout=60)
+    # Results are in the order of the requested ids, unknown ids are null
+    return {
+        paper_id: (paper or {}).get("abstract")
+        for paper_id, paper in zip(paper_ids, response.json())
+    }
 
 
 # OpenAlex API
@@ -101,84 +134,158 @@ def build_openalex_search_query(substance_terms: list[str]) -> str:
     return query
 
 
-def search_openalex_works(query: str, output_file: str):
-    """
-    Search OpenAlex works using cursor paging, writing results continuously to file.
-    Avoids duplicates and respects OpenAlex rate limits.
-    """
+OPENALEX_WORK_FIELDS = [
+    "id", "doi", "title", "publication_year", "type",
+    "pmid", "pmcid", "mag", "abstract"
+]
 
-    base_url = f"{OPEN_ALEX_API}works"
-    per_page = 200  # max allowed
-    seen_ids = set()
-
-    cursor = "*"  # start
-    requests_this_second = 0
-    start_second = time.time()
-
-    with open(output_file, 'w', newline='', encoding='utf-8') as f:
-        writer = None
-        while True:
-            # Rate limiting (10 req/sec)
-            current_time = time.time()
-            if current_time - start_second < 1:
-                if requests_this_second >= 10:
-                    time.sleep(1 - (current_time - start_second))
-                    start_second = time.time()
-                    requests_this_second = 0
-            else:
-                start_second = time.time()
-                requests_this_second = 0
 
+def abstract_from_inverted_index(inverted_index: Optional[dict]) -> Optional[str]:
+    """OpenAlex ships abstracts as {word: [positions]}, rebuild the plain text."""
+    if not inverted_index:
+        return None
+    positions = [(pos, word) for word, pos_list in inverted_index.items() for pos in pos_list]
+    return ' '.join(word for _, word in sorted(positions))
+
+
+def parse_openalex_work(item: dict) -> dict:
+    ids = item.get("ids", {})
+    return {
+        "id": item.get("id"),
+        "doi": item.get("doi"),
+        "title": item.get("title"),
+        "publication_year": item.get("publication_year"),
+        "type": item.get("type"),
+        "pmid": ids.get("pmid"),
+        "pmcid": ids.get("pmcid"),
+        "mag": ids.get("mag"),
+        "abstract": abstract_from_inverted_index(item.get("abstract_inverted_index")),
+    }
+
+
+def load_harvest_state(state_file: str) -> Optional[dict]:
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_harvest_state(state_file: str, state: dict):
+    """Write the state atomically, a crash never leaves a half written state file."""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, state_file)
+
+
+def _fetch_openalex_pages(query: str, cursor: str, per_page: int, bucket: TokenBucket,
+                          pages: queue.Queue, stop: threading.Event):
+    """Producer: fetch cursor pages and hand them to the writer, so that fetching and writing overlap."""
+    base_url = f"{OPEN_ALEX_API}works"
+    try:
+        while cursor and not stop.is_set():
             params = {
                 "filter": f"title_and_abstract.search:{query}",
+                "select": "id,doi,title,publication_year,type,ids,abstract_inverted_index",
                 "per-page": per_page,
                 "cursor": cursor
             }
+            response = request_with_backoff('GET', base_url, bucket=bucket,
+                                            params=params, timeout=30)
+            data = response.json()
+            page_results = data.get("results", [])
+            next_cursor = data.get("meta", {}).get("next_cursor") if page_results else None
+            pages.put((page_results, next_cursor))
+            cursor = next_cursor
+    except Exception as e:
+        pages.put(e)
+    pages.put(None)
 
-            try:
-                response = requests.get(base_url, params=params, timeout=15)
-                response.raise_for_status()
-                data = response.json()
-                requests_this_second += 1
 
-                page_results = data.get("results", [])
-                if not page_results:
-                    break
+def search_openalex_works(query: str, output_file: str, resume: bool = True,
+                          requests_per_second: float = 10, prefetch_pages: int = 4):
+    """
+    Search OpenAlex works using cursor paging, writing results continuously to file.
+    Avoids duplicates and respects OpenAlex rate limits.
 
-                # Initialize CSV writer on first batch
-                if writer is None and page_results:
-                    keys = [
-                        "id", "doi", "title", "publication_year", "type",
-                        "pmid", "pmcid", "mag", "abstract"
-                    ]
-                    writer = csv.DictWriter(f, fieldnames=keys)
-                    writer.writeheader()
+    The harvest is resumable: after every page the next cursor and the sizes of the output
+    file and of the seen-ids file (<output_file>.seen) are saved to <output_file>.state.json.
+    When rerun with the same query, both files are cut back to the last saved state and the
+    harvest continues from the saved cursor, so every work is written exactly once.
+    """
+    per_page = 200  # max allowed
+    state_file = output_file + '.state.json'
+    seen_file = output_file + '.seen'
+
+    state = load_harvest_state(state_file) if resume else None
+    if state and state['query'] != query:
+        raise ValueError(
+            f"{state_file} belongs to a different query, use resume=False to start over.")
+    if state and state['done']:
+        print(f"Harvest already finished ({state['works']} works in {output_file})")
+        return
+
+    if state:
+        # Drop anything written after the last saved state
+        os.truncate(output_file, state['output_bytes'])
+        os.truncate(seen_file, state['seen_bytes'])
+        with open(seen_file, 'r', encoding='utf-8') as f:
+            seen_ids = {line.strip() for line in f if line.strip()}
+        cursor = state['next_cursor']
+        print(f"Resuming harvest after {state['pages']} pages ({state['works']} works)")
+    else:
+        state = {'query': query, 'next_cursor': '*', 'pages': 0, 'works': 0,
+                 'output_bytes': 0, 'seen_bytes': 0, 'done': False}
+        for path in (output_file, seen_file):
+            open(path, 'w', encoding='utf-8').close()
+        seen_ids = set()
+        cursor = '*'  # start
 
+    # OpenAlex allows 10 requests per second
+    bucket = TokenBucket(requests_per_second)
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=_fetch_openalex_pages, daemon=True,
+                               args=(query, cursor, per_page, bucket, pages, stop))
+    fetcher.start()
+
+    with open(output_file, 'a', newline='', encoding='utf-8') as f, \
+            open(seen_file, 'a', encoding='utf-8') as seen_f:
+        writer = csv.DictWriter(f, fieldnames=OPENALEX_WORK_FIELDS)
+        if state['output_bytes'] == 0:
+            writer.writeheader()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    print(f"Request failed: {page}. Rerun to resume the harvest.")
+                    break
+
+                page_results, next_cursor = page
                 # Process and write each work
                 for item in page_results:
                     if item["id"] not in seen_ids:
                         seen_ids.add(item["id"])
-                        work_info = {
-                            "id": item.get("id"),
-                            "doi": item.get("doi"),
-                            "title": item.get("title"),
-                            "publication_year": item.get("publication_year"),
-                            "type": item.get("type"),
-                            "pmid": item.get("ids", {}).get("pmid"),
-                            "pmcid": item.get("ids", {}).get("pmcid"),
-                            "mag": item.get("ids", {}).get("mag"),
-                        }
-                        writer.writerow(work_info)
-
-                # Move to next page
-                cursor = data.get("meta", {}).get("next_cursor")
-                if not cursor:
-                    break
+                        writer.writerow(parse_openalex_work(item))
+                        seen_f.write(item["id"] + '\n')
+                        state['works'] += 1
 
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}")
-                time.sleep(5)
-                continue
+                # Make the page durable before recording it in the state
+                for handle in (f, seen_f):
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                state['pages'] += 1
+                state['next_cursor'] = next_cursor
+                state['output_bytes'] = os.fstat(f.fileno()).st_size
+                state['seen_bytes'] = os.fstat(seen_f.fileno()).st_size
+                state['done'] = next_cursor is None
+                save_harvest_state(state_file, state)
+        finally:
+            stop.set()
 
     print(f"Finished. Saved results to {output_file}")
 
@@ -188,7 +295,7 @@ def get_openalex_topic(topic_id: int):
     Check if an OpenAlex topic ID is valid and retrieve its details.
     """
     try:
-        response = requests.get(topic_id, timeout=10)
+        response = http_cache.get(topic_id, timeout=10)
         response.raise_for_status()
         data = response.json()
         
@@ -230,7 +337,7 @@ def find_openalex_topics(term, per_page=10):
     :param per_page: int, number of results to return
     :return: list of topic objects
     """
-    response = requests.get(
+    response = http_cache.get(
         f"{OPEN_ALEX_API}topics",
         params={
             "search": term,
@@ -3,15 +3,33 @@ import time
 from lxml import etree as ET
 import pandas as pd
 import os
+import sys
+import argparse
+import json
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data import http_cache
+from pipeline.telemetry import record, http_metrics
 
 PUBMED_API_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
 PUBMED_ABSTRACTS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
 SEARCH_STRING = '((Randomized Controlled Trial[Publication Type] OR Controlled Clinical Trial[Publication Type] OR Pragmatic Clinical Trial[Publication Type] OR Clinical Study[Publication Type] OR Adaptive Clinical Trial[Publication Type] OR Equivalence Trial[Publication Type] OR Clinical Trial[Publication Type] OR Clinical Trial, Phase I[Publication Type] OR Clinical Trial, Phase II[Publication Type] OR Clinical Trial, Phase III[Publication Type] OR Clinical Trial, Phase IV[Publication Type] OR Clinical Trial Protocol[Publication Type] OR multicenter study[Publication Type] OR "Clinical Studies as Topic"[Mesh] OR "Clinical Trials as Topic"[Mesh] OR "Clinical Trial Protocols as Topic"[Mesh] OR "Multicenter Studies as Topic"[Mesh] OR "Random Allocation"[Mesh] OR "Double-Blind Method"[Mesh] OR "Single-Blind Method"[Mesh] OR "Placebos"[Mesh:NoExp] OR "Control Groups"[Mesh] OR "Cross-Over Studies"[Mesh] OR random*[Title/Abstract] OR sham[Title/Abstract] OR placebo*[Title/Abstract] OR ((singl*[Title/Abstract] OR doubl*[Title/Abstract]) AND (blind*[Title/Abstract] OR dumm*[Title/Abstract] OR mask*[Title/Abstract])) OR ((tripl*[Title/Abstract] OR trebl*[Title/Abstract]) AND (blind*[Title/Abstract] OR dumm*[Title/Abstract] OR mask*[Title/Abstract])) OR "control study"[tiab:~3] OR "control studies"[tiab:~3] OR "control group"[tiab:~3] OR "control groups"[tiab:~3] OR "healthy volunteers"[tiab:~3] OR "control trial"[tiab:~3] OR "control trials"[tiab:~3] OR "controlled study"[tiab:~3] OR "controlled trial"[tiab:~3] OR "controlled studies"[tiab:~3] OR "controlled trials"[tiab:~3] OR "clinical study"[tiab:~3] OR "clinical studies"[tiab:~3] OR "clinical trial"[tiab:~3] OR "clinical trials"[tiab:~3] OR Nonrandom*[Title/Abstract] OR non random*[Title/Abstract] OR non-random*[Title/Abstract] OR quasi-random*[Title/Abstract] OR quasirandom*[Title/Abstract] OR "phase study"[tiab:~3] OR "phase studies"[tiab:~3] OR "phase trial"[tiab:~3] OR "phase trials"[tiab:~3] OR "crossover study"[tiab:~3] OR "crossover studies"[tiab:~3] OR "crossover trial"[tiab:~3] OR "crossover trials"[tiab:~3] OR "cross-over study"[tiab:~3] OR "cross-over studies"[tiab:~3] OR "cross-over trial"[tiab:~3] OR "cross-over trials"[tiab:~3] OR ((multicent*[tiab] OR multi-cent*[tiab] OR open label[tiab] OR open-label[tiab] OR equivalence[tiab] OR superiority[tiab] OR non-inferiority[tiab] OR noninferiority[tiab] OR quasiexperimental[tiab] OR quasi-experimental[tiab]) AND (study[tiab] OR studies[tiab] OR trial*[tiab])) OR allocated[tiab] OR pragmatic study[tiab] OR pragmatic studies[tiab] OR pragmatic trial*[tiab] OR practical trial*[tiab]) AND ("Hallucinogens"[Majr] OR "Lysergic Acid Diethylamide"[Majr] OR "Psilocybin"[Majr] OR "psilocin" [Supplementary Concept] OR "Mescaline"[Majr] OR "N,N-Dimethyltryptamine"[Majr] OR "Banisteriopsis"[Majr] OR "N-Methyl-3,4-methylenedioxyamphetamine"[Majr] OR "3,4-Methylenedioxyamphetamine"[Majr] OR ("Ketamine"[Majr] AND ("Behavioral Symptoms"[MeSH] OR "Mental Disorders"[Mesh])) OR "Ibogaine"[Majr] OR "salvinorin a"[Supplementary Concept] OR ((hallucinogen*[tiab] OR psychedel*[tiab] OR psychomimet*[tiab] OR entheo*[tiab] OR entactogen*[tiab]) AND (agent*[tiab] OR drug*[tiab] OR compound*[tiab] OR substance*[tiab] OR therap*[tiab] OR psychotherap*[tiab] OR medic*[tiab])) OR (LSD[tiab] AND (psychedel*[tiab] OR hallucinogen*[tiab] OR entheo*[tiab] OR trip*[tiab] OR psychiat*[tiab])) OR LSD-25[tiab] OR "lysergic acid diethylamide"[tiab] OR delysid*[tiab] OR lysergide[tiab] OR lysergamide[tiab] OR Psilocybin*[tiab] OR Psilocibin*[tiab] OR comp360[tiab] OR Psilocin*[tiab] OR 4-HO-DMT[tiab] OR psilocyn*[tiab] OR mescalin*[tiab] OR 3,4,5-trimethoxyphenethylamine[tiab] OR TMPEA[tiab] OR Peyot*[tiab] OR (DMT[tiab] AND (psychedel*[tiab] OR hallucinogen*[tiab] OR entheo*[tiab] OR trip*[tiab] OR psychiat*[tiab])) OR N,N-Dimethyltryptamine[tiab] OR dimethyltryptamine*[tiab] OR "dimethyl tryptamine"[tiab] OR N,N-DMT[tiab] OR ayahuasca[tiab] OR banisteriopsis[tiab] OR 5-methoxy-N,N-dimethyltryptamine[tiab] OR methylbufotenin[tiab] OR 5-MeO-DMT[tiab] OR "5 methoxy dmt"[tiab] OR "5 methoxy n, n dimethyl tryptamine"[tiab] OR "5 methoxydimethyltryptamine"[tiab] OR "n, n dimethyl 5 methoxytryptamine"[tiab] OR Methylenedioxymethamphetamine[tiab] OR "3,4-Methylenedioxy methamphetamine"[tiab] OR "n methyl 3, 4 methylenedioxyamphetamine"[tiab] OR midomafetamine[tiab] OR MDMA[tiab] OR (ecstasy[tiab] AND drug*[tiab]) OR ((Ketamin*[tiab] OR esketamine[tiab]) AND (psychedel*[tiab] OR hallucinogen*[tiab] OR entheo*[tiab] OR trip*[tiab] OR psychiat*[tiab])) OR Ibogaine[tiab] OR iboga[tiab] OR salvinorin[tiab] OR "salvia divinorum"[tiab])) NOT (("Animals"[Mesh] OR "Animal Experimentation"[Mesh] OR "Models, Animal"[Mesh] OR "Vertebrates"[Mesh]) NOT ("Humans"[Mesh] OR "Human Experimentation"[Mesh]))'
+RESULT_COLUMNS = ['keywords', 'pubmed_id', 'pubmed_url', 'doi', 'year', 'title', 'abstract', 'authors']
+# Every pubmed id fetched in delta mode, including the articles the relevance model rejected (never in the database)
+FETCHED_PMIDS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.fetched_pmids.txt')
+# Pubmed ids and date of the last delta fetch, only recorded as fetched (commit_fetch) once its batch is in the database
+PENDING_FETCH_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.pending_fetch.json')
+LAST_FETCH_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'last_data_fetch.txt')
 
 
-def get_pubmed_data(query_string: str, retstart: int = 0, retmax: int = 2000):
+def get_pubmed_data(query_string: str, retstart: int = 0, retmax: int = 2000, refresh: bool = False):
     """
-    Get pubmed ids for a given query string (which includes the query and a time filter)
+    Get pubmed ids for a given query string (which includes the query and a time filter).
+    With refresh the search is sent to PubMed even if the same search is in the response cache.
     """
 
     params = {
@@ -25,8 +43,8 @@ def get_pubmed_data(query_string: str, retstart: int = 0, retmax: int = 2000):
     }
 
     try:
-        response = requests.post(
-            PUBMED_API_URL, params=params, data=data, timeout=10)
+        response = http_cache.post(
+            PUBMED_API_URL, params=params, data=data, timeout=10, refresh=refresh)
         response.raise_for_status()
         return response.text
     except requests.exceptions.RequestException as e:
@@ -47,7 +65,7 @@ def get_pubmed_abstracts(pmids: list) -> str:
     }
 
     try:
-        response = requests.post(PUBMED_ABSTRACTS_URL, data=data, timeout=10)
+        response = http_cache.post(PUBMED_ABSTRACTS_URL, data=data, timeout=10)
         response.raise_for_status()
         return response.text
     except requests.exceptions.RequestException as e:
@@ -122,69 +140,173 @@ def parse_abstracts(xml_data: str):
     return abstracts
 
 
-def main():
+def get_known_pmids(pmid_file: str = None) -> set[str]:
+    """
+    Get the pubmed ids that were already fetched, either from a local file with one pmid per line
+    or, if no file is given, from the paper table in the database
+    """
+    if pmid_file:
+        if not os.path.exists(pmid_file):
+            return set()
+        with open(pmid_file, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import SQLAlchemyError
+    from sqlalchemy.orm import sessionmaker
+    from data.models import Paper, DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME
+
+    database_url = os.getenv(
+        "DATABASE_URL",
+        "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+            DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+    )
+    try:
+        engine = create_engine(database_url, echo=False)
+        session = sessionmaker(bind=engine)()
+        try:
+            rows = session.query(Paper.pubmed_id).filter(
+                Paper.pubmed_id.isnot(None)).all()
+        finally:
+            session.close()
+    except (SQLAlchemyError, ImportError) as e:
+        print(f"Could not load known pubmed ids from the database, fetching all: {e}")
+        return set()
+    return {str(row.pubmed_id) for row in rows}
+
+
+def save_known_pmids(pmid_file: str, pmids: list[str]):
+    """Append newly fetched pubmed ids to the local pmid file"""
+    with open(pmid_file, 'a', encoding='utf-8') as f:
+        for pmid in pmids:
+            f.write(f'{pmid}\n')
+
+
+def main(pmid_file: str = None, skip_known: bool = True, delta: bool = False):
+    """
+    Fetch the articles published since the last fetch. In delta mode (frequent small polls, see pipeline/run.py --watch)
+    the articles added to PubMed since the last fetch are fetched instead, and no result file is written if there is
+    nothing new, so that the later stages of the pipeline are skipped.
+    """
     # Get dir of this file
     dir_path = os.path.dirname(os.path.realpath(__file__))
-    date_file = os.path.join(dir_path, 'last_data_fetch.txt')
+    date_file = LAST_FETCH_FILE
 
     # open last_data_fetch.txt
     with open(date_file, 'r', encoding='utf-8') as f:
         last_data_fetch = f.read()
 
-    search_string_with_date = f'{SEARCH_STRING} AND (("{last_data_fetch}"[Date - Publication] : "3000"[Date - Publication]))'
+    # The publication date of a newly indexed article can lie months back, its entry date is the day it was added
+    date_field = 'Date - Entry' if delta else 'Date - Publication'
+    search_string_with_date = f'{SEARCH_STRING} AND (("{last_data_fetch}"[{date_field}] : "3000"[{date_field}]))'
+
+    # Articles already fetched in an earlier (overlapping) window are not downloaded again
+    known_pmids = get_known_pmids(pmid_file) if skip_known else set()
+    if delta and skip_known:
+        known_pmids |= get_known_pmids(FETCHED_PMIDS_FILE)
+    print(f"Number of known pubmed ids: {len(known_pmids)}")
 
     start = 0
-    total_results = 0
     all_abstracts = []
     count = 0
+    nr_skipped = 0
 
     start_time = time.time()
 
     while True:
-        xml_data = get_pubmed_data(search_string_with_date, retstart=start)
-        if xml_data:
-            root = ET.fromstring(xml_data.encode('utf-8'))
-            pmids = [
-                id_element.text for id_element in root.xpath('//IdList/Id')]
-            count = int(root.find('Count').text)
-
-            # Step 2: Fetch abstracts for these articles
-            if pmids:
-                abstract_data = get_pubmed_abstracts(pmids)
-                if abstract_data:
-                    parsed_abstracts = parse_abstracts(abstract_data)
-                    all_abstracts.extend(parsed_abstracts)
-                    total_results += len(parsed_abstracts)
-
-                    # If we reached the max number of results, stop
-                    if total_results >= count:
-                        break
-
-                    start += 2000
-                    # If we reached the max number of results, stop
-                    if start >= count:
-                        break
-
-                    time.sleep(1)  # Delay to respect the rate limit
-                else:
-                    break
-            else:
+        # The search of every poll is the same until the date moves on, but new articles match it in the meantime
+        xml_data = get_pubmed_data(search_string_with_date, retstart=start, refresh=delta)
+        if not xml_data:
+            break
+        root = ET.fromstring(xml_data.encode('utf-8'))
+        pmids = [
+            id_element.text for id_element in root.xpath('//IdList/Id')]
+        count = int(root.find('Count').text)
+        if not pmids:
+            break
+
+        new_pmids = [pmid for pmid in pmids if pmid not in known_pmids]
+        nr_skipped += len(pmids) - len(new_pmids)
+
+        # Step 2: Fetch abstracts for the articles not seen before
+        if new_pmids:
+            abstract_data = get_pubmed_abstracts(new_pmids)
+            if not abstract_data:
                 break
-        else:
+            all_abstracts.extend(parse_abstracts(abstract_data))
+            known_pmids.update(new_pmids)
+
+        start += 2000
+        # If we reached the max number of results, stop
+        if start >= count:
             break
-    
+
+        time.sleep(1)  # Delay to respect the rate limit
+
+    print(f"Fetched {len(all_abstracts)} new articles, skipped {nr_skipped} already known articles")
+
     end_time = time.time()
     # duration in format hh:mm:ss
     duration = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
-    df = pd.DataFrame(all_abstracts)
+    df = pd.DataFrame(all_abstracts, columns=RESULT_COLUMNS)
     df['text'] = df['title'] + '^\n' + df['abstract']
     today = time.strftime("%Y/%m/%d")
-    outfile = os.path.join(dir_path,'pubmed_fetch_results', f'pubmed_results_{today.replace("/", "")}_{duration}.csv')
-    df.to_csv(outfile, index=False, encoding='utf-8')
-
-    with open(date_file, 'w', encoding='utf-8') as f:
-        f.write(today)
+    # Several micro-batches a day are told apart by the time of the fetch, e.g. pubmed_results_20250813-060000_00:00:02
+    stamp = time.strftime("%Y%m%d-%H%M%S") if delta else today.replace("/", "")
+    if delta and df.empty:
+        print("Nothing new, no result file written")
+    else:
+        outfile = os.path.join(dir_path, 'pubmed_fetch_results', f'pubmed_results_{stamp}_{duration}.csv')
+        df.to_csv(outfile, index=False, encoding='utf-8')
+
+    if pmid_file:
+        save_known_pmids(pmid_file, df['pubmed_id'].dropna().tolist())
+    if delta:
+        # If the micro-batch fails later on, the next poll fetches these articles again from the same date
+        with open(PENDING_FETCH_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'date': today, 'pmids': [str(pmid) for pmid in df['pubmed_id'].dropna()]}, f)
+    else:
+        with open(date_file, 'w', encoding='utf-8') as f:
+            f.write(today)
+    record('fetch', rows=len(df), **http_metrics())
+
+
+def commit_fetch():
+    """
+    Record the last delta fetch as done, once its micro-batch is in the database: its pubmed ids are not
+    fetched again and the next delta fetch starts from its date.
+    """
+    if not os.path.exists(PENDING_FETCH_FILE):
+        print("No pending fetch")
+        return
+    with open(PENDING_FETCH_FILE, 'r', encoding='utf-8') as f:
+        pending = json.load(f)
+    save_known_pmids(FETCHED_PMIDS_FILE, pending['pmids'])
+    with open(LAST_FETCH_FILE, 'w', encoding='utf-8') as f:
+        f.write(pending['date'])
+    os.remove(PENDING_FETCH_FILE)
+    print(f"Recorded {len(pending['pmids'])} fetched pubmed ids, next fetch from {pending['date']}")
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Fetch new articles from PubMed')
+    arg_parser.add_argument('--pmid_file', type=str, default=None,
+                            help='Local file with known pubmed ids (one per line), used instead of the database')
+    arg_parser.add_argument('--fetch_all', action='store_true',
+                            help='Do not skip articles that were already fetched')
+    arg_parser.add_argument('--delta', action='store_true',
+                            help='Fetch only the articles added to PubMed since the last fetch (micro-batches of the watch mode)')
+    arg_parser.add_argument('--commit', action='store_true',
+                            help='Record the last delta fetch as done, after its micro-batch was added to the database')
+    return arg_parser
 
 
 if __name__ == "__main__":
-    main()
+    parser = init_args_parser()
+    args = parser.parse_args()
+    if args.commit:
+        commit_fetch()
+    else:
+        main(pmid_file=args.pmid_file, skip_known=not args.fetch_all, delta=args.delta)
@@ -0,0 +1,258 @@
+"""
+On-disk, content-addressed cache for the HTTP requests of the data fetchers.
+
+Every request is keyed by a hash of its method, URL, query parameters and body.
+Successful responses are stored as two files in the cache directory:
+<key>.body (raw content) and <key>.json (status, headers, creation time).
+The cache is bounded by a TTL and by its total size; when it grows beyond
+the size limit the least recently used entries are evicted.
+
+Configuration via environment variables:
+    HTTP_CACHE_MODE     off | readwrite (default) | replay
+                        replay serves everything from the cache and never
+                        touches the network, a miss raises CacheMissError
+    HTTP_CACHE_DIR      cache directory (default: data/.http_cache)
+    HTTP_CACHE_TTL      time to live in seconds (default: 86400, 0 = no expiry)
+    HTTP_CACHE_MAX_MB   maximum cache size in MB (default: 512)
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Optional
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODE_OFF = 'off'
+MODE_READWRITE = 'readwrite'
+MODE_REPLAY = 'replay'
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.http_cache')
+
+
+class CacheMissError(requests.exceptions.RequestException):
+    """Raised in replay mode when a request is not in the cache."""
+
+
+def _normalise(value) -> str:
+    """Turn params/body into a canonical string, so that the order of dict keys does not matter."""
+    if value is None:
+        return ''
+    if isinstance(value, (bytes, bytearray)):
+        return hashlib.sha256(value).hexdigest()
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return urlencode(sorted((str(k), str(v)) for k, v in value.items()))
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def request_key(method: str, url: str, params=None, data=None, json_body=None) -> str:
+    """Content hash identifying a request."""
+    parts = [method.upper(), url, _normalise(params),
+             _normalise(data), _normalise(json_body)]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of HTTP responses on disk."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, mode: str = MODE_READWRITE,
+                 ttl: float = 86400, max_bytes: int = 512 * 1024 * 1024):
+        if mode not in (MODE_OFF, MODE_READWRITE, MODE_REPLAY):
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'network_requests': 0, 'evictions': 0, 'retries': 0}
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        if self.mode != MODE_OFF:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return base + '.body', base + '.json'
+
+    def get(self, key: str) -> Optional[requests.Response]:
+        """Return the cached response for key, or None if missing or expired."""
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # In replay mode expired entries are still served
+        if self.mode != MODE_REPLAY and self.ttl and time.time() - meta['created'] > self.ttl:
+            return None
+
+        # Touch the entry, the access time drives LRU eviction
+        now = time.time()
+        try:
+            os.utime(meta_path, (now, now))
+        except OSError:
+            pass
+
+        response = requests.Response()
+        response._content = content
+        response.status_code = meta['status_code']
+        response.headers = CaseInsensitiveDict(meta.get('headers', {}))
+        response.url = meta.get('url', '')
+        response.encoding = meta.get('encoding')
+        response.reason = 'OK (cached)'
+        return response
+
+    def put(self, key: str, response: requests.Response):
+        """Store a response. Writes go to a temporary file first so that readers never see partial entries."""
+        body_path, meta_path = self._paths(key)
+        meta = {
+            'url': response.url,
+            'status_code': response.status_code,
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+            'created': time.time(),
+        }
+        tmp_suffix = f'.tmp{os.getpid()}.{threading.get_ident()}'
+        with open(body_path + tmp_suffix, 'wb') as f:
+            f.write(response.content)
+        with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(body_path + tmp_suffix, body_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+
+        # Keep a running total so that the directory is only scanned when the limit is exceeded
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._total_bytes += len(response.content) + os.path.getsize(meta_path)
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """List (last access, size, key) of all cache entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-5]
+            body_path, meta_path = self._paths(key)
+            try:
+                size = os.path.getsize(body_path) + os.path.getsize(meta_path)
+                last_access = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((last_access, size, key))
+        return entries
+
+    def remove(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Drop expired entries and, if still over the size limit, the least recently used ones."""
+        with self._lock:
+            entries = self._entries()
+            now = time.time()
+            total = 0
+            alive = []
+            for last_access, size, key in entries:
+                created = self._created(key)
+                if self.ttl and created is not None and now - created > self.ttl:
+                    self.remove(key)
+                    self.stats['evictions'] += 1
+                else:
+                    alive.append((last_access, size, key))
+                    total += size
+
+            alive.sort()
+            while total > self.max_bytes and alive:
+                _, size, key = alive.pop(0)
+                self.remove(key)
+                self.stats['evictions'] += 1
+                total -= size
+            self._total_bytes = total
+
+    def _created(self, key: str) -> Optional[float]:
+        try:
+            with open(self._paths(key)[1], 'r', encoding='utf-8') as f:
+                return json.load(f)['created']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def clear(self):
+        for _, _, key in self._entries():
+            self.remove(key)
+        self._total_bytes = 0
+
+    def count(self, stat: str):
+        """Increment a stats counter, the fetchers call this from several threads."""
+        with self._lock:
+            self.stats[stat] += 1
+
+    def request(self, method: str, url: str, params=None, data=None, json=None,
+                session: Optional[requests.Session] = None, refresh: bool = False, **kwargs) -> requests.Response:
+        """
+        Drop-in replacement for requests.request() that goes through the cache.
+        With refresh the request is sent even if it is cached (outside of replay mode), for requests whose answer
+        changes between identical calls, and the response replaces the cached one.
+        """
+        http = session or requests
+        if self.mode == MODE_OFF:
+            self.count('network_requests')
+            return http.request(method, url, params=params, data=data, json=json, **kwargs)
+
+        key = request_key(method, url, params, data, json)
+        cached = self.get(key) if not refresh or self.mode == MODE_REPLAY else None
+        if cached is not None:
+            self.count('hits')
+            return cached
+
+        self.count('misses')
+        if self.mode == MODE_REPLAY:
+            raise CacheMissError(
+                f"Replay mode: no cached response for {method.upper()} {url}")
+
+        self.count('network_requests')
+        response = http.request(method, url, params=params, data=data, json=json, **kwargs)
+        # Only cache successful responses, errors should be retried on the next run
+        if 200 <= response.status_code < 300:
+            self.put(key, response)
+        return response
+
+
+def cache_from_env() -> ResponseCache:
+    return ResponseCache(
+        cache_dir=os.getenv('HTTP_CACHE_DIR', DEFAULT_CACHE_DIR),
+        mode=os.getenv('HTTP_CACHE_MODE', MODE_READWRITE),
+        ttl=float(os.getenv('HTTP_CACHE_TTL', 86400)),
+        max_bytes=int(float(os.getenv('HTTP_CACHE_MAX_MB', 512)) * 1024 * 1024),
+    )
+
+
+# Shared by all fetchers in data/
+response_cache = cache_from_env()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return response_cache.request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return response_cache.request('POST', url, **kwargs)
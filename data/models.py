@@ -21,6 +21,9 @@ sys.path.insert(0, parent_folder_path)
 # Base class for all models
 Base = declarative_base()
 
+# Papers are keyed by their PubMed id, papers without one (e.g. OpenAlex-only records) get ids from here upwards
+NO_PMID_ID_START = 1_000_000_000
+
 
 class Paper(Base):
     __tablename__ = 'paper'
@@ -47,6 +50,8 @@ class Paper(Base):
     tokens = relationship('Token', back_populates='paper')
     # Relationship to Prediction (One-to-Many)
     predictions = relationship('Prediction', back_populates='paper')
+    # Relationship to PaperLabel (One-to-Many)
+    labels = relationship('PaperLabel', back_populates='paper')
 
     def __repr__(self):
         return f"<Paper(id={self.id}, title={self.title}, authors={self.authors})>"
@@ -65,6 +70,8 @@ class BatchRetrieval(Base):
 
     # Relationship to Paper (One-to-Many)
     papers = relationship('Paper', back_populates='batch_retrieval')
+    # Relationship to PipelineTelemetry (One-to-Many)
+    telemetry = relationship('PipelineTelemetry', back_populates='batch_retrieval')
 
     def __repr__(self):
         return f"<BatchRetrieval(id={self.id}, date={self.date}, number_new_papers={self.number_new_papers})>"
@@ -121,6 +128,113 @@ class Prediction(Base):
         return f"<Prediction(id={self.id}, task={self.task}, label={self.label}, probability={self.probability})>"
 
 
+class PaperLabel(Base):
+    """
+    Labels predicted for a paper: its predictions at or above the task's prediction_threshold (the most
+    probable label for single-label tasks), materialised at ingest by data/paper_labels.py for the webapp.
+    """
+    __tablename__ = 'paper_label'
+
+    # Primary Key, its index serves the counts and ids per task and label
+    task = Column(String(255), primary_key=True)
+    label = Column(String(255), primary_key=True)
+    # Foreign Key to Paper
+    paper_id = Column(Integer, ForeignKey('paper.id'), primary_key=True, index=True)
+
+    # Columns
+    probability = Column(Float, nullable=False)
+
+    # Relationship to Paper (Many-to-One)
+    paper = relationship('Paper', back_populates='labels')
+
+    def __repr__(self):
+        return f"<PaperLabel(paper_id={self.paper_id}, task={self.task}, label={self.label})>"
+
+
+class LabelThreshold(Base):
+    """prediction_threshold of each task the paper_label table was built with."""
+    __tablename__ = 'label_threshold'
+
+    # Primary Key
+    task = Column(String(255), primary_key=True)
+
+    # Columns
+    threshold = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return f"<LabelThreshold(task={self.task}, threshold={self.threshold})>"
+
+
+class PredictionVersion(Base):
+    """Version of the predictions of each task, incremented by every ingest, for the caches of the webapp."""
+    __tablename__ = 'prediction_version'
+
+    # Primary Key
+    task = Column(String(255), primary_key=True)
+
+    # Columns
+    version = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<PredictionVersion(task={self.task}, version={self.version})>"
+
+
+class PredictionStaging(Base):
+    """Predictions streamed in by pipeline/predict.py --db_sink, moved to prediction once all models are done."""
+    __tablename__ = 'prediction_staging'
+
+    # Primary Key
+    id = Column(Integer, primary_key=True)
+
+    # Foreign Key to BatchRetrieval, the paper does not exist yet while its predictions are staged
+    retrieval_id = Column(Integer, ForeignKey(
+        'batch_retrieval.id'), nullable=False, index=True)
+    paper_id = Column(Integer, nullable=False)
+
+    # Columns
+    task = Column(String(255), nullable=False)
+    label = Column(String(255), nullable=False)
+    probability = Column(Float, nullable=False)
+    model = Column(String(255), nullable=False)
+    is_multilabel = Column(Boolean, default=False)
+
+    def __repr__(self):
+        return f"<PredictionStaging(retrieval_id={self.retrieval_id}, paper_id={self.paper_id}, task={self.task}, label={self.label})>"
+
+
+class PipelineTelemetry(Base):
+    """Resource usage and throughput of one stage (or one model of a stage) of a pipeline run, see pipeline/telemetry.py."""
+    __tablename__ = 'pipeline_telemetry'
+
+    # Primary Key
+    id = Column(Integer, primary_key=True)
+
+    # Foreign Key to BatchRetrieval, runs without new papers have none
+    retrieval_id = Column(Integer, ForeignKey(
+        'batch_retrieval.id'), nullable=True, index=True)
+
+    # Columns
+    run_id = Column(String(32), nullable=False, index=True)
+    recorded_at = Column(TIMESTAMP, default=datetime.utcnow)
+    stage = Column(String(64), nullable=False)
+    model = Column(String(255), nullable=True)  # per-model inference throughput
+    status = Column(String(32), nullable=False)
+    wall_seconds = Column(Float, nullable=True)
+    cpu_seconds = Column(Float, nullable=True)
+    peak_rss_mb = Column(Float, nullable=True)
+    rows = Column(Integer, nullable=True)
+    rows_per_second = Column(Float, nullable=True)
+    http_requests = Column(Integer, nullable=True)
+    http_cache_hits = Column(Integer, nullable=True)
+    http_retries = Column(Integer, nullable=True)
+
+    # Relationship to BatchRetrieval (Many-to-One)
+    batch_retrieval = relationship('BatchRetrieval', back_populates='telemetry')
+
+    def __repr__(self):
+        return f"<PipelineTelemetry(run_id={self.run_id}, stage={self.stage}, model={self.model}, wall_seconds={self.wall_seconds})>"
+
+
 class PredictionToken(Base):
     __tablename__ = 'prediction_token'
 
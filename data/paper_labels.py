@@ -0,0 +1,153 @@
+"""
+Materialise the paper_label table: for each paper and task only the labels the model predicts, i.e. the
+labels at or above the task's prediction_threshold in model_paths.json for multilabel tasks and the most
+probable label for single-label tasks (the same rules as predict.py). populate.py and the database sink
+of predict.py fill it at ingest, the webapp queries read it instead of every label row of prediction.
+
+Every ingest also increments the version of the ingested tasks in the prediction_version table, from which
+the webapp knows when to reload the probabilities of a task (data/probabilities.py).
+
+The thresholds it was built with are kept in the label_threshold table. populate.py and the sink rebuild
+the whole table from the prediction table (ensure_paper_labels) if it does not exist yet, e.g. in a restored
+database, or if a threshold in model_paths.json changed. To rebuild it by hand:
+    python data/paper_labels.py
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, delete, insert, inspect, select, update
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data.models import (Prediction, PaperLabel, LabelThreshold, PredictionVersion, DATABASE_USER, DATABASE_PASSWORD,
+                         DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+
+load_dotenv()
+
+MODEL_INFO = os.path.join(parent_folder_path, 'pipeline', 'model_paths.json')
+DEFAULT_THRESHOLD = 0.5
+# Paper ids per DELETE statement, keeps the IN lists well below the bind parameter limits
+DELETE_CHUNK_SIZE = 5000
+
+
+def load_thresholds(model_info_path: str = MODEL_INFO) -> dict[str, float]:
+    """prediction_threshold of each task in model_paths.json"""
+    with open(model_info_path, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+    return {m['task']: float(m['prediction_threshold']) for m in model_info}
+
+
+def positive_labels(pred_df: pd.DataFrame, thresholds: dict[str, float]) -> pd.DataFrame:
+    """
+    The predicted labels of pred_df (paper_id, task, label, probability, is_multilabel and optionally the
+    prediction id), as (paper_id, task, label, probability). If a paper was scored for a task by more than
+    one model, e.g. after a checkpoint update, the latest prediction (highest id) of each label counts.
+    """
+    if 'id' in pred_df.columns:
+        pred_df = pred_df.sort_values('id').drop_duplicates(['paper_id', 'task', 'label'], keep='last')
+    pred_df = pred_df.reset_index(drop=True)
+    multilabel = pred_df['is_multilabel'].astype(bool)
+    threshold = pred_df['task'].map(thresholds).fillna(DEFAULT_THRESHOLD)
+    keep = multilabel & (pred_df['probability'] >= threshold)
+    single = pred_df[~multilabel]
+    if not single.empty:
+        keep[single.groupby(['paper_id', 'task'])['probability'].idxmax()] = True
+    return pred_df.loc[keep, ['paper_id', 'task', 'label', 'probability']]
+
+
+def replace_labels(conn, pred_df: pd.DataFrame, thresholds: dict[str, float]) -> int:
+    """Replace the paper_label rows of the papers and tasks in pred_df by their predicted labels."""
+    for task, paper_ids in pred_df.groupby('task')['paper_id']:
+        ids = [int(i) for i in paper_ids.unique()]
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            conn.execute(delete(PaperLabel).where(
+                PaperLabel.task == task, PaperLabel.paper_id.in_(ids[start:start + DELETE_CHUNK_SIZE])))
+    labels = positive_labels(pred_df, thresholds)
+    if not labels.empty:
+        conn.execute(insert(PaperLabel), labels.astype({'paper_id': int}).to_dict('records'))
+    return len(labels)
+
+
+def bump_versions(conn, tasks):
+    """Increment the prediction_version of the tasks whose predictions were added or updated."""
+    PredictionVersion.__table__.create(conn, checkfirst=True)
+    tasks = sorted(set(tasks))
+    known = set(conn.execute(select(PredictionVersion.task).where(PredictionVersion.task.in_(tasks))).scalars())
+    if known:
+        conn.execute(update(PredictionVersion).where(PredictionVersion.task.in_(known)).values(
+            version=PredictionVersion.version + 1))
+    if len(known) < len(tasks):
+        conn.execute(insert(PredictionVersion), [{'task': task, 'version': 1} for task in tasks if task not in known])
+
+
+def rebuild(engine, thresholds: dict[str, float]) -> int:
+    """Recompute the whole paper_label table from the prediction table, one task at a time."""
+    PaperLabel.__table__.create(engine, checkfirst=True)
+    LabelThreshold.__table__.create(engine, checkfirst=True)
+    total = 0
+    with engine.begin() as conn:
+        conn.execute(delete(PaperLabel))
+        conn.execute(delete(LabelThreshold))
+        if thresholds:
+            conn.execute(insert(LabelThreshold), [{'task': task, 'threshold': threshold}
+                                                  for task, threshold in thresholds.items()])
+        tasks = conn.execute(select(Prediction.task).distinct()).scalars().all()
+        for task in tasks:
+            pred_df = pd.read_sql(select(
+                Prediction.id, Prediction.paper_id, Prediction.task, Prediction.label,
+                Prediction.probability, Prediction.is_multilabel).where(Prediction.task == task), conn)
+            labels = positive_labels(pred_df, thresholds)
+            if not labels.empty:
+                conn.execute(insert(PaperLabel), labels.astype({'paper_id': int}).to_dict('records'))
+            print(f"{task}: {len(labels)} labels of {len(pred_df)} predictions")
+            total += len(labels)
+    return total
+
+
+def ensure_paper_labels(engine, thresholds: dict[str, float]) -> bool:
+    """
+    Rebuild the paper_label table if it was not built yet for this database or not with these thresholds,
+    before labels of new batches are added to it. Returns whether it was rebuilt.
+    """
+    tables = inspect(engine)
+    if tables.has_table(PaperLabel.__tablename__) and tables.has_table(LabelThreshold.__tablename__):
+        with engine.connect() as conn:
+            built_with = dict(conn.execute(select(LabelThreshold.task, LabelThreshold.threshold)).all())
+        if built_with == thresholds:
+            return False
+        changed = sorted(task for task in set(built_with) | set(thresholds)
+                         if built_with.get(task) != thresholds.get(task))
+        print(f"Thresholds of {', '.join(changed)} changed, rebuilding the paper_label table")
+    else:
+        print("Building the paper_label table from the prediction table")
+    total = rebuild(engine, thresholds)
+    print(f"Added {total} paper labels")
+    return True
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Rebuild the paper_label table from the prediction table')
+    arg_parser.add_argument('-m', '--model_info', type=str, default=MODEL_INFO,
+                            help='model_paths.json with the prediction_threshold of each task')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    database_url = os.getenv(
+        "DATABASE_URL",
+        "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+            DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+    )
+    total = rebuild(create_engine(database_url, echo=False), load_thresholds(args.model_info))
+    print(f"Added {total} paper labels")
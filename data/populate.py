@@ -6,11 +6,16 @@ from datetime import datetime, timezone, timedelta
 
 import pandas as pd
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, insert
 from sqlalchemy.orm import sessionmaker, Session
 
 from models import Paper, BatchRetrieval, Token, Prediction, PredictionToken
+from data.models import NO_PMID_ID_START
+from data.paper_labels import load_thresholds, replace_labels, ensure_paper_labels, bump_versions
 from pipeline.predict import check_if_pred_exist
+from pipeline.artifacts import is_artifact, read_table
+from pipeline.ledger import PredictionLedger
+from pipeline.telemetry import record
 
 load_dotenv()
 
@@ -95,7 +100,8 @@ def create_prediction_tokens(token_id, prediction_id, weight):
     )
 
 
-def populate_db(prediction_file: str, studies_file: str, studies_id_column: Optional[str] = 'id'):
+def populate_db(prediction_file: str, studies_file: str, studies_id_column: Optional[str] = 'id',
+                tokens_file: Optional[str] = None):
 
     # Using the settings.py file, create a connection to the database
     DATABASE_URL = os.getenv(
@@ -104,6 +110,9 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
             DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
     )
     engine = create_engine(DATABASE_URL, echo=False)
+    thresholds = load_thresholds()
+    # Label all predictions of a database that has no (up to date) paper_label table, not only this batch
+    ensure_paper_labels(engine, thresholds)
     SessionLocal = sessionmaker(bind=engine)
     session = SessionLocal()
 
@@ -117,14 +126,15 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
 
     # If studies_file is provided, process studies
     if studies_file:
-        batch_date = studies_file[:-4].split('_')[-2]  # yyyymmdd
-        batch_date = datetime.strptime(batch_date, '%Y%m%d')
-        retrieval_duration = studies_file[:-4].split('_')[-1]  # hh:mm:ss
+        studies_name = os.path.splitext(os.path.basename(studies_file))[0]
+        batch_date = studies_name.split('_')[-2]  # yyyymmdd, yyyymmdd-hhmmss for the micro-batches of the watch mode
+        batch_date = datetime.strptime(batch_date, '%Y%m%d-%H%M%S' if '-' in batch_date else '%Y%m%d')
+        retrieval_duration = studies_name.split('_')[-1]  # hh:mm:ss
         hours, minutes, seconds = map(int, retrieval_duration.split(':'))
         retrieval_duration = timedelta(
             hours=hours, minutes=minutes, seconds=seconds)
 
-        studies_data = pd.read_csv(studies_file)
+        studies_data = read_table(studies_file)
         # Check if studies_id_column is in the studies_data
         if studies_id_column not in studies_data.columns:
             raise ValueError(f"Studies file does not contain column '{studies_id_column}'. Please specify the correct column name with the --studies_id_column argument.")
@@ -153,7 +163,8 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
             title = row['title']
             prediction_input = title + '.^\n' + abstract
             paper_id = row[studies_id_column]
-            if pd.isna(paper_id):
+            # NaNs were replaced by empty strings above, e.g. OpenAlex-only records in a merged study file
+            if paper_id == '' or pd.isna(paper_id):
                 paper_id = get_unused_id(session)
 
             paper = create_paper(
@@ -175,7 +186,7 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
 
     # If prediction_file is provided, process predictions
     if prediction_file:
-        pred_data = pd.read_csv(prediction_file)
+        pred_data = read_table(prediction_file)
         for i, row in pred_data.iterrows():
             paper_id = row['id']
             paper = session.query(Paper).filter(Paper.id == paper_id).first()
@@ -191,7 +202,10 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
                 Prediction.model == row['model']
             ).first()
             if existing_pred:
-                print(f"Prediction already exists for paper_id {paper_id}, task {row['task']}, label {row['label']}, model {row['model']}")
+                # Re-scored by a new checkpoint in the same model folder: keep the prediction in line with paper_label
+                existing_pred.probability = float(row['probability'])
+                existing_pred.is_multilabel = bool(row['is_multilabel'])
+                print(f"Prediction already exists for paper_id {paper_id}, task {row['task']}, label {row['label']}, model {row['model']}, probability updated")
                 continue
 
             pred = create_predictions(
@@ -205,7 +219,38 @@ def populate_db(prediction_file: str, studies_file: str, studies_id_column: Opti
             session.add(pred)
         session.commit()
 
+        # Materialise the predicted labels of the papers in the database for the webapp queries
+        paper_ids = [int(i) for i in pred_data['id'].unique()]
+        known = {row.id for row in session.query(Paper.id).filter(Paper.id.in_(paper_ids))}
+        labelled = pred_data[pred_data['id'].isin(known)].rename(columns={'id': 'paper_id'})
+        nr_labels = replace_labels(session.connection(), labelled, thresholds)
+        bump_versions(session.connection(), pred_data['task'].unique())
+        session.commit()
+        print(f"Added {nr_labels} paper labels")
+
+    # If tokens_file is provided, bulk load the NER token labels of papers that have no tokens yet
+    if tokens_file:
+        tokens_data = read_table(tokens_file)
+        paper_ids = [int(i) for i in tokens_data['id'].unique()]
+        known = {row.id for row in session.query(Paper.id).filter(Paper.id.in_(paper_ids))}
+        with_tokens = {row.paper_id for row in session.query(Token.paper_id).filter(
+            Token.paper_id.in_(paper_ids)).distinct()}
+        tokens_data = tokens_data[tokens_data['id'].isin(known - with_tokens)]
+        if not tokens_data.empty:
+            session.execute(insert(Token), [
+                {'paper_id': int(row.id), 'text': row.text, 'ner_tag': row.ner_tag, 'position_id': int(row.position_id)}
+                for row in tokens_data.itertuples(index=False)])
+            session.commit()
+        print(f"Added {len(tokens_data)} tokens of {tokens_data['id'].nunique()} papers")
+
     session.close()
+    if prediction_file:
+        # Only now the papers of the predictions file count as scored, a failed ingest has them scored again
+        ledger = PredictionLedger()
+        nr_scored = ledger.commit_batch(os.path.splitext(os.path.basename(prediction_file))[0])
+        ledger.close()
+        print(f"Recorded {nr_scored} scored papers in the prediction ledger")
+    record('populate', rows=len(pred_data) if pred_data is not None else 0, retrieval_id=batch_id)
 
 
 def check_if_paper_exists(session: Session, row: pd.Series) -> bool:
@@ -231,15 +276,10 @@ def check_if_paper_exists(session: Session, row: pd.Series) -> bool:
 
 
 def get_unused_id(session: Session):
-    # get all ids from papers, sort from lowest to highest
-    ids = session.query(Paper.id).all()
-    ids = sorted(ids)
-    session.close()
-
-    for i in range(ids[-1]):
-        if i not in ids:
-            return i
-    return ids[-1] + 1
+    # Ids of papers without a PubMed id come from their own range, so they cannot take the id of a future PMID.
+    # Pending papers are autoflushed before the query, so ids handed out before are taken into account
+    max_id = session.query(func.max(Paper.id)).filter(Paper.id >= NO_PMID_ID_START).scalar()
+    return max_id + 1 if max_id else NO_PMID_ID_START
 
 
 def init_args_parser():
@@ -251,6 +291,8 @@ def init_args_parser():
                             help='Path to the predictions file', required=False)
     arg_parser.add_argument('-s', '--studies_file', type=str,
                             help='Path to the studies file', required=False)
+    arg_parser.add_argument('-t', '--tokens_file', type=str,
+                            help='Path to the NER token predictions file', required=False)
     arg_parser.add_argument('--studies_id_column', type=str, default='id',)
     return arg_parser
 
@@ -262,16 +304,22 @@ if __name__ == '__main__':
     if not args.predictions_file and not args.studies_file:
         STUDIES_DIR = 'data/relevant_studies'
         PREDICTIONS_DIR = 'data/predictions'
+        TOKENS_DIR = 'data/ner_tokens'
         # get the latest file in the directory
         args.studies_file = max([os.path.join(STUDIES_DIR, f) for f in os.listdir(
-            STUDIES_DIR) if f.endswith('.csv')], key=os.path.getctime)
+            STUDIES_DIR) if is_artifact(f)], key=os.path.getctime)
         # get prediction file with the same date as studies file
-        date_str = args.studies_file[:-4].split('_')[-2]  #
+        date_str = os.path.splitext(os.path.basename(args.studies_file))[0].split('_')[-2][:8]  # yyyymmdd
+        # prediction files are named predictions_yyyy-mm-dd_<duration>
+        date_str = datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
         args.predictions_file = check_if_pred_exist(PREDICTIONS_DIR, date_str)
         if not args.predictions_file:
             print(
                 f"No predictions file found for date {date_str}. Please provide a predictions file.")
             sys.exit(1)
+        # only written if model_paths.json contains NER models
+        if os.path.isdir(TOKENS_DIR):
+            args.tokens_file = check_if_pred_exist(TOKENS_DIR, date_str) or None
 
     populate_db(args.predictions_file, args.studies_file,
-                args.studies_id_column)
+                args.studies_id_column, args.tokens_file)
@@ -0,0 +1,199 @@
+"""
+Per-task probability matrices for re-thresholding in the webapp.
+
+The probabilities of a task are loaded once from the prediction table into a dense float32
+(papers x labels) matrix kept in process memory, so that the counts and paper ids for any decision
+threshold are NumPy comparisons instead of queries. A matrix is reloaded once predictions of its task
+were added or updated, i.e. its version in the prediction_version table changed, which is checked at most
+every RELOAD_CHECK_SECONDS.
+"""
+
+import time
+import threading
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from .models import Prediction, PaperLabel, LabelThreshold, PredictionVersion
+from .paper_labels import DEFAULT_THRESHOLD
+from .queries import Session
+
+RELOAD_CHECK_SECONDS = 60
+
+_thresholds = {'checked_at': None, 'value': {}}
+_multilabel: dict[str, bool] = {}
+
+
+def label_thresholds() -> dict[str, float]:
+    """Thresholds paper_label was built with (label_threshold table), reloaded at most every RELOAD_CHECK_SECONDS."""
+    now = time.monotonic()
+    if _thresholds['checked_at'] is None or now - _thresholds['checked_at'] > RELOAD_CHECK_SECONDS:
+        session = Session()
+        try:
+            value = dict(session.query(LabelThreshold.task, LabelThreshold.threshold).all())
+        except SQLAlchemyError:
+            # Not built yet, e.g. a restored database the pipeline has not run on
+            value = {}
+        finally:
+            session.close()
+        _thresholds.update(checked_at=now, value=value)
+    return _thresholds['value']
+
+
+def is_multilabel(task: str) -> bool:
+    if task not in _multilabel:
+        session = Session()
+        try:
+            _multilabel[task] = bool(session.query(Prediction.is_multilabel).filter(
+                Prediction.task == task).limit(1).scalar())
+        finally:
+            session.close()
+    return _multilabel[task]
+
+
+def default_threshold(task: str) -> float:
+    """
+    The threshold the paper_label table was built with: the prediction_threshold for multilabel tasks
+    (DEFAULT_THRESHOLD if unknown), 0 for single-label tasks, whose most probable label counts
+    (a threshold is its minimum probability).
+    """
+    if not task or not is_multilabel(task):
+        return 0.0
+    return float(label_thresholds().get(task, DEFAULT_THRESHOLD))
+
+
+class ProbabilityMatrix:
+    """Probabilities of one task: probabilities[i, j] is the probability of labels[j] for paper_ids[i]."""
+
+    def __init__(self, task: str, paper_ids: np.ndarray, labels: list[str], probabilities: np.ndarray,
+                 is_multilabel: bool, version: Optional[int] = None):
+        self.task = task
+        self.paper_ids = paper_ids
+        self.labels = labels
+        self.probabilities = probabilities
+        self.is_multilabel = is_multilabel
+        self.version = version
+
+    @classmethod
+    def from_predictions(cls, task: str, pred_df: pd.DataFrame, version: Optional[int] = None) -> 'ProbabilityMatrix':
+        """From the prediction rows (id, paper_id, label, probability, is_multilabel) of a task."""
+        # A paper scored by more than one model (a checkpoint in a new model folder) keeps the predictions of the
+        # newest model, a model that scores a paper again updates its predictions in place
+        pred_df = pred_df.sort_values('id').drop_duplicates(['paper_id', 'label'], keep='last')
+        paper_ids, rows = np.unique(pred_df['paper_id'].to_numpy(dtype=np.int64), return_inverse=True)
+        labels, columns = np.unique(pred_df['label'].to_numpy(dtype=object), return_inverse=True)
+        probabilities = np.zeros((len(paper_ids), len(labels)), dtype=np.float32)
+        probabilities[rows, columns] = pred_df['probability'].to_numpy(dtype=np.float32)
+        is_multilabel = bool(pred_df['is_multilabel'].any()) if len(pred_df) else False
+        return cls(task, paper_ids, labels.tolist(), probabilities, is_multilabel, version)
+
+    def predicted(self, threshold: Optional[float] = None) -> np.ndarray:
+        """(papers x labels) mask of the predicted labels at the threshold (default: that of paper_label)."""
+        threshold = np.float32(default_threshold(self.task) if threshold is None else threshold)
+        if self.is_multilabel:
+            return self.probabilities >= threshold
+        mask = np.zeros(self.probabilities.shape, dtype=bool)
+        if len(self.paper_ids):
+            best = self.probabilities.argmax(axis=1)
+            rows = np.arange(len(best))
+            mask[rows, best] = self.probabilities[rows, best] >= threshold
+        return mask
+
+    def rows(self, paper_ids: Optional[list[int]]) -> np.ndarray:
+        """Row indices of the given papers that have predictions for the task."""
+        if paper_ids is None:
+            return np.arange(len(self.paper_ids))
+        return np.flatnonzero(np.isin(self.paper_ids, np.asarray(paper_ids, dtype=np.int64)))
+
+    def counts(self, threshold: Optional[float] = None, paper_ids: Optional[list[int]] = None) -> pd.DataFrame:
+        """Number of papers per predicted label, like queries.get_freq: (task, Frequency), most frequent first."""
+        counts = self.predicted(threshold)[self.rows(paper_ids)].sum(axis=0)
+        result = pd.DataFrame({self.task: self.labels, 'Frequency': counts})
+        return result[result['Frequency'] > 0].sort_values('Frequency', ascending=False, ignore_index=True)
+
+    def ids(self, label: Optional[str] = None, threshold: Optional[float] = None) -> list[int]:
+        """Papers with the label at the threshold, or with any label of the task if no label is given."""
+        predicted = self.predicted(threshold)
+        if label is None:
+            selected = predicted.any(axis=1)
+        elif label in self.labels:
+            selected = predicted[:, self.labels.index(label)]
+        else:
+            return []
+        return self.paper_ids[selected].tolist()
+
+    def label_pairs(self, threshold: Optional[float] = None) -> pd.DataFrame:
+        """(paper_id, label) of every predicted label at the threshold."""
+        rows, columns = np.nonzero(self.predicted(threshold))
+        return pd.DataFrame({'paper_id': self.paper_ids[rows],
+                             'label': np.asarray(self.labels, dtype=object)[columns]})
+
+
+_matrices: dict[str, ProbabilityMatrix] = {}
+_lock = threading.Lock()
+_versions = {'checked_at': None, 'value': {}}
+
+
+def prediction_versions() -> dict[str, int]:
+    """Version of the predictions of each task, incremented by populate.py and the sink on every ingest."""
+    session = Session()
+    try:
+        return dict(session.query(PredictionVersion.task, PredictionVersion.version).all())
+    except SQLAlchemyError:
+        # No batch was ingested since the table was added
+        return {}
+    finally:
+        session.close()
+
+
+def load_matrix(task: str, version: Optional[int] = None) -> ProbabilityMatrix:
+    session = Session()
+    try:
+        pred_df = pd.read_sql(select(
+            Prediction.id, Prediction.paper_id, Prediction.label, Prediction.probability, Prediction.is_multilabel
+        ).where(Prediction.task == task), session.bind)
+    finally:
+        session.close()
+    return ProbabilityMatrix.from_predictions(task, pred_df, version)
+
+
+def get_matrix(task: str) -> ProbabilityMatrix:
+    """The probability matrix of the task from the process cache, (re)loaded if its predictions changed."""
+    with _lock:
+        now = time.monotonic()
+        if _versions['checked_at'] is None or now - _versions['checked_at'] > RELOAD_CHECK_SECONDS:
+            _versions.update(checked_at=now, value=prediction_versions())
+        version = _versions['value'].get(task)
+        matrix = _matrices.get(task)
+        if matrix is not None and matrix.version == version:
+            return matrix
+    # Loaded without the lock, the other tasks are served meanwhile
+    matrix = load_matrix(task, version)
+    with _lock:
+        # Unless a newer version was loaded by another thread in the meantime
+        if task not in _matrices or _versions['value'].get(task) == version:
+            _matrices[task] = matrix
+    return matrix
+
+
+def get_freq_grouped_at(task: str, group_task: str, threshold: float, labels: list[str] = None) -> pd.DataFrame:
+    """
+    queries.get_freq_grouped with the labels of task predicted at threshold (those of group_task from paper_label):
+    (group_task, task, Study_ID) for every pair of labels of a paper.
+    """
+    pairs = get_matrix(task).label_pairs(threshold)
+    if labels and 'Other' in labels:
+        pairs['label'] = pairs['label'].where(pairs['label'].isin(labels), 'Other')
+
+    session = Session()
+    try:
+        groups = pd.read_sql(select(PaperLabel.paper_id, PaperLabel.label).where(
+            PaperLabel.task == group_task), session.bind)
+    finally:
+        session.close()
+    merged = groups.merge(pairs, on='paper_id', suffixes=('_group', '_task'))
+    return pd.DataFrame({group_task: merged['label_group'], task: merged['label_task'],
+                         'Study_ID': merged['paper_id']})
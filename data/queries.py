@@ -24,7 +24,7 @@ DATABASE_HOST = os.getenv("DATABASE_HOST")
 DATABASE_PORT = os.getenv("DATABASE_PORT")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 
-from .models import Paper, Prediction
+from .models import Paper, Prediction, PaperLabel
 
 # Add the parent folder to the Python search path
 parent_folder_path = os.path.abspath(
@@ -140,15 +140,15 @@ def get_study_tags(ids: list[int], tags: dict[str, list]) -> dict[int, list[dict
         ]
 
         query = session.query(
-            Prediction.paper_id,
-            Prediction.task,
-            Prediction.label
+            PaperLabel.paper_id,
+            PaperLabel.task,
+            PaperLabel.label
         ).filter(
             and_(
-                Prediction.task.in_(tags.keys()),
-                tuple_(Prediction.task, Prediction.label).in_(
+                PaperLabel.task.in_(tags.keys()),
+                tuple_(PaperLabel.task, PaperLabel.label).in_(
                     valid_task_label_pairs),
-                Prediction.paper_id.in_(ids)
+                PaperLabel.paper_id.in_(ids)
             )
         )
 
@@ -199,18 +199,18 @@ def get_filtered_freq(task: str, filter_task: str, filter_task_label: str = None
     try:
         # Explicitly use select() for the subquery
         subquery = (
-            select(Prediction.paper_id)
+            select(PaperLabel.paper_id)
             .where(
-                Prediction.task == filter_task,
-                Prediction.label == filter_task_label
+                PaperLabel.task == filter_task,
+                PaperLabel.label == filter_task_label
             )
         ).subquery()
 
         query = (
-            select(Prediction.label, func.count(
-                Prediction.id).label("Frequency"))
-            .where(Prediction.task == task, Prediction.paper_id.in_(select(subquery)))
-            .group_by(Prediction.label)
+            select(PaperLabel.label, func.count(
+                PaperLabel.paper_id).label("Frequency"))
+            .where(PaperLabel.task == task, PaperLabel.paper_id.in_(select(subquery)))
+            .group_by(PaperLabel.label)
             .order_by("Frequency")
         )
 
@@ -229,15 +229,15 @@ def get_freq(task: str, labels: list[str] = None) -> pd.DataFrame:
     try:
         # Build query
         query = session.query(
-            Prediction.label,
-            func.count(Prediction.id).label('Frequency')
+            PaperLabel.label,
+            func.count(PaperLabel.paper_id).label('Frequency')
         ).filter(
-            Prediction.task == task,
+            PaperLabel.task == task,
         )
         if labels:
-            query = query.filter(Prediction.label.in_(labels))
-        query = query.group_by(Prediction.label).order_by(
-            func.count(Prediction.id).desc())
+            query = query.filter(PaperLabel.label.in_(labels))
+        query = query.group_by(PaperLabel.label).order_by(
+            func.count(PaperLabel.paper_id).desc())
         result = pd.read_sql(query.statement, session.bind)
         result.rename(
             columns={'label': task, 'Frequency': 'Frequency'}, inplace=True)
@@ -289,31 +289,31 @@ def get_freq_grouped(task: str, group_task: str, labels: list[str] = None) -> pd
         # Subquery to group by the group_task
         grouping_query = (
             session.query(
-                Prediction.paper_id.label("paper_id"),
-                Prediction.label.label(group_task)
+                PaperLabel.paper_id.label("paper_id"),
+                PaperLabel.label.label(group_task)
             )
-            .filter(Prediction.task == group_task)
+            .filter(PaperLabel.task == group_task)
             .subquery()
         )
 
         # Handle the case where specific labels are provided
         if labels:
             label_case = case(
-                (Prediction.label.in_(labels), Prediction.label),
-                else_="Other" if use_rest else Prediction.label
+                (PaperLabel.label.in_(labels), PaperLabel.label),
+                else_="Other" if use_rest else PaperLabel.label
             )
         else:
-            label_case = Prediction.label
+            label_case = PaperLabel.label
 
         # Main query (without frequency counting, including Study_ID)
         query = (
             session.query(
                 grouping_query.c[group_task].label(group_task),
                 label_case.label("Label"),
-                Prediction.paper_id.label("Study_ID")  # Include Study_ID
+                PaperLabel.paper_id.label("Study_ID")  # Include Study_ID
             )
-            .join(grouping_query, grouping_query.c.paper_id == Prediction.paper_id)
-            .filter(Prediction.task == task)
+            .join(grouping_query, grouping_query.c.paper_id == PaperLabel.paper_id)
+            .filter(PaperLabel.task == task)
         )
 
         # Execute query and fetch results
@@ -333,27 +333,27 @@ def get_ids(task: str = None, label: str = None) -> set[int]:
     if task is None and label is None:
         # Return all paper ids
         try:
-            query = session.query(Prediction.paper_id)
+            query = session.query(PaperLabel.paper_id).distinct()
             ids = [item.paper_id for item in query.all()]
             return list(set(ids))
         finally:
             session.close()
     elif task is not None:
         try:
-            query = session.query(Prediction.paper_id).filter(
-                Prediction.task == task
+            query = session.query(PaperLabel.paper_id).filter(
+                PaperLabel.task == task
             )
             if label is not None:
-                query = query.filter(Prediction.label == label)
+                query = query.filter(PaperLabel.label == label)
             ids = [item.paper_id for item in query.all()]
             return list(set(ids))
         finally:
             session.close()
     else:
         try:
-            query = session.query(Prediction.paper_id).filter(
-                Prediction.task == task,
-                Prediction.label == label)
+            query = session.query(PaperLabel.paper_id).filter(
+                PaperLabel.task == task,
+                PaperLabel.label == label)
             ids = [item.paper_id for item in query.all()]
             return list(set(ids))
         finally:
@@ -361,10 +361,10 @@ def get_ids(task: str = None, label: str = None) -> set[int]:
 
 
 def get_all_tasks() -> list[str]:
-    """Get all unique tasks from the predictions."""
+    """Get all unique tasks from the predicted labels."""
     session = Session()
     try:
-        query = session.query(Prediction.task).distinct()
+        query = session.query(PaperLabel.task).distinct()
         tasks = [item.task for item in query.all()]
         return tasks
     finally:
@@ -373,6 +373,7 @@ def get_all_tasks() -> list[str]:
 
 def get_all_labels(task: str) -> list[str]:
     """Get all unique labels for a given task."""
+    # From all predictions, not only the predicted labels: the label colors depend on the complete list
     session = Session()
     try:
         query = session.query(Prediction.label).filter(
@@ -0,0 +1,102 @@
+"""
+Rate limiting and retrying of HTTP requests for the data fetchers.
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+from typing import Optional
+
+import requests
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data import http_cache
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: tokens are refilled continuously at `rate` per second,
+    up to `capacity`, and every request takes one token (blocking until one is available).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1):
+        """Block until `tokens` tokens are available and take them."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds to wait as requested by the server, if any."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def request_with_backoff(method: str, url: str, bucket: Optional[TokenBucket] = None,
+                         max_retries: int = 6, backoff: float = 1.0, max_backoff: float = 120.0,
+                         **kwargs) -> requests.Response:
+    """
+    Send a request through the shared response cache, rate limited by `bucket`.
+    Connection errors, timeouts, 429 and 5xx responses are retried with exponential
+    backoff and jitter (honouring Retry-After); other errors are raised immediately.
+    """
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = http_cache.response_cache.request(method, url, **kwargs)
+        except http_cache.CacheMissError:
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = None
+            error = e
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                response.raise_for_status()
+                return response
+            delay = _retry_after(response)
+            error = f"HTTP {response.status_code}"
+
+        if delay is None:
+            delay = min(max_backoff, backoff * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        attempt += 1
+        http_cache.response_cache.count('retries')
+        print(f"Request to {url} failed ({error}), retry {attempt}/{max_retries} in {delay:.1f}s")
+        time.sleep(delay)
@@ -0,0 +1,266 @@
+"""
+Link records from PubMed (get_pubmed_data.py) and OpenAlex (search_openalex_works) to canonical papers.
+
+All identifiers (DOI, PMID, PMCID, OpenAlex ID) are normalised and kept in one hash map
+per identifier type, so resolving a record is a constant number of dict lookups instead
+of a comparison against every other record. When a record links two papers that were
+seen separately so far (e.g. its PMID matches one and its DOI another), the two papers
+are merged (union-find).
+
+The merged file is written next to the PubMed fetch results, named like them
+(merged_results_<yyyymmdd-hhmmss>_<hh:mm:ss>.csv), so predict.py filters and classifies it
+like any other batch before populate.py adds it to the database.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+from typing import Optional
+
+import pandas as pd
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data.get_pubmed_data import RESULT_COLUMNS
+from data.models import Paper, NO_PMID_ID_START, DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME
+
+ID_TYPES = ('doi', 'pmid', 'pmcid', 'openalex_id')
+MERGED_COLUMNS = ['id'] + RESULT_COLUMNS + ['text', 'pmcid', 'openalex_id', 'source']
+FETCH_RESULTS_DIR = os.path.join(parent_folder_path, 'data', 'pubmed_fetch_results')
+
+
+def _clean(value) -> Optional[str]:
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def normalise_doi(value) -> Optional[str]:
+    """10.1056/NEJMoa2032994, https://doi.org/10.1056/nejmoa2032994 and doi:10.1056/... -> 10.1056/nejmoa2032994"""
+    value = _clean(value)
+    if not value:
+        return None
+    value = re.sub(r'^(https?://(dx\.)?doi\.org/|doi:\s*)', '', value, flags=re.IGNORECASE)
+    return value.lower() if value.startswith('10.') else None
+
+
+def normalise_pmid(value) -> Optional[str]:
+    """40791037, 40791037.0 and https://pubmed.ncbi.nlm.nih.gov/40791037/ -> 40791037"""
+    value = _clean(value)
+    if not value:
+        return None
+    value = value.rstrip('/').rsplit('/', 1)[-1]
+    if value.endswith('.0'):
+        value = value[:-2]
+    return value if value.isdigit() else None
+
+
+def normalise_pmcid(value) -> Optional[str]:
+    """PMC1234, 1234 and https://www.ncbi.nlm.nih.gov/pmc/articles/PMC1234 -> PMC1234"""
+    value = _clean(value)
+    if not value:
+        return None
+    value = value.rstrip('/').rsplit('/', 1)[-1].upper()
+    if value.isdigit():
+        value = 'PMC' + value
+    return value if re.fullmatch(r'PMC\d+', value) else None
+
+
+def normalise_openalex_id(value) -> Optional[str]:
+    """https://openalex.org/W2741809807 and W2741809807 -> W2741809807"""
+    value = _clean(value)
+    if not value:
+        return None
+    value = value.rstrip('/').rsplit('/', 1)[-1].upper()
+    return value if re.fullmatch(r'W\d+', value) else None
+
+
+NORMALISERS = {
+    'doi': normalise_doi,
+    'pmid': normalise_pmid,
+    'pmcid': normalise_pmcid,
+    'openalex_id': normalise_openalex_id,
+}
+
+
+class LinkageIndex:
+    """Hash-map index from normalised identifiers to canonical papers."""
+
+    def __init__(self):
+        self.records: list[dict] = []
+        self._parent: list[int] = []
+        self._maps: dict[str, dict[str, int]] = {id_type: {} for id_type in ID_TYPES}
+
+    def _find(self, i: int) -> int:
+        while self._parent[i] != i:
+            self._parent[i] = self._parent[self._parent[i]]
+            i = self._parent[i]
+        return i
+
+    def resolve(self, ids: dict) -> Optional[int]:
+        """Canonical paper for the given (normalised) ids, or None if the paper is unknown."""
+        for id_type in ID_TYPES:
+            value = ids.get(id_type)
+            if value and value in self._maps[id_type]:
+                return self._find(self._maps[id_type][value])
+        return None
+
+    def add(self, record: dict) -> int:
+        """
+        Add a record and return the index of its canonical paper.
+        Fields of the canonical paper that are still empty are filled from the record,
+        so records added first (PubMed) take precedence.
+        """
+        ids = {id_type: NORMALISERS[id_type](record.get(id_type)) for id_type in ID_TYPES}
+
+        matches = {self._find(self._maps[id_type][value])
+                   for id_type, value in ids.items()
+                   if value and value in self._maps[id_type]}
+
+        if matches:
+            canonical = min(matches)
+            for other in matches - {canonical}:
+                self._merge(canonical, other)
+        else:
+            canonical = len(self.records)
+            self.records.append({})
+            self._parent.append(canonical)
+
+        merged = self.records[canonical]
+        for key, value in {**record, **ids}.items():
+            if _clean(value) is not None and _clean(merged.get(key)) is None:
+                merged[key] = value
+        sources = set(filter(None, str(merged.get('source', '')).split(',')))
+        sources.add(record.get('source', ''))
+        merged['source'] = ','.join(sorted(filter(None, sources)))
+
+        for id_type, value in ids.items():
+            if value:
+                self._maps[id_type].setdefault(value, canonical)
+        return canonical
+
+    def _merge(self, keep: int, drop: int):
+        self._parent[drop] = keep
+        kept = self.records[keep]
+        for key, value in self.records[drop].items():
+            if key == 'source':
+                kept['source'] = ','.join(sorted(set(filter(None,
+                    f"{kept.get('source', '')},{value}".split(',')))))
+            elif _clean(value) is not None and _clean(kept.get(key)) is None:
+                kept[key] = value
+        self.records[drop] = None
+
+    def papers(self) -> list[dict]:
+        return [record for record in self.records if record is not None]
+
+
+def pubmed_records(df: pd.DataFrame):
+    for record in df.to_dict('records'):
+        record['pmid'] = record.get('pubmed_id')
+        record['source'] = 'pubmed'
+        yield record
+
+
+def openalex_records(df: pd.DataFrame):
+    for record in df.to_dict('records'):
+        yield {
+            'openalex_id': record.get('id'),
+            'doi': record.get('doi'),
+            'pmid': record.get('pmid'),
+            'pmcid': record.get('pmcid'),
+            'title': record.get('title'),
+            'abstract': record.get('abstract'),
+            'year': record.get('publication_year'),
+            'source': 'openalex',
+        }
+
+
+def first_unused_id() -> int:
+    """First id of the range for papers without a PubMed id that is not taken in the database yet."""
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+
+    database_url = os.getenv(
+        "DATABASE_URL",
+        "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+            DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+    )
+    session = sessionmaker(bind=create_engine(database_url, echo=False))()
+    try:
+        max_id = session.query(func.max(Paper.id)).filter(Paper.id >= NO_PMID_ID_START).scalar()
+    finally:
+        session.close()
+    return max_id + 1 if max_id else NO_PMID_ID_START
+
+
+def merge_studies(pubmed_file: Optional[str], openalex_file: Optional[str], output_dir: str = FETCH_RESULTS_DIR,
+                  first_id: int = NO_PMID_ID_START) -> str:
+    """
+    Merge PubMed and OpenAlex results into one deduplicated study file in the format of
+    the PubMed fetch results (plus id, pmcid, openalex_id and source), ready for predict.py and populate.py.
+    Papers are identified by their PubMed id, papers without one get ids from first_id upwards.
+    Returns the path of the merged file.
+    """
+    start_time = time.time()
+    index = LinkageIndex()
+    nr_records = 0
+    if pubmed_file:
+        for record in pubmed_records(pd.read_csv(pubmed_file)):
+            index.add(record)
+            nr_records += 1
+    if openalex_file:
+        for record in openalex_records(pd.read_csv(openalex_file)):
+            index.add(record)
+            nr_records += 1
+
+    df = pd.DataFrame(index.papers())
+    df = df.reindex(columns=list(dict.fromkeys(MERGED_COLUMNS + ['pmid'])))
+    df['pubmed_id'] = df['pmid'].where(df['pmid'].notna(), df['pubmed_id'])
+    df['pubmed_url'] = df['pubmed_url'].where(
+        df['pubmed_url'].notna(),
+        df['pubmed_id'].map(lambda pmid: f'https://pubmed.ncbi.nlm.nih.gov/{pmid}/', na_action='ignore'))
+    df['text'] = df['text'].where(df['text'].notna(), df['title'] + '^\n' + df['abstract'])
+    no_pmid = df['pubmed_id'].isna()
+    df['pubmed_id'] = pd.to_numeric(df['pubmed_id'], errors='coerce').astype('Int64')
+    df['id'] = df['pubmed_id']
+    df.loc[no_pmid, 'id'] = range(first_id, first_id + int(no_pmid.sum()))
+    df = df[MERGED_COLUMNS]
+
+    # Named like the fetch results (date and duration of the retrieval), e.g. merged_results_20250813-060000_00:00:02
+    duration = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
+    output_file = os.path.join(output_dir, f'merged_results_{time.strftime("%Y%m%d-%H%M%S")}_{duration}.csv')
+    os.makedirs(output_dir, exist_ok=True)
+    df.to_csv(output_file, index=False, encoding='utf-8')
+    print(f"Merged {nr_records} records into {len(df)} papers ({int(no_pmid.sum())} without PubMed id), "
+          f"saved to {output_file}")
+    return output_file
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Merge PubMed and OpenAlex results into one deduplicated study file')
+    arg_parser.add_argument('-p', '--pubmed_file', type=str, required=False,
+                            help='Path to the PubMed fetch results')
+    arg_parser.add_argument('-a', '--openalex_file', type=str, required=False,
+                            help='Path to the OpenAlex harvest results')
+    arg_parser.add_argument('-o', '--output_dir', type=str, default=FETCH_RESULTS_DIR,
+                            help='Directory of the merged study file, by default that of the fetch results read by predict.py')
+    arg_parser.add_argument('--first_id', type=int, default=None,
+                            help='First id for papers without PubMed id, by default the next free one in the database')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    parser = init_args_parser()
+    args = parser.parse_args()
+    if not args.pubmed_file and not args.openalex_file:
+        parser.error('Provide at least one of --pubmed_file and --openalex_file')
+    first_id = args.first_id if args.first_id is not None else first_unused_id()
+    merge_studies(args.pubmed_file, args.openalex_file, args.output_dir, first_id)
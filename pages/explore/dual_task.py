@@ -4,7 +4,7 @@ from dash import html, dcc
 import dash_bootstrap_components as dbc
 from plotly import express as px
 
-from components.layout import filter_component, filter_button, study_grid
+from components.layout import filter_component, filter_button, study_grid, threshold_slider
 from data.queries import (
     get_filtered_freq,
     get_all_tasks,
@@ -13,10 +13,12 @@ from data.queries import (
     get_all_labels,
     nr_studies,
 )
+from data.probabilities import get_matrix, default_threshold
 from style.colors import get_color_mapping, SECONDARY_COLOR, get_color
 
 
-def dual_task_graphs(df_task1: pd.DataFrame = None, df_task2: pd.DataFrame = None, task1: str = None, task2: str = None) -> html.Div:
+def dual_task_graphs(df_task1: pd.DataFrame = None, df_task2: pd.DataFrame = None, task1: str = None, task2: str = None,
+                     threshold1: float = None, threshold2: float = None) -> html.Div:
     all_tasks = get_all_tasks()
 
     if task1 and task2:
@@ -27,7 +29,7 @@ def dual_task_graphs(df_task1: pd.DataFrame = None, df_task2: pd.DataFrame = Non
 
     return html.Div([
         html.H1("Dual Task Analysis", className="my-4"),
-        html.P("Select two classification tasks from dropdowns to view a pie chart (Task 1) and a bar chart (Task 2). Click on a pie segment to filter Task 2."),
+        html.P("Select two classification tasks from dropdowns to view a pie chart (Task 1) and a bar chart (Task 2). Click on a pie segment to filter Task 2. Move a task's decision threshold to see how the counts change."),
         html.Div(id="validation-message", className="mt-4 text-danger"),
         dbc.Row([
             dbc.Col([
@@ -35,6 +37,8 @@ def dual_task_graphs(df_task1: pd.DataFrame = None, df_task2: pd.DataFrame = Non
                 html.Label("Choose Task 1", className="mt-2"),
                 dcc.Dropdown(all_tasks, id="jux_dropdown1", placeholder="Select a Task", value=task1 if task1 else None, style={'width': '75%'}
                              ),
+                threshold_slider('task1-threshold', task1 or '',
+                                 threshold1 if threshold1 is not None else default_threshold(task1)),
                 dcc.Graph(id='task1-pie-graph',
                           figure=create_pie_chart(df_task1, task1, task1_col_map) if df_task1 is not None else {}),
             ], width=6),
@@ -42,6 +46,8 @@ def dual_task_graphs(df_task1: pd.DataFrame = None, df_task2: pd.DataFrame = Non
                 html.Label("Choose Task 2", className="mt-2"),
                 dcc.Dropdown(all_tasks, id="jux_dropdown2", placeholder="Select a Task",
                              value=task2 if task2 else None, style={'width': '75%'}),
+                threshold_slider('task2-threshold', task2 or '',
+                                 threshold2 if threshold2 is not None else default_threshold(task2)),
                 dcc.Graph(id='task2-bar-graph',
                           figure=create_bar_chart(df_task2, task2, task2_color) if df_task2 is not None else {}),
             ], width=6)
@@ -68,7 +74,9 @@ def create_bar_chart(df, column: str, color: str):
     return fig
 
 
-def get_dual_task_data(task1, task2, task1_label=None) -> tuple[pd.DataFrame, pd.DataFrame, list[int], dict]:
+def get_dual_task_data(task1, task2, task1_label=None, threshold1=None, threshold2=None) -> tuple[pd.DataFrame, pd.DataFrame, list[int], dict]:
+    if threshold1 is not None or threshold2 is not None:
+        return get_dual_task_data_at(task1, task2, task1_label, threshold1, threshold2)
     task1_data = get_freq(task1)
 
     if task1_label:
@@ -91,6 +99,22 @@ def get_dual_task_data(task1, task2, task1_label=None) -> tuple[pd.DataFrame, pd
     return task1_data, task2_data, ids, tags
 
 
+def get_dual_task_data_at(task1, task2, task1_label=None, threshold1=None, threshold2=None) -> tuple[pd.DataFrame, pd.DataFrame, list[int], dict]:
+    """get_dual_task_data with other decision thresholds (None: the default), from the cached probability matrices."""
+    matrix1, matrix2 = get_matrix(task1), get_matrix(task2)
+    task1_data = matrix1.counts(threshold1)
+    ids = matrix1.ids(task1_label, threshold1)
+    if task1_label:
+        task2_data = matrix2.counts(threshold2, paper_ids=ids)
+    else:
+        task2_data = matrix2.counts(threshold2)
+
+    tags = OrderedDict()
+    tags[task1] = [task1_label] if task1_label else task1_data[task1].tolist()
+    tags[task2] = task2_data[task2].tolist()
+    return task1_data, task2_data, ids, tags
+
+
 def dual_task_layout(task1=None, task2=None, task1_label=None):
     if task1_label:
         df_task1, df_task2, ids, tags = get_dual_task_data(
@@ -2,9 +2,10 @@ from collections import defaultdict
 from dash import html, dcc
 import dash_bootstrap_components as dbc
 from style.colors import get_color_mapping
-from components.layout import filter_component, studies_display, filter_button, study_grid
+from components.layout import filter_component, studies_display, filter_button, study_grid, threshold_slider
 from components.graphs import bar_chart
 from data.queries import get_freq_grouped, get_ids, get_pred_filtered, get_all_labels, nr_studies
+from data.probabilities import get_matrix, get_freq_grouped_at, default_threshold
 from callbacks import rgb_to_hex
 from collections import OrderedDict
 
@@ -21,10 +22,11 @@ def get_filter_buttons(task, labels):
     return buttons
 
 
-def view_layout(title: str, graph: dcc.Graph, filter_buttons: list[dbc.Button],  ids: list[int], id: str, info_buttons: list[dbc.Button] = None, tags: OrderedDict = None, ) -> html.Div:
+def view_layout(title: str, graph: dcc.Graph, filter_buttons: list[dbc.Button],  ids: list[int], id: str, info_buttons: list[dbc.Button] = None, tags: OrderedDict = None, slider: html.Div = None) -> html.Div:
     return html.Div([
         html.H1(f'{title}', className="my-4"),
-        graph,
+        slider if slider else html.Div(),
+        html.Div(graph, id={"type": "insight-content", "index": id["index"]}),
         html.H4("Filtered Studies"),
         filter_component(
             filter_buttons, info_buttons if info_buttons else None),
@@ -34,170 +36,158 @@ def view_layout(title: str, graph: dcc.Graph, filter_buttons: list[dbc.Button],
     ])
 
 
-def rct_view():
-    title = "Assessing evidence strength: How many Randomized Controlled Trials (RCTs) and Systematic Reviews are there per substance?"
-    task = 'Study Type'
-    labels = [
-        'Randomized-controlled trial (RCT)', 'Systematic review/meta-analysis', 'Other']
-    group_task = 'Substances'
-    graph_title = 'Number of RCTs and Systematic Reviews per Substance'
-
-    color_mapping = get_color_mapping(task, labels)
-
-    data_rct = get_freq_grouped(task, group_task, labels=labels)
-    data_rct_freq = data_rct_freq = data_rct.groupby(
+# Views that count the studies per label of task, grouped by the labels of group_task, by studies-grid index
+GROUPED_VIEWS = {
+    0: {
+        'title': "Assessing evidence strength: How many Randomized Controlled Trials (RCTs) and Systematic Reviews are there per substance?",
+        'task': 'Study Type',
+        'labels': ['Randomized-controlled trial (RCT)', 'Systematic review/meta-analysis', 'Other'],
+        'group_task': 'Substances',
+        'graph_title': 'Number of RCTs and Systematic Reviews per Substance',
+    },
+    1: {
+        'title': "Effectiveness and safety: Is there enough studies measuring efficacy and safety endpoints per substance?",
+        'task': "Study Purpose",
+        'labels': ["Efficacy endpoints", "Safety endpoints"],
+        'group_task': 'Substances',
+        'graph_title': 'Number of studies measuring efficacy and safety endpoints per substance',
+    },
+    2: {
+        'title': "Do we have enough longitudinal studies and cross-sectional studies for each substance?",
+        'task': "Data Type",
+        'labels': ["Longitudinal short", "Longitudinal long", "Cross-sectional"],
+        'group_task': 'Substances',
+        'graph_title': 'Number of studies per substance for different data types',
+    },
+    3: {
+        'title': "Is there sex bias per substance?",
+        'task': "Sex of Participants",
+        'labels': ["Male", "Female", "Both sexes", "Unknown"],
+        'group_task': 'Substances',
+        'graph_title': 'Sex of participants of studies per substance',
+    },
+    4: {
+        'title': "Study Participation: How many participants are included per study?",
+        'task': "Number of Participants",
+        'labels': ['1-20', '21-40', '41-60', '61-80', '81-100',
+                   '100-199', '200-499', '500-999', '≥1000', 'Unknown'],
+        'group_task': 'Substances',
+        'graph_title': 'Number of Participants per Substance',
+        # All labels are shown, the list only sets their order
+        'query_labels': False,
+    },
+}
+
+STUDY_PROTOCOL_VIEW = 5
+STUDY_PROTOCOL_TASK = "Study Type"
+STUDY_PROTOCOL_LABEL = "Study protocol"
+
+
+def selected_labels(view: dict) -> list[str]:
+    """The labels the studies are filtered by, 'Other' collects the remaining labels and is not one of them."""
+    return [label for label in view['labels'] if label != 'Other']
+
+
+def grouped_view_content(view: dict, threshold: float = None) -> tuple[dcc.Graph, list[int]]:
+    """Bar chart and filtered study ids of a grouped view, at another decision threshold of its task if given."""
+    task, group_task, labels = view['task'], view['group_task'], view['labels']
+    query_labels = labels if view.get('query_labels', True) else None
+    if threshold is None:
+        data = get_freq_grouped(task, group_task, labels=query_labels)
+    else:
+        data = get_freq_grouped_at(task, group_task, threshold, labels=query_labels)
+    data_freq = data.groupby(
         [group_task, task]).size().reset_index(name='Frequency')
-    graph = bar_chart(data_rct_freq, group_task, 'Frequency', graph_title, group_task, 'Frequency',
-                      task, color_mapping, ['pan', 'select', 'lasso2d'], labels)
+    graph = bar_chart(data_freq, group_task, 'Frequency', view['graph_title'], group_task, 'Frequency',
+                      task, get_color_mapping(task, labels), ['pan', 'select', 'lasso2d'], labels)
+    ids = data[data[task].isin(selected_labels(view))]['Study_ID'].unique().tolist()
+    return graph, ids
 
-    filter_buttons = get_filter_buttons(task, labels[:-1])
-    group_labels = get_all_labels(group_task)
-    info_buttons = get_filter_buttons(
-        group_task, group_labels)
 
-    ids = data_rct[data_rct[task].isin(
-        labels[:-1])]['Study_ID'].unique().tolist()
+def study_protocol_content(threshold: float = None) -> tuple[html.P, list[int]]:
+    if threshold is None:
+        ids = get_ids(STUDY_PROTOCOL_TASK, STUDY_PROTOCOL_LABEL)
+    else:
+        ids = get_matrix(STUDY_PROTOCOL_TASK).ids(STUDY_PROTOCOL_LABEL, threshold)
+    freq_span = html.P(
+        f"Total number of study protocols: {len(ids)}", className="mb-4")
+    return freq_span, ids
 
-    # Setting tags
-    tags = OrderedDict()
-    tags[task] = labels[:-1]
-    tags[group_task] = group_labels
 
-    return view_layout(title, graph, filter_buttons, ids, id={"type": "studies-grid", "index": 0}, info_buttons=info_buttons, tags=tags)
+def insight_content(index: int, threshold: float = None) -> tuple:
+    """Content (graph or count) and filtered study ids of the insight view with this studies-grid index."""
+    if index == STUDY_PROTOCOL_VIEW:
+        return study_protocol_content(threshold)
+    return grouped_view_content(GROUPED_VIEWS[index], threshold)
 
 
-def efficacy_safety_view():
-    title = "Effectiveness and safety: Is there enough studies measuring efficacy and safety endpoints per substance?"
-    task = "Study Purpose"
-    labels = ["Efficacy endpoints", "Safety endpoints"]
-    group_task = 'Substances'
-    graph_title = 'Number of studies measuring efficacy and safety endpoints per substance'
+def insight_slider(index: int, task: str) -> html.Div:
+    return threshold_slider({"type": "insight-threshold", "index": index}, task, default_threshold(task))
 
-    data = get_freq_grouped(task, group_task, labels=labels)
-    data_freq = data.groupby(
-        [group_task, task]).size().reset_index(name='Frequency')
 
-    graph = bar_chart(data_freq, group_task, 'Frequency', graph_title, group_task, 'Frequency',
-                      task, get_color_mapping(task, labels), ['pan', 'select', 'lasso2d'], labels)
+def grouped_view(index: int) -> html.Div:
+    view = GROUPED_VIEWS[index]
+    task, group_task = view['task'], view['group_task']
+    graph, ids = grouped_view_content(view)
 
+    labels = selected_labels(view)
     filter_buttons = get_filter_buttons(task, labels)
     group_labels = get_all_labels(group_task)
     info_buttons = get_filter_buttons(
         group_task, group_labels)
 
-    ids = data[data[task].isin(labels)]['Study_ID'].unique().tolist()
-
     # Setting tags
     tags = OrderedDict()
     tags[task] = labels
     tags[group_task] = group_labels
 
-    return view_layout(title, graph, filter_buttons, ids, id={"type": "studies-grid", "index": 1}, info_buttons=info_buttons, tags=tags)
-
+    return view_layout(view['title'], graph, filter_buttons, ids, id={"type": "studies-grid", "index": index},
+                       info_buttons=info_buttons, tags=tags, slider=insight_slider(index, task))
 
-def longitudinal_view():
-    title = "Do we have enough longitudinal studies and cross-sectional studies for each substance?"
-    task = "Data Type"
-    labels = ["Longitudinal short", "Longitudinal long", "Cross-sectional"]
-    group_task = 'Substances'
-    graph_title = 'Number of studies per substance for different data types'
 
-    data = get_freq_grouped(task, group_task, labels=labels)
-    data_freq = data.groupby(
-        [group_task, task]).size().reset_index(name='Frequency')
+def rct_view():
+    return grouped_view(0)
 
-    graph = bar_chart(data_freq, group_task, 'Frequency', graph_title, group_task, 'Frequency',
-                      task, get_color_mapping(task, labels), ['pan', 'select', 'lasso2d'], labels)
 
-    filter_buttons = get_filter_buttons(task, labels)
-    info_buttons = get_filter_buttons(
-        group_task, get_all_labels(group_task))
+def efficacy_safety_view():
+    return grouped_view(1)
 
-    ids = data[data[task].isin(labels)]['Study_ID'].unique().tolist()
-    tags = OrderedDict()
-    tags[task] = labels
-    tags[group_task] = get_all_labels(group_task)
 
-    return view_layout(title, graph, filter_buttons, ids, id={"type": "studies-grid", "index": 2}, info_buttons=info_buttons, tags=tags)
+def longitudinal_view():
+    return grouped_view(2)
 
 
 def sex_bias_view():
-    title = "Is there sex bias per substance?"
-    task = "Sex of Participants"
-    labels = ["Male", "Female", "Both sexes", "Unknown"]
-    group_task = 'Substances'
-    graph_title = 'Sex of participants of studies per substance'
-
-    data = get_freq_grouped(task, group_task, labels=labels)
-    data_freq = data.groupby(
-        [group_task, task]).size().reset_index(name='Frequency')
-
-    filter_buttons = get_filter_buttons(task, labels)
-    graph = bar_chart(data_freq, group_task, 'Frequency', graph_title, group_task, 'Frequency',
-                      task, get_color_mapping(task, labels), ['pan', 'select', 'lasso2d'], labels)
-
-    info_buttons = get_filter_buttons(
-        group_task, get_all_labels(group_task))
-
-    ids = data[data[task].isin(labels)]['Study_ID'].unique().tolist()
-    tags = OrderedDict()
-    tags[task] = labels
-    tags[group_task] = get_all_labels(group_task)
-
-    return view_layout(title, graph, filter_buttons, ids, id={"type": "studies-grid", "index": 3}, info_buttons=info_buttons, tags=tags)
+    return grouped_view(3)
 
 
 def nr_part_view():
-    title = "Study Participation: How many participants are included per study?"
-    task = "Number of Participants"
-    group_task = 'Substances'
-    labels = ['1-20', '21-40', '41-60', '61-80', '81-100',
-              '100-199', '200-499', '500-999', '≥1000', 'Unknown']
-    graph_title = 'Number of Participants per Substance'
-
-    data = get_freq_grouped(task, group_task)
-    data_freq = data.groupby(
-        [group_task, task]).size().reset_index(name='Frequency')
-    filter_buttons = get_filter_buttons(task, labels)
-    graph = bar_chart(data_freq, group_task, 'Frequency', graph_title, group_task, 'Frequency',
-                      task, get_color_mapping(task, labels), ['pan', 'select', 'lasso2d'], labels)
-
-    info_buttons = get_filter_buttons(
-        group_task, get_all_labels(group_task))
-
-    ids = data[data[task].isin(labels)]['Study_ID'].unique().tolist()
-    tags = OrderedDict()
-    tags[task] = labels
-    tags[group_task] = get_all_labels(group_task)
-
-    return view_layout(title, graph, filter_buttons, ids, id={"type": "studies-grid", "index": 4}, info_buttons=info_buttons, tags=tags)
+    return grouped_view(4)
 
 
 def study_protocol_view():
     title = "How many study protocols are available?"
-    task = "Study Type"
-    label = "Study protocol"
+    task = STUDY_PROTOCOL_TASK
+    label = STUDY_PROTOCOL_LABEL
 
     # Fetch data
     color_mapping = get_color_mapping(task, [label])
-    ids = get_ids(task, label)
+    freq_span, ids = study_protocol_content()
 
     tags = OrderedDict()
     tags[task] = [label]
 
-    freq_span = html.P(
-        f"Total number of study protocols: {len(ids)}", className="mb-4")
-
     return html.Div([
         html.H1(f'{title}', className="my-4"),
-        freq_span,
+        insight_slider(STUDY_PROTOCOL_VIEW, task),
+        html.Div(freq_span, id={"type": "insight-content", "index": STUDY_PROTOCOL_VIEW}),
         html.H4("Filtered Studies"),
         filter_component(filter_button(
             color_mapping[label], label, task, False)),
         dcc.Store(id="filtered-study-ids", data=ids, storage_type="session"),
         dcc.Store(id="filter-tags", data=tags, storage_type="session"),
         study_grid(nr_studies(), len(ids), 'January 2024', tags=True,
-                   id={"type": "studies-grid", "index": 5})
+                   id={"type": "studies-grid", "index": STUDY_PROTOCOL_VIEW})
     ])
 
 
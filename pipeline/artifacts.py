@@ -0,0 +1,39 @@
+"""
+Reading and writing the files passed from predict.py to populate.py.
+
+The relevant studies and predictions are written as Parquet: the repeated task, label and
+model strings are dictionary-encoded, and floats, bools and ints keep their exact types,
+so populate.py does not have to infer them from text. CSV is still read, and can be
+exported next to the Parquet file.
+"""
+
+import os
+
+import pandas as pd
+
+ARTIFACT_EXTENSIONS = ('.parquet', '.csv')
+
+# Few distinct values repeated on every row of the predictions
+CATEGORICAL_COLUMNS = ('task', 'label', 'model')
+
+
+def is_artifact(filename: str) -> bool:
+    return filename.endswith(ARTIFACT_EXTENSIONS)
+
+
+def read_table(path: str) -> pd.DataFrame:
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def write_table(df: pd.DataFrame, path: str, export_csv: bool = False) -> str:
+    """Write df to path (.parquet), optionally also as CSV next to it, returns the path."""
+    df = df.astype({col: 'category' for col in CATEGORICAL_COLUMNS if col in df.columns})
+    # Replace the file atomically, populate.py must never read a half written file
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False, use_dictionary=True)
+    os.replace(tmp_path, path)
+    if export_csv:
+        df.to_csv(os.path.splitext(path)[0] + '.csv', index=False)
+    return path
@@ -0,0 +1,175 @@
+"""
+Calibrate the CPU inference settings of each model on this host.
+
+For every model in model_paths.json the throughput on a sample of abstracts is measured for
+a grid of batch sizes and intra-op thread counts, and the fastest setting is stored per host in
+inference_profile.json next to model_paths.json. load_model in predict.py picks it up.
+
+    python pipeline/autotune.py -s data/relevant_studies/<studies>.parquet --sample 256
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+from typing import Optional
+
+import torch
+import pandas as pd
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+MODEL_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_paths.json')
+PROFILE_PATH = os.getenv('INFERENCE_PROFILE', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'inference_profile.json'))
+
+BATCH_SIZES = [4, 8, 16, 32, 64]
+
+_default_threads = None
+
+
+def host_key() -> str:
+    """Identifies the hardware rather than the machine name, so containers on the same host share a profile."""
+    cpu = platform.processor() or platform.machine()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo', 'r', encoding='utf-8') as f:
+            cpu = next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), cpu)
+    return f'{cpu} x{os.cpu_count()}' if cpu else socket.gethostname()
+
+
+def available_threads() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def load_profile(path: str = PROFILE_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def tuned_settings(model_path: str, backend: str = 'torch', path: str = PROFILE_PATH) -> Optional[dict]:
+    """
+    Calibrated {'batch_size', 'num_threads'} of a model on this host, or None.
+    The thread count is capped by the cores this process may use (e.g. a pinned scheduler worker).
+    """
+    settings = load_profile(path).get(host_key(), {}).get(backend, {}).get(model_path)
+    if settings is None:
+        return None
+    return {'batch_size': settings['batch_size'],
+            'num_threads': min(settings['num_threads'], available_threads())}
+
+
+def set_threads(num_threads: Optional[int]):
+    """Use num_threads intra-op threads, None restores the thread count from before the first call."""
+    global _default_threads
+    if _default_threads is None:
+        _default_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads or _default_threads)
+
+
+def thread_grid(max_threads: int) -> list[int]:
+    """1, 2, 4, ... up to and including max_threads"""
+    grid = [2 ** i for i in range(max_threads.bit_length()) if 2 ** i < max_threads]
+    return grid + [max_threads]
+
+
+def measure(trainer, data, batch_size: int, num_threads: int) -> float:
+    """Texts per second for one setting, after a warm-up batch."""
+    from torch.utils.data import Subset
+    from pipeline.predict import predict_logits
+
+    torch.set_num_threads(num_threads)
+    if hasattr(trainer, 'session'):
+        trainer.batch_size = batch_size
+    else:
+        trainer.args.per_device_eval_batch_size = batch_size
+    trainer.predict(Subset(data, range(min(batch_size, len(data)))))
+    start = time.perf_counter()
+    predict_logits(trainer, data)
+    return len(data) / (time.perf_counter() - start)
+
+
+def calibrate(m: dict, texts: list[str], backend: str = 'torch', batch_sizes: list[int] = BATCH_SIZES,
+              threads: Optional[list[int]] = None) -> pd.DataFrame:
+    """Throughput of one model for every batch size and thread count."""
+    from pipeline.predict import SimpleDataset, load_model
+
+    results = []
+    for num_threads in threads or thread_grid(available_threads()):
+        torch.set_num_threads(num_threads)
+        # ONNX Runtime fixes its thread pool when the session is created
+        trainer = load_model(m['model_path'], m['task'], backend=backend, tuned=False)
+        if hasattr(trainer, 'args'):
+            trainer.args.disable_tqdm = True
+        data = SimpleDataset(pd.DataFrame({'id': range(len(texts)), 'text': texts}), trainer.tokenizer,
+                             multilabel=m['is_multilabel'], is_ner='ner' in m['task'].lower(), pretokenize=True)
+        for batch_size in batch_sizes:
+            throughput = measure(trainer, data, batch_size, num_threads)
+            logging.info(f'{m["task"]}: batch size {batch_size}, {num_threads} threads: {throughput:.1f} texts/s')
+            results.append({'batch_size': batch_size, 'num_threads': num_threads, 'texts_per_second': throughput})
+    return pd.DataFrame(results)
+
+
+def save_profile(best: dict[str, dict], backend: str, path: str = PROFILE_PATH):
+    """Merge the best settings per model path into the profile of this host."""
+    profile = load_profile(path)
+    profile.setdefault(host_key(), {}).setdefault(backend, {}).update(best)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Measure the fastest batch size and thread count of each model on this host')
+    arg_parser.add_argument('-s', '--studies_file', type=str, required=True,
+                            help='Studies to sample the abstracts from')
+    arg_parser.add_argument('-m', '--model_info', type=str, default=MODEL_INFO,
+                            help='Path to the model info JSON')
+    arg_parser.add_argument('--sample', type=int, default=256,
+                            help='Number of abstracts to measure the throughput on')
+    arg_parser.add_argument('--batch_sizes', type=int, nargs='+', default=BATCH_SIZES)
+    arg_parser.add_argument('--threads', type=int, nargs='+', default=None,
+                            help='Thread counts to try, defaults to powers of two up to the available cores')
+    arg_parser.add_argument('--tasks', type=str, nargs='+', default=None,
+                            help='Only calibrate these tasks')
+    arg_parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx', 'onnx-int8'])
+    arg_parser.add_argument('--profile', type=str, default=PROFILE_PATH,
+                            help='Profile file the best settings are written to')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    from pipeline.artifacts import read_table
+
+    with open(args.model_info, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+    studies = read_table(args.studies_file)
+    texts = studies['text'].dropna().sample(n=min(args.sample, studies['text'].notna().sum()), random_state=42).tolist()
+
+    best = {}
+    for m in model_info:
+        if args.tasks and m['task'] not in args.tasks:
+            continue
+        results = calibrate(m, texts, backend=args.backend, batch_sizes=args.batch_sizes, threads=args.threads)
+        top = results.loc[results['texts_per_second'].idxmax()]
+        best[m['model_path']] = {'batch_size': int(top['batch_size']), 'num_threads': int(top['num_threads']),
+                                 'texts_per_second': round(float(top['texts_per_second']), 1)}
+        print(f"{m['task']}: batch size {best[m['model_path']]['batch_size']}, "
+              f"{best[m['model_path']]['num_threads']} threads, {best[m['model_path']]['texts_per_second']} texts/s")
+    save_profile(best, args.backend, args.profile)
+    print(f'Saved profile for host {host_key()} to {args.profile}')
@@ -0,0 +1,175 @@
+"""
+Stream predictions from predict.py straight into the database.
+
+Each model's long-format output is copied into prediction_staging as soon as the model is done,
+tagged with the BatchRetrieval of the run. Only when all models have finished are the relevant
+papers and their staged predictions moved to the paper and prediction tables, in one transaction,
+so the webapp never shows a half predicted batch.
+"""
+
+import io
+import os
+import sys
+import logging
+from datetime import datetime, timezone, timedelta
+
+import pandas as pd
+from sqlalchemy import create_engine, delete, insert, select, text
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from data.models import (Paper, BatchRetrieval, PredictionStaging, DATABASE_USER, DATABASE_PASSWORD,
+                         DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+from data.paper_labels import load_thresholds, replace_labels, ensure_paper_labels, bump_versions
+
+STAGING_COLUMNS = ['retrieval_id', 'paper_id', 'task', 'label', 'probability', 'model', 'is_multilabel']
+
+# A paper re-scored by a new checkpoint of the same model (same run folder) gets the new probabilities
+UPDATE_PREDICTIONS = text("""
+    UPDATE prediction
+    SET probability = s.probability, is_multilabel = s.is_multilabel
+    FROM prediction_staging s
+    WHERE s.retrieval_id = :retrieval_id
+      AND prediction.paper_id = s.paper_id AND prediction.task = s.task
+      AND prediction.label = s.label AND prediction.model = s.model
+""")
+
+PUBLISH_PREDICTIONS = text("""
+    INSERT INTO prediction (paper_id, task, label, probability, model, is_multilabel)
+    SELECT s.paper_id, s.task, s.label, s.probability, s.model, s.is_multilabel
+    FROM prediction_staging s
+    JOIN paper p ON p.id = s.paper_id
+    WHERE s.retrieval_id = :retrieval_id
+      AND NOT EXISTS (
+        SELECT 1 FROM prediction q
+        WHERE q.paper_id = s.paper_id AND q.task = s.task AND q.label = s.label AND q.model = s.model)
+""")
+
+
+def parse_duration(duration: str) -> timedelta:
+    """hh:mm:ss from the fetch result file names -> timedelta"""
+    hours, minutes, seconds = map(int, duration.split(':'))
+    return timedelta(hours=hours, minutes=minutes, seconds=seconds)
+
+
+class PredictionSink:
+    """Stages the predictions of one retrieval and publishes them together with its papers."""
+
+    def __init__(self, database_url: str = None):
+        database_url = database_url or os.getenv(
+            "DATABASE_URL",
+            "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+                DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+        )
+        self.engine = create_engine(database_url, echo=False)
+        PredictionStaging.__table__.create(self.engine, checkfirst=True)
+        self.thresholds = load_thresholds()
+        # Label all predictions of a database that has no (up to date) paper_label table, not only this batch
+        ensure_paper_labels(self.engine, self.thresholds)
+        self.retrieval_id = None
+        self.studies_df = None
+
+    def begin(self, studies_df: pd.DataFrame, retrieval_time_needed: timedelta) -> int:
+        """Create the BatchRetrieval of this run, the papers in studies_df are added on publish."""
+        self.studies_df = studies_df
+        with self.engine.begin() as conn:
+            self.retrieval_id = conn.execute(insert(BatchRetrieval).values(
+                date=datetime.now(timezone.utc),
+                number_new_papers=len(studies_df),
+                retrieval_time_needed=retrieval_time_needed
+            ).returning(BatchRetrieval.id)).scalar_one()
+        logging.info(f'Staging predictions for batch retrieval {self.retrieval_id}')
+        return self.retrieval_id
+
+    def write(self, predictions_df: pd.DataFrame):
+        """Stage the long-format predictions of one model."""
+        if predictions_df.empty:
+            return
+        staged = predictions_df.rename(columns={'id': 'paper_id'})
+        staged.insert(0, 'retrieval_id', self.retrieval_id)
+        staged = staged[STAGING_COLUMNS]
+
+        if self.engine.dialect.name == 'postgresql':
+            # COPY is by far the fastest way to load many rows into Postgres
+            buffer = io.StringIO()
+            staged.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            connection = self.engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        f"COPY prediction_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+                connection.commit()
+            finally:
+                connection.close()
+        else:
+            with self.engine.begin() as conn:
+                conn.execute(insert(PredictionStaging), staged.to_dict('records'))
+        logging.info(f'Staged {len(staged)} predictions of {staged["model"].iloc[0]}')
+
+    def _new_papers(self, conn) -> list[dict]:
+        """Papers of the studies that are not in the database yet, same rules as populate.py."""
+        studies = self.studies_df.fillna('')
+        # For now, papers without abstracts are skipped, like in populate.py
+        studies = studies[(studies['abstract'] != '') & (studies['year'] != '')]
+        ids = [int(i) for i in studies['id']]
+        pubmed_ids = [int(i) for i in studies['pubmed_id'] if i != '']
+        existing_ids = set(conn.execute(select(Paper.id).where(Paper.id.in_(ids))).scalars())
+        existing_pmids = set(conn.execute(select(Paper.pubmed_id).where(Paper.pubmed_id.in_(pubmed_ids))).scalars())
+        existing_titles = set(conn.execute(select(Paper.title, Paper.year).where(
+            Paper.title.in_(studies['title'].tolist()))).tuples())
+
+        papers = []
+        for row in studies.to_dict('records'):
+            pubmed_id = int(row['pubmed_id']) if row['pubmed_id'] != '' else None
+            if (int(row['id']) in existing_ids or pubmed_id in existing_pmids
+                    or (row['title'], int(row['year'])) in existing_titles):
+                continue
+            papers.append({
+                'id': int(row['id']),
+                'pubmed_id': pubmed_id,
+                'title': row['title'],
+                'abstract': row['abstract'],
+                'prediction_input': row['title'] + '.^\n' + row['abstract'],
+                'key_terms': row['keywords'] or None,
+                'doi': row['doi'] or None,
+                'year': int(row['year']),
+                'authors': '',
+                'link_to_fulltext': None,
+                'link_to_pubmed': row['pubmed_url'] or None,
+                'retrieval_id': self.retrieval_id,
+            })
+            existing_ids.add(int(row['id']))
+        return papers
+
+    def publish(self):
+        """Add the new papers and move their staged predictions to the prediction table, atomically."""
+        with self.engine.begin() as conn:
+            papers = self._new_papers(conn)
+            if papers:
+                conn.execute(insert(Paper), papers)
+            updated = conn.execute(UPDATE_PREDICTIONS, {'retrieval_id': self.retrieval_id}).rowcount
+            published = conn.execute(PUBLISH_PREDICTIONS, {'retrieval_id': self.retrieval_id}).rowcount
+            # The predicted labels of the batch, for the webapp queries
+            staged = pd.read_sql(select(
+                PredictionStaging.paper_id, PredictionStaging.task, PredictionStaging.label,
+                PredictionStaging.probability, PredictionStaging.is_multilabel
+            ).join(Paper, Paper.id == PredictionStaging.paper_id).where(
+                PredictionStaging.retrieval_id == self.retrieval_id), conn)
+            labels = replace_labels(conn, staged, self.thresholds)
+            bump_versions(conn, staged['task'].unique())
+            conn.execute(delete(PredictionStaging).where(PredictionStaging.retrieval_id == self.retrieval_id))
+        logging.info(f'Published {len(papers)} papers, {published} predictions ({updated} updated) and {labels} labels '
+                     f'of batch retrieval {self.retrieval_id}')
+
+    def discard(self):
+        """Drop the staged predictions and the batch retrieval of a failed run."""
+        if self.retrieval_id is None:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(delete(PredictionStaging).where(PredictionStaging.retrieval_id == self.retrieval_id))
+            conn.execute(delete(BatchRetrieval).where(BatchRetrieval.id == self.retrieval_id))
+        logging.info(f'Discarded staged predictions of batch retrieval {self.retrieval_id}')
@@ -0,0 +1,259 @@
+"""
+Distil the classifiers of model_paths.json into one student: a shared encoder with one
+classification head per task, so that all tasks are predicted in a single encoder pass.
+
+The teachers label the texts of a studies file (soft labels), the student is trained on them
+and compared with the teachers on a held-out part of the texts (agreement report).
+
+    python pipeline/distill.py -s data/relevant_studies/<studies>.parquet --student_base <checkpoint>
+    python pipeline/predict.py --student models/distilled_<yyyymmdd>/student
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch import nn
+from transformers import AutoModel, AutoTokenizer, Trainer, TrainingArguments
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from pipeline.predict import (SimpleDataset, DynamicPaddingCollator, load_model, predict_logits, to_long_format,
+                              model_name)
+from pipeline.tokenization import encode_texts, get_encoded_texts
+from pipeline.artifacts import read_table
+from pipeline.telemetry import record
+
+MODEL_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_paths.json')
+STUDENT_CONFIG = 'student.json'
+HEADS_FILE = 'heads.pt'
+
+
+def student_tasks(model_info: list[dict]) -> list[dict]:
+    """Tasks the student learns: all sequence classifiers except the relevance filter."""
+    return [m for m in model_info if m['task'].lower() != 'relevant' and 'ner' not in m['task'].lower()]
+
+
+class MultiTaskStudent(nn.Module):
+    """Shared encoder with one linear head per task, the logits of all heads are concatenated."""
+
+    def __init__(self, encoder, tasks: list[dict], dropout: float = 0.1):
+        super().__init__()
+        self.encoder = encoder
+        self.tasks = tasks
+        self.dropout = nn.Dropout(dropout)
+        self.heads = nn.ModuleList([nn.Linear(encoder.config.hidden_size, len(t['id2label'])) for t in tasks])
+        sizes = [len(t['id2label']) for t in tasks]
+        self.slices = [slice(start, start + size) for start, size in zip(np.cumsum([0] + sizes[:-1]).tolist(), sizes)]
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, **kwargs):
+        hidden = self.encoder(input_ids=input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids).last_hidden_state[:, 0]
+        hidden = self.dropout(hidden)
+        return SequenceClassifierOutput(logits=torch.cat([head(hidden) for head in self.heads], dim=-1))
+
+    def save(self, path: str, tokenizer):
+        os.makedirs(path, exist_ok=True)
+        self.encoder.save_pretrained(path)
+        tokenizer.save_pretrained(path)
+        torch.save(self.heads.state_dict(), os.path.join(path, HEADS_FILE))
+        with open(os.path.join(path, STUDENT_CONFIG), 'w', encoding='utf-8') as f:
+            json.dump({'tasks': self.tasks}, f, indent=4)
+
+    @classmethod
+    def load(cls, path: str) -> 'MultiTaskStudent':
+        with open(os.path.join(path, STUDENT_CONFIG), 'r', encoding='utf-8') as f:
+            tasks = json.load(f)['tasks']
+        student = cls(AutoModel.from_pretrained(path, add_pooling_layer=False), tasks)
+        student.heads.load_state_dict(torch.load(os.path.join(path, HEADS_FILE), map_location='cpu'))
+        return student.eval()
+
+
+def load_student(path: str) -> Trainer:
+    """Student wrapped in a Trainer, so that predict_logits works on it like on the teachers."""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    args = TrainingArguments(output_dir=os.path.join(path, '.trainer'), report_to=[], disable_tqdm=True)
+    return Trainer(model=MultiTaskStudent.load(path).to(device), args=args, tokenizer=tokenizer,
+                   data_collator=DynamicPaddingCollator(tokenizer))
+
+
+def task_probabilities(logits: np.ndarray, tasks: list[dict]) -> list[np.ndarray]:
+    """Split concatenated logits into the (texts x labels) probability matrix of each task."""
+    probs, start = [], 0
+    for t in tasks:
+        task_logits = torch.from_numpy(logits[:, start:start + len(t['id2label'])])
+        start += len(t['id2label'])
+        probs.append((torch.sigmoid(task_logits) if t['is_multilabel'] else F.softmax(task_logits, dim=-1)).numpy())
+    return probs
+
+
+def run_student(student_path: str, models: list[dict], relevant_df: pd.DataFrame,
+                unscored_ids: list[list]) -> list[pd.DataFrame]:
+    """
+    Predict the tasks of models with the student in one encoder pass over the papers that any of them
+    has not scored yet, and return the long-format predictions of each model (see to_long_format).
+    """
+    started = time.perf_counter()
+    trainer = load_student(student_path)
+    tasks = trainer.model.tasks
+    columns = {t['task']: i for i, t in enumerate(tasks)}
+    df = relevant_df[relevant_df['id'].isin(set().union(*map(set, unscored_ids)))]
+    encodings = get_encoded_texts(trainer.tokenizer, df[SimpleDataset.TEXT_COL].tolist())
+    data = SimpleDataset(df, trainer.tokenizer, encodings=encodings)
+    probs = task_probabilities(predict_logits(trainer, data).predictions, tasks)
+    logging.info(f'Completed predictions for student {student_path} ({len(tasks)} tasks, {len(df)} papers)')
+    record('predict', model=model_name({'model_path': student_path}), rows=len(df),
+           seconds=time.perf_counter() - started)
+
+    results = []
+    for m, ids in zip(models, unscored_ids):
+        keep = np.isin(data.ids, ids)
+        results.append(to_long_format(data.ids[keep], probs[columns[m['task']]][keep], m))
+    return results
+
+
+def teacher_logits(tasks: list[dict], texts: list[str]) -> np.ndarray:
+    """Concatenated logits of all teachers on the texts (texts x sum of labels)."""
+    df = pd.DataFrame({'id': range(len(texts)), 'text': texts})
+    logits = []
+    for t in tasks:
+        trainer = load_model(t['model_path'], t['task'])
+        trainer.args.disable_tqdm = True
+        data = SimpleDataset(df, trainer.tokenizer, multilabel=t['is_multilabel'],
+                             encodings=get_encoded_texts(trainer.tokenizer, texts))
+        logits.append(predict_logits(trainer, data).predictions.astype(np.float32))
+        logging.info(f'Labelled {len(texts)} texts with teacher {t["model_path"]}')
+    return np.concatenate(logits, axis=1)
+
+
+def distillation_loss(student_logits: torch.Tensor, targets: torch.Tensor, student: MultiTaskStudent,
+                      temperature: float) -> torch.Tensor:
+    """Mean over tasks of KL divergence (single-label) or soft-target BCE (multilabel) at the temperature."""
+    losses = []
+    for t, cols in zip(student.tasks, student.slices):
+        s, teacher = student_logits[:, cols] / temperature, targets[:, cols] / temperature
+        if t['is_multilabel']:
+            losses.append(F.binary_cross_entropy_with_logits(s, torch.sigmoid(teacher)))
+        else:
+            losses.append(F.kl_div(F.log_softmax(s, dim=-1), F.softmax(teacher, dim=-1), reduction='batchmean'))
+    return torch.stack(losses).mean() * temperature ** 2
+
+
+def agreement_report(student_probs: list[np.ndarray], teacher_probs: list[np.ndarray], tasks: list[dict]) -> pd.DataFrame:
+    """
+    Per task: how often the student takes the same decisions as the teacher
+    (labels above prediction_threshold for multilabel tasks, the argmax otherwise).
+    """
+    rows = []
+    for t, s, p in zip(tasks, student_probs, teacher_probs):
+        if t['is_multilabel']:
+            threshold = float(t['prediction_threshold'])
+            s_dec, p_dec = s >= threshold, p >= threshold
+            label_agreement = (s_dec == p_dec).mean()
+            exact = (s_dec == p_dec).all(axis=1).mean()
+        else:
+            exact = label_agreement = (s.argmax(axis=1) == p.argmax(axis=1)).mean()
+        rows.append({
+            'task': t['task'],
+            'is_multilabel': t['is_multilabel'],
+            'label_agreement': float(label_agreement),
+            'exact_agreement': float(exact),
+            'mean_abs_diff': float(np.abs(s - p).mean()),
+        })
+    return pd.DataFrame(rows)
+
+
+def distill(studies_file: str, student_base: str, output_dir: str, model_info: list[dict], epochs: int = 3,
+            batch_size: int = 16, learning_rate: float = 5e-5, temperature: float = 2.0,
+            eval_fraction: float = 0.1, seed: int = 42) -> pd.DataFrame:
+    """Train the student on the teachers' soft labels, save it to output_dir and return the agreement report."""
+    torch.manual_seed(seed)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tasks = student_tasks(model_info)
+    studies = read_table(studies_file)
+    texts = [text if isinstance(text, str) else '' for text in studies[SimpleDataset.TEXT_COL]]
+    targets = teacher_logits(tasks, texts)
+
+    # Held-out texts for the agreement report
+    order = np.random.default_rng(seed).permutation(len(texts))
+    n_eval = max(1, int(len(texts) * eval_fraction))
+    eval_idx, train_idx = order[:n_eval], order[n_eval:]
+
+    tokenizer = AutoTokenizer.from_pretrained(student_base)
+    student = MultiTaskStudent(AutoModel.from_pretrained(student_base, add_pooling_layer=False), tasks).to(device)
+    encodings = encode_texts(tokenizer, texts)
+    collator = DynamicPaddingCollator(tokenizer)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+
+    for epoch in range(epochs):
+        student.train()
+        total = 0.0
+        batches = np.array_split(np.random.default_rng(seed + epoch).permutation(train_idx),
+                                 max(1, int(np.ceil(len(train_idx) / batch_size))))
+        for batch_idx in batches:
+            batch = {k: v.to(device) for k, v in collator([{'input_ids': encodings[i]} for i in batch_idx]).items()}
+            loss = distillation_loss(student(**batch).logits, torch.from_numpy(targets[batch_idx]).to(device),
+                                     student, temperature)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item()
+        logging.info(f'Epoch {epoch + 1}/{epochs}: distillation loss {total / len(batches):.4f}')
+
+    student.save(output_dir, tokenizer)
+    logging.info(f'Saved student to {output_dir}')
+
+    trainer = load_student(output_dir)
+    eval_df = pd.DataFrame({'id': eval_idx, 'text': [texts[i] for i in eval_idx]})
+    data = SimpleDataset(eval_df, trainer.tokenizer, pretokenize=True)
+    student_probs = task_probabilities(predict_logits(trainer, data).predictions, tasks)
+    report = agreement_report(student_probs, task_probabilities(targets[eval_idx], tasks), tasks)
+    report.to_csv(os.path.join(output_dir, 'agreement.csv'), index=False)
+    return report
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Distil the classification models into one multi-task student')
+    arg_parser.add_argument('-s', '--studies_file', type=str, required=True,
+                            help='Studies whose texts the teachers label for training')
+    arg_parser.add_argument('--student_base', type=str, required=True,
+                            help='Checkpoint (or model name) the student encoder starts from')
+    arg_parser.add_argument('-o', '--output_dir', type=str,
+                            default=f'models/distilled_{datetime.now().strftime("%Y%m%d")}/student',
+                            help='Where to save the student, its parent folder names the model in the predictions')
+    arg_parser.add_argument('-m', '--model_info', type=str, default=MODEL_INFO,
+                            help='Path to the model info JSON with the teachers')
+    arg_parser.add_argument('--epochs', type=int, default=3)
+    arg_parser.add_argument('--batch_size', type=int, default=16)
+    arg_parser.add_argument('--learning_rate', type=float, default=5e-5)
+    arg_parser.add_argument('--temperature', type=float, default=2.0)
+    arg_parser.add_argument('--eval_fraction', type=float, default=0.1,
+                            help='Share of the texts held out for the agreement report')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.model_info, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+
+    report = distill(args.studies_file, args.student_base, args.output_dir, model_info, epochs=args.epochs,
+                     batch_size=args.batch_size, learning_rate=args.learning_rate,
+                     temperature=args.temperature, eval_fraction=args.eval_fraction)
+    print(report.to_string(index=False))
@@ -0,0 +1,120 @@
+"""
+Prediction ledger: which papers have been scored by which model checkpoint.
+
+Checkpoints are identified by a hash of their files, so replacing the checkpoint of a task in
+model_paths.json makes all papers unscored for that task only, while the other tasks keep
+skipping the papers they have already scored. Papers only count as scored once their predictions
+are in the database, until populate.py has ingested a predictions file they are pending under its
+name. The ledger is a small SQLite file next to the prediction files.
+"""
+
+import os
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+from typing import Iterable
+
+import numpy as np
+
+LEDGER_PATH = os.getenv('PREDICTION_LEDGER', os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'data', 'prediction_ledger.sqlite'))
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def paper_key(value) -> str:
+    """Ledger key of a paper id or pubmed id, 40791037, 40791037.0 and '40791037' -> '40791037'"""
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+class PredictionLedger:
+    """SQLite table of (paper, task, checkpoint) triples that have been scored."""
+
+    def __init__(self, path: str = LEDGER_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS scored (
+                paper_key TEXT NOT NULL,
+                task TEXT NOT NULL,
+                checkpoint TEXT NOT NULL,
+                scored_at TEXT NOT NULL,
+                PRIMARY KEY (task, checkpoint, paper_key)
+            );
+            CREATE TABLE IF NOT EXISTS pending (
+                paper_key TEXT NOT NULL,
+                task TEXT NOT NULL,
+                checkpoint TEXT NOT NULL,
+                batch TEXT NOT NULL,
+                scored_at TEXT NOT NULL,
+                PRIMARY KEY (task, checkpoint, paper_key)
+            );
+            CREATE INDEX IF NOT EXISTS pending_batch ON pending (batch);
+            CREATE TABLE IF NOT EXISTS checkpoint_file (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def _file_hash(self, path: str) -> str:
+        """Content hash of a checkpoint file, recomputed only when its size or mtime changed."""
+        stat = os.stat(path)
+        row = self.conn.execute('SELECT size, mtime, sha256 FROM checkpoint_file WHERE path = ?',
+                                (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        self.conn.execute('INSERT OR REPLACE INTO checkpoint_file VALUES (?, ?, ?, ?)',
+                          (path, stat.st_size, stat.st_mtime, h.hexdigest()))
+        self.conn.commit()
+        return h.hexdigest()
+
+    def checkpoint_hash(self, model_path: str) -> str:
+        """Hash of the files (weights, config, tokenizer) of a checkpoint directory."""
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(model_path)):
+            path = os.path.join(model_path, name)
+            if os.path.isfile(path):
+                h.update(name.encode('utf-8'))
+                h.update(self._file_hash(path).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def unscored(self, task: str, checkpoint: str, keys: Iterable[str]) -> np.ndarray:
+        """Boolean mask over keys, True for papers not yet scored by this checkpoint."""
+        keys = list(keys)
+        scored = {row[0] for row in self.conn.execute(
+            'SELECT paper_key FROM scored WHERE task = ? AND checkpoint = ?', (task, checkpoint))}
+        return np.fromiter((key not in scored for key in keys), dtype=bool, count=len(keys))
+
+    def mark_scored(self, task: str, checkpoint: str, keys: Iterable[str]):
+        now = datetime.now(timezone.utc).isoformat()
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO scored VALUES (?, ?, ?, ?)',
+                                  ((key, task, checkpoint, now) for key in keys))
+
+    def mark_pending(self, batch: str, task: str, checkpoint: str, keys: Iterable[str]):
+        """Papers scored into the predictions file batch, recorded as scored by commit_batch once it is ingested."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self.conn:
+            # A paper scored again (its earlier batch was not ingested) is pending under the new batch
+            self.conn.executemany('INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?, ?)',
+                                  ((key, task, checkpoint, batch, now) for key in keys))
+
+    def commit_batch(self, batch: str) -> int:
+        """Record the pending papers of a predictions file as scored, returns their number."""
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO scored SELECT paper_key, task, checkpoint, scored_at FROM pending WHERE batch = ?',
+                (batch,))
+            self.conn.execute('DELETE FROM pending WHERE batch = ?', (batch,))
+        return cursor.rowcount
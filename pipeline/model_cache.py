@@ -0,0 +1,176 @@
+"""
+Memory management of the model checkpoints in the prediction pipeline.
+
+Checkpoints that only have pytorch_model.bin are converted once to safetensors (into a cache directory
+of the pipeline, the checkpoint directories can be read-only), which are memory-mapped when loaded
+instead of unpickled into RAM.
+ModelCache keeps at most max_models loaded models; evicted and released models are garbage
+collected right away and the freed memory is handed back to the OS, and the peak RSS while
+loading and running each model is recorded, so the container can run with a hard memory limit.
+"""
+
+import os
+import gc
+import json
+import ctypes
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+MODEL_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_paths.json')
+SAFETENSORS_CACHE_DIR = os.getenv('SAFETENSORS_CACHE_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.model_cache'))
+WEIGHTS_FILE = 'model.safetensors'
+# Files of the checkpoint the conversion is made from, a change to any of them converts it again
+SOURCE_FILES = ('pytorch_model.bin', 'config.json')
+
+
+def conversion_key(model_path: str) -> str:
+    """Hash of the checkpoint's path and the size and modification time of its source files."""
+    h = hashlib.sha256(os.path.abspath(model_path).encode('utf-8'))
+    for name in SOURCE_FILES:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def safetensors_checkpoint(model_path: str, model_class, cache_dir: str = SAFETENSORS_CACHE_DIR) -> str:
+    """
+    Directory with the checkpoint's weights as safetensors, converted on first use into cache_dir.
+    Checkpoints that come with model.safetensors are used as they are, and so is the original checkpoint
+    if it cannot be converted, the conversion only saves memory.
+    """
+    source = os.path.join(model_path, 'pytorch_model.bin')
+    if os.path.exists(os.path.join(model_path, WEIGHTS_FILE)) or not os.path.exists(source):
+        return model_path
+    target_dir = os.path.join(cache_dir, conversion_key(model_path))
+    if os.path.exists(os.path.join(target_dir, WEIGHTS_FILE)):
+        return target_dir
+
+    logging.info(f'Converting {source} to safetensors in {target_dir}')
+    model = None
+    try:
+        model = model_class.from_pretrained(model_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmp_dir:
+            # save_pretrained takes care of tied weights, which safetensors cannot store twice
+            model.save_pretrained(tmp_dir, safe_serialization=True)
+            converted = os.path.join(tmp_dir, 'converted')
+            os.makedirs(converted)
+            for name in ('config.json', WEIGHTS_FILE):
+                os.replace(os.path.join(tmp_dir, name), os.path.join(converted, name))
+            os.replace(converted, target_dir)
+    except OSError as e:
+        logging.warning(f'Could not convert {model_path} to safetensors, loading it as it is: {e}')
+        return model_path
+    finally:
+        del model
+        release_memory()
+    return target_dir
+
+
+def release_memory():
+    """Collect unreachable models and return the freed heap memory to the OS."""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    try:
+        # glibc keeps freed memory in its arenas otherwise, which still counts towards the RSS
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of this process (Linux), returns False if it cannot be reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process since the last reset_peak_rss, or since the start."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ModelCache:
+    """Loaded models by (model_path, backend), at most max_models resident, least recently used evicted first."""
+
+    def __init__(self, max_models: int = 1):
+        self.max_models = max(max_models, 1)
+        self._models: OrderedDict = OrderedDict()
+        self.peak_rss: dict[str, float] = {}
+
+    def __contains__(self, model_path: str) -> bool:
+        return any(path == model_path for path, _ in self._models)
+
+    def get(self, model_path: str, task: str, backend: str = 'torch'):
+        from pipeline.predict import load_model
+
+        key = (model_path, backend)
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+        while len(self._models) >= self.max_models:
+            (evicted, _), _ = self._models.popitem(last=False)
+            release_memory()
+            logging.info(f'Evicted model {evicted}')
+        self._models[key] = load_model(model_path, task, backend=backend)
+        return self._models[key]
+
+    def release(self, model_path: str = None):
+        """Drop one model (all with model_path None) and free its memory now, not whenever gc gets to it."""
+        for key in [key for key in self._models if model_path is None or key[0] == model_path]:
+            del self._models[key]
+        release_memory()
+
+    @contextmanager
+    def track(self, model_path: str):
+        """Record the peak RSS while the model is loaded and run."""
+        resettable = reset_peak_rss()
+        try:
+            yield
+        finally:
+            peak = peak_rss_mb()
+            self.peak_rss[model_path] = max(peak, self.peak_rss.get(model_path, 0))
+            logging.info(f'Peak RSS of {model_path}: {peak:.0f} MB'
+                         + ('' if resettable else ' (process peak, could not be reset)'))
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Convert the checkpoints in model_paths.json to safetensors ahead of prediction')
+    arg_parser.add_argument('-m', '--model_info', type=str, default=MODEL_INFO,
+                            help='Path to the model info JSON')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    from transformers import AutoModelForTokenClassification, AutoModelForSequenceClassification
+
+    with open(args.model_info, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+    for m in model_info:
+        model_class = AutoModelForTokenClassification if 'ner' in m['task'].lower() else AutoModelForSequenceClassification
+        print(f"{m['task']}: {safetensors_checkpoint(m['model_path'], model_class)}")
@@ -0,0 +1,254 @@
+"""
+Local inference server that keeps the classifiers of model_paths.json in memory.
+
+Models are loaded on first use and at most `max_resident` of them are kept, the least
+recently used one is dropped first. Requests for the same task that arrive within
+`max_wait_ms` of each other are run as one batch (micro-batching), so concurrent callers
+share a forward pass instead of queueing for the model one by one.
+
+Start the server:
+    python pipeline/model_server.py --port 8765 --max_resident 4
+
+Classify papers:
+    curl -X POST localhost:8765/predict -d '{"papers": [{"title": "...", "abstract": "..."}], "tasks": ["Study Type"]}'
+"""
+
+import os
+import sys
+import json
+import queue
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import requests
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from pipeline.model_cache import release_memory
+
+MODEL_SERVER_URL = os.getenv('MODEL_SERVER_URL', 'http://127.0.0.1:8765')
+MODEL_INFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_paths.json')
+
+
+def paper_text(paper: dict) -> str:
+    """Prediction input of a paper, in the same format as the fetch results."""
+    return f"{paper.get('title') or ''}^\n{paper.get('abstract') or ''}"
+
+
+class ModelRegistry:
+    """Lazily loaded models, bounded to the max_resident most recently used ones."""
+
+    def __init__(self, model_info: list[dict], max_resident: int = 4, backend: str = 'torch'):
+        # Sequence classifiers only, NER models label tokens
+        self.model_info = {m['task']: m for m in model_info if 'ner' not in m['task'].lower()}
+        self.max_resident = max_resident
+        self.backend = backend
+        self._resident: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: dict[str, threading.Lock] = {task: threading.Lock() for task in self.model_info}
+
+    def resident(self) -> list[str]:
+        with self._lock:
+            return list(self._resident)
+
+    def get(self, task: str):
+        with self._lock:
+            if task in self._resident:
+                self._resident.move_to_end(task)
+                return self._resident[task]
+
+        # Only one thread loads a model, the others wait for it
+        with self._loading[task]:
+            with self._lock:
+                if task in self._resident:
+                    return self._resident[task]
+            from pipeline.predict import load_model
+
+            m = self.model_info[task]
+            trainer = load_model(m['model_path'], m['task'], backend=self.backend)
+            if hasattr(trainer, 'args'):
+                trainer.args.disable_tqdm = True
+            logging.info(f'Loaded model {m["model_path"]} for task {task}')
+
+            with self._lock:
+                self._resident[task] = trainer
+                while len(self._resident) > self.max_resident:
+                    evicted, _ = self._resident.popitem(last=False)
+                    logging.info(f'Evicted model for task {evicted}')
+                    release_memory()
+            return trainer
+
+
+class MicroBatcher:
+    """Collects the requests for one task and runs them in batches of up to max_batch_size texts."""
+
+    def __init__(self, registry: ModelRegistry, task: str, max_batch_size: int = 32, max_wait_ms: float = 10):
+        self.registry = registry
+        self.task = task
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True, name=f'batcher-{task}').start()
+
+    def submit(self, texts: list[str]) -> Future:
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            requests_ = [self._queue.get()]
+            size = len(requests_[0][0])
+            # Wait a little for concurrent requests to share the forward pass
+            while size < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                requests_.append(request)
+                size += len(request[0])
+
+            texts = [text for request_texts, _ in requests_ for text in request_texts]
+            try:
+                probs = self._predict(texts)
+            except Exception as e:
+                logging.error(f'Prediction for task {self.task} failed: {e}', exc_info=True)
+                for _, future in requests_:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for request_texts, future in requests_:
+                future.set_result(probs[start:start + len(request_texts)])
+                start += len(request_texts)
+
+    def _predict(self, texts: list[str]) -> np.ndarray:
+        from pipeline.predict import SimpleDataset, predict_probabilities
+
+        m = self.registry.model_info[self.task]
+        trainer = self.registry.get(self.task)
+        data = SimpleDataset(pd.DataFrame({'id': range(len(texts)), 'text': texts}), trainer.tokenizer,
+                             multilabel=m['is_multilabel'], pretokenize=True)
+        return predict_probabilities(trainer, data)
+
+
+class ModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Accept many concurrent callers, the default backlog of 5 resets connections under load
+    request_queue_size = 128
+
+    def __init__(self, address, registry: ModelRegistry, max_batch_size: int = 32, max_wait_ms: float = 10):
+        super().__init__(address, ModelRequestHandler)
+        self.registry = registry
+        self.batchers = {task: MicroBatcher(registry, task, max_batch_size, max_wait_ms)
+                         for task in registry.model_info}
+
+    def classify(self, texts: list[str], tasks: list[str]) -> list[dict]:
+        """Probabilities and predicted labels per text and task."""
+        futures = {task: self.batchers[task].submit(texts) for task in tasks}
+        results = [{} for _ in texts]
+        for task, future in futures.items():
+            m = self.registry.model_info[task]
+            labels = [m['id2label'][str(i)] for i in range(len(m['id2label']))]
+            probs = future.result()
+            if m['is_multilabel']:
+                predicted = probs >= float(m['prediction_threshold'])
+            else:
+                predicted = np.eye(len(labels), dtype=bool)[probs.argmax(axis=1)]
+            for i, (p, mask) in enumerate(zip(probs, predicted)):
+                results[i][task] = {
+                    'probabilities': dict(zip(labels, p.astype(float).tolist())),
+                    'labels': [label for label, selected in zip(labels, mask) if selected],
+                }
+        return results
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    server: ModelServer
+
+    def _send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': 'not found'})
+            return
+        self._send_json(200, {'tasks': list(self.server.registry.model_info),
+                              'resident': self.server.registry.resident()})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            texts = body.get('texts') or [paper_text(p) for p in body.get('papers', [])]
+            tasks = body.get('tasks') or list(self.server.registry.model_info)
+        except (ValueError, AttributeError, TypeError) as e:
+            self._send_json(400, {'error': f'invalid request: {e}'})
+            return
+        unknown = [task for task in tasks if task not in self.server.registry.model_info]
+        if unknown:
+            self._send_json(400, {'error': f'unknown tasks: {unknown}'})
+            return
+        try:
+            self._send_json(200, {'predictions': self.server.classify(texts, tasks) if texts else []})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+
+def classify(papers: list[dict], tasks: Optional[list[str]] = None, url: str = MODEL_SERVER_URL,
+             timeout: float = 300) -> list[dict]:
+    """Classify papers (dicts with title and abstract) with a running model server."""
+    response = requests.post(f'{url}/predict', json={'papers': papers, 'tasks': tasks}, timeout=timeout)
+    response.raise_for_status()
+    return response.json()['predictions']
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Serve the classification models from memory over HTTP')
+    arg_parser.add_argument('-m', '--model_info', type=str, default=MODEL_INFO,
+                            help='Path to the model info JSON')
+    arg_parser.add_argument('--host', type=str, default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--max_resident', type=int, default=4,
+                            help='Maximum number of models kept in memory')
+    arg_parser.add_argument('--max_batch_size', type=int, default=32,
+                            help='Maximum number of texts collected into one batch')
+    arg_parser.add_argument('--max_wait_ms', type=float, default=10,
+                            help='How long to wait for concurrent requests to batch together')
+    arg_parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx', 'onnx-int8'])
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.model_info, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+
+    registry = ModelRegistry(model_info, max_resident=args.max_resident, backend=args.backend)
+    server = ModelServer((args.host, args.port), registry,
+                         max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    logging.info(f'Serving {len(model_info)} models on http://{args.host}:{args.port}')
+    server.serve_forever()
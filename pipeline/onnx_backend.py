@@ -0,0 +1,197 @@
+"""
+ONNX Runtime backend for CPU inference, optionally with dynamic int8 quantisation.
+
+Each checkpoint is exported to ONNX once and cached next to it (<model_path>/onnx/).
+OnnxPredictor mimics the parts of the transformers Trainer used by predict.py
+(`.tokenizer` and `.predict(dataset)`), so it can be used in place of the Trainer.
+
+Run this script to compare the ONNX predictions against the PyTorch path:
+    python pipeline/onnx_backend.py -s data/relevant_studies/studies_20250813.csv --quantize
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from transformers import AutoModelForSequenceClassification, AutoModelForTokenClassification, AutoTokenizer
+from transformers.trainer_utils import PredictionOutput
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+ONNX_DIR = 'onnx'
+ONNX_OPSET = 17
+
+
+def onnx_model_file(model_path: str, quantize: bool = False) -> str:
+    return os.path.join(model_path, ONNX_DIR, 'model.int8.onnx' if quantize else 'model.onnx')
+
+
+def _is_stale(onnx_file: str, model_path: str) -> bool:
+    """The export is stale if it is missing or older than any file of the checkpoint."""
+    if not os.path.exists(onnx_file):
+        return True
+    exported = os.path.getmtime(onnx_file)
+    return any(os.path.getmtime(os.path.join(model_path, f)) > exported
+               for f in os.listdir(model_path) if os.path.isfile(os.path.join(model_path, f)))
+
+
+def export_onnx(model_path: str, task: str, quantize: bool = False) -> str:
+    """Export the checkpoint to ONNX (and quantise it) unless a current export exists, returns the .onnx file."""
+    onnx_file = onnx_model_file(model_path, quantize)
+    fp32_file = onnx_model_file(model_path, quantize=False)
+    os.makedirs(os.path.dirname(onnx_file), exist_ok=True)
+
+    if _is_stale(fp32_file, model_path):
+        if 'ner' in task.lower():
+            model = AutoModelForTokenClassification.from_pretrained(model_path)
+        else:
+            model = AutoModelForSequenceClassification.from_pretrained(model_path)
+        model.eval()
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        dummy = tokenizer(['dummy input'], return_tensors='pt')
+        input_names = [k for k in ('input_ids', 'attention_mask', 'token_type_ids') if k in dummy]
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['logits'] = {0: 'batch', 1: 'sequence'} if 'ner' in task.lower() else {0: 'batch'}
+
+        # Export into a temporary file first, parallel workers may export the same model
+        fd, tmp_file = tempfile.mkstemp(suffix='.onnx', dir=os.path.dirname(fp32_file))
+        os.close(fd)
+        with torch.no_grad():
+            torch.onnx.export(model, tuple(dummy[name] for name in input_names), tmp_file,
+                              input_names=input_names, output_names=['logits'],
+                              dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, dynamo=False)
+        os.replace(tmp_file, fp32_file)
+        logging.info(f'Exported {model_path} to {fp32_file}')
+
+    if quantize and (not os.path.exists(onnx_file) or os.path.getmtime(onnx_file) < os.path.getmtime(fp32_file)):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        fd, tmp_file = tempfile.mkstemp(suffix='.onnx', dir=os.path.dirname(onnx_file))
+        os.close(fd)
+        quantize_dynamic(fp32_file, tmp_file, weight_type=QuantType.QInt8)
+        os.replace(tmp_file, onnx_file)
+        logging.info(f'Quantised {fp32_file} to {onnx_file}')
+    return onnx_file
+
+
+class OnnxPredictor:
+    """Runs a checkpoint exported to ONNX through ONNX Runtime, a drop-in for Trainer in predict.py."""
+
+    def __init__(self, model_path: str, task: str, quantize: bool = False, batch_size: int = 8,
+                 tokenizer=None, data_collator=None, num_threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        self.tokenizer = tokenizer or AutoTokenizer.from_pretrained(model_path)
+        self.batch_size = batch_size
+        self.data_collator = data_collator
+        self.onnx_file = export_onnx(model_path, task, quantize)
+
+        options = ort.SessionOptions()
+        # Follow torch, so that the thread pinning of pipeline/scheduler.py applies here as well
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.onnx_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, dataset) -> PredictionOutput:
+        loader = DataLoader(dataset, batch_size=self.batch_size, collate_fn=self.data_collator)
+        outputs = []
+        for batch in loader:
+            feed = {name: tensor.numpy() for name, tensor in batch.items() if name in self.input_names}
+            if 'token_type_ids' in self.input_names and 'token_type_ids' not in feed:
+                # Pre-tokenised items only carry input_ids, BERT defaults the segment ids to 0
+                feed['token_type_ids'] = np.zeros_like(feed['input_ids'])
+            outputs.append(self.session.run(['logits'], feed)[0])
+
+        if outputs and outputs[0].ndim == 3:
+            # Token logits, pad the sequence axis across batches like the Trainer does
+            max_len = max(o.shape[1] for o in outputs)
+            outputs = [np.pad(o, ((0, 0), (0, max_len - o.shape[1]), (0, 0)), constant_values=-100)
+                       for o in outputs]
+        predictions = np.concatenate(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+        return PredictionOutput(predictions=predictions, label_ids=None, metrics={})
+
+
+def _probabilities(predictions_df: pd.DataFrame) -> np.ndarray:
+    return np.array(predictions_df['probability'].tolist(), dtype=np.float64)
+
+
+def agreement_report(model_info: list[dict], studies_file: str, quantize: bool = False,
+                     tolerance: float = 0.01) -> pd.DataFrame:
+    """
+    Predict the studies with the PyTorch and the ONNX backend and compare, per model,
+    the maximum absolute difference of the probabilities and the share of identical labels.
+    """
+    from pipeline.predict import SimpleDataset, load_model, predict
+
+    studies_df = pd.read_csv(studies_file)
+    backend = 'onnx-int8' if quantize else 'onnx'
+    rows = []
+    for m in model_info:
+        if 'ner' in m['task'].lower():
+            continue  # the comparison covers the classification models
+        results = {}
+        for name in ('torch', backend):
+            trainer = load_model(m['model_path'], m['task'], backend=name)
+            data = SimpleDataset(studies_df, trainer.tokenizer, multilabel=m['is_multilabel'], pretokenize=True)
+            results[name] = predict(trainer, data, threshold=m['prediction_threshold'])
+
+        reference, candidate = results['torch'], results[backend]
+        diff = np.abs(_probabilities(reference) - _probabilities(candidate))
+        labels_equal = [np.array_equal(a, b) for a, b in zip(reference['prediction'], candidate['prediction'])]
+        rows.append({
+            'task': m['task'],
+            'model': os.path.basename(os.path.dirname(m['model_path'])),
+            'max_abs_diff': float(diff.max()) if diff.size else 0.0,
+            'mean_abs_diff': float(diff.mean()) if diff.size else 0.0,
+            'label_agreement': float(np.mean(labels_equal)) if labels_equal else 1.0,
+        })
+        logging.info(f'Compared {m["model_path"]}: {rows[-1]}')
+
+    report = pd.DataFrame(rows)
+    if not report.empty:
+        report['within_tolerance'] = report['max_abs_diff'] <= tolerance
+    return report
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Export the models to ONNX and compare their predictions against PyTorch')
+    arg_parser.add_argument('-s', '--studies_file', type=str, required=True,
+                            help='Path to the studies used for the comparison')
+    arg_parser.add_argument('-m', '--model_info', type=str, default='pipeline/model_paths.json',
+                            help='Path to the model info JSON')
+    arg_parser.add_argument('--quantize', action='store_true',
+                            help='Compare the dynamically int8 quantised models')
+    arg_parser.add_argument('--tolerance', type=float, default=0.01,
+                            help='Maximum absolute probability difference accepted')
+    arg_parser.add_argument('-o', '--output_file', type=str, required=False,
+                            help='Path to write the report to (CSV)')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.model_info, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+
+    report = agreement_report(model_info, args.studies_file, quantize=args.quantize, tolerance=args.tolerance)
+    print(report.to_string(index=False))
+    if args.output_file:
+        report.to_csv(args.output_file, index=False)
+    if not report.empty and not report['within_tolerance'].all():
+        print(f"{int((~report['within_tolerance']).sum())} models exceed the tolerance of {args.tolerance}")
+        sys.exit(1)
@@ -1,13 +1,15 @@
 
 import os
+import sys
+import time
+import argparse
 import logging
 import numpy as np
-from ast import literal_eval
 import pandas as pd
 import torch
 import json
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 
 # Assuming Trainer, DataSplit, DataSplitBIO are defined elsewhere in your project
 from typing import Union
@@ -18,6 +20,18 @@ import pytz
 import pandas as pd
 from torch.utils.data import Dataset
 
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from pipeline.tokenization import EncodedTexts, encode_texts, get_encoded_texts, prune_token_cache
+from pipeline.ledger import PredictionLedger, paper_key
+from pipeline.artifacts import is_artifact, read_table, write_table
+from pipeline.autotune import tuned_settings, set_threads
+from pipeline.model_cache import ModelCache, safetensors_checkpoint, release_memory
+from pipeline.telemetry import record
+
 zurich = pytz.timezone('Europe/Zurich')
 
 
@@ -27,54 +41,117 @@ class SimpleDataset(Dataset):
     ID_COL = 'id'
     TEXT_COL = 'text'
 
-    def __init__(self, csv_file: Union[str, pd.DataFrame], tokenizer, max_len=512, multilabel=False, is_ner=False):
+    def __init__(self, csv_file: Union[str, pd.DataFrame], tokenizer, max_len=512, multilabel=False, is_ner=False,
+                 encodings: EncodedTexts = None, pretokenize: bool = False):
         if isinstance(csv_file, str):
-            self.df = pd.read_csv(csv_file)
+            self.df = read_table(csv_file)
         else:
             self.df = csv_file
         self.tokenizer = tokenizer
         self.max_len = max_len
         self.is_multilabel = multilabel
         self.is_ner = is_ner
+        # Token ids computed up front (and shared between models), see pipeline/tokenization.py
+        self.encodings = encodings
 
         # Check if pubmed_id exists, else use 'id'
         if self.ID_COL not in self.df.columns:
             self.ID_COL = 'pubmed_id'
 
+        # Plain arrays, item access does not need to go through pandas
+        self.ids = self.df[self.ID_COL].to_numpy()
+        self.texts = [text if isinstance(text, str) else '' for text in self.df[self.TEXT_COL]]
+
+        if self.is_ner and (self.encodings is None or self.encodings.char_offsets is None):
+            # NER needs the character span of each token to map the token labels back to the text
+            self.encodings = encode_texts(tokenizer, self.texts, max_len, with_char_offsets=True)
+        elif pretokenize and self.encodings is None:
+            # Batch encode the whole text column once, items are then slices of one int32 array
+            self.encodings = encode_texts(tokenizer, self.texts, max_len)
+
     def __len__(self):
         return len(self.df)
 
+    def lengths(self) -> np.ndarray:
+        """Tokenised length (or a cheap proxy for it) of each text, used to group texts of similar length into batches."""
+        if self.encodings is not None:
+            return self.encodings.lengths()
+        return np.fromiter((len(text) for text in self.texts), dtype=np.int64, count=len(self.texts))
+
     def __getitem__(self, idx):
-        row = self.df.iloc[idx]
-        id_ = row[self.ID_COL]
-        text = row[self.TEXT_COL]
-
-        if self.is_ner:
-            # Tokenize for NER, return dummy labels
-            tokens = self.tokenizer.tokenize(text)
-            dummy_label = [-100] * len(tokens)  # ignored by loss function
+        id_ = self.ids[idx]
+        text = self.texts[idx]  # empty for records without title and abstract
+
+        if self.encodings is not None:
             return {
                 'id': id_,
                 'text': text,
-                'tokens': tokens,
-                'labels': dummy_label
+                'input_ids': self.encodings[idx]
             }
         else:
-            # Standard tokenization for classification/regression
+            # Standard tokenization for classification/regression,
+            # padding is done per batch by the DynamicPaddingCollator
             encoding = self.tokenizer(
                 text,
                 truncation=True,
-                padding='max_length',
                 max_length=self.max_len,
-                return_tensors='pt'
             )
             return {
                 'id': id_,
                 'text': text,
-                **{key: val.squeeze(0) for key, val in encoding.items()}
+                **encoding
             }
 
 
+class DynamicPaddingCollator:
+    """Pads each batch only to the length of its longest sequence instead of max_len."""
+
+    def __init__(self, tokenizer):
+        self.pad_values = {
+            'input_ids': tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0,
+            'attention_mask': 0,
+            'token_type_ids': tokenizer.pad_token_type_id,
+            'labels': -100,
+        }
+
+    def __call__(self, features: list[dict]) -> dict[str, torch.Tensor]:
+        max_len = max(len(f['input_ids']) for f in features)
+        batch = {}
+        for key, pad_value in self.pad_values.items():
+            if key not in features[0]:
+                continue
+            padded = np.full((len(features), max_len), pad_value, dtype=np.int64)
+            for i, f in enumerate(features):
+                padded[i, :len(f[key])] = f[key]
+            batch[key] = torch.from_numpy(padded)
+        if 'attention_mask' not in batch:
+            # Pre-tokenised items only carry input_ids
+            lengths = np.array([len(f['input_ids']) for f in features])
+            batch['attention_mask'] = torch.from_numpy(
+                (np.arange(max_len) < lengths[:, None]).astype(np.int64))
+        return batch
+
+
+def predict_logits(trainer: Trainer, test_dataset: SimpleDataset):
+    """Run the model on the test dataset and return the Trainer's prediction output in dataset order."""
+    # Make predictions on the texts sorted by length, so that each batch holds texts of similar length
+    # and dynamic padding adds as few pad tokens as possible, then restore the input order
+    order = np.argsort(test_dataset.lengths(), kind='stable')
+    predictions = trainer.predict(Subset(test_dataset, order))
+    sorted_predictions = predictions.predictions
+    predictions = predictions._replace(predictions=np.empty_like(sorted_predictions))
+    predictions.predictions[order] = sorted_predictions
+    return predictions
+
+
+def predict_probabilities(trainer: Trainer, test_dataset: SimpleDataset) -> np.ndarray:
+    """Class probabilities (sigmoid for multilabel, softmax otherwise) as a (texts x labels) matrix."""
+    logits = torch.from_numpy(predict_logits(trainer, test_dataset).predictions)
+    if test_dataset.is_multilabel:
+        return torch.sigmoid(logits).numpy()
+    return F.softmax(logits, dim=-1).numpy()
+
+
 def predict(trainer: Trainer, test_dataset: SimpleDataset, threshold: float = 0.5) -> pd.DataFrame:
     """
     Predicts the labels for the test dataset and saves predictions to a CSV.
@@ -84,36 +161,12 @@ def predict(trainer: Trainer, test_dataset: SimpleDataset, threshold: float = 0.
     # Ensure threshold is a float
     threshold = float(threshold)
 
-
-    # Make predictions
-    predictions = trainer.predict(test_dataset)
+    predictions = predict_logits(trainer, test_dataset)
     pred_data = []
 
     # Check if this is NER
     if test_dataset.is_ner:
-        # predictions.predictions shape: (num_samples, seq_len, num_labels)
-        logits = torch.tensor(predictions.predictions)
-        probs = F.softmax(logits, dim=-1)
-        pred_labels_idx = torch.argmax(
-            probs, dim=-1).numpy()  # (num_samples, seq_len)
-
-        for i, data in enumerate(test_dataset):
-            id_ = data['id']
-            tokens = data['tokens']
-            dummy_labels = data['labels']  # all -100
-            preds = pred_labels_idx[i]
-
-            if len(preds) != len(tokens):
-                # Sometimes tokenizers add special tokens, truncate predictions accordingly
-                preds = preds[:len(tokens)]
-
-            for token, pred_idx in zip(tokens, preds):
-                pred_data.append({
-                    "id": id_,
-                    "token": token,
-                    "prediction": test_dataset.labels[pred_idx],
-                    "probability": probs[i, :len(tokens), pred_idx].tolist()
-                })
+        return ner_predictions(predictions.predictions, test_dataset)
 
     else:
         # Classification
@@ -127,9 +180,8 @@ def predict(trainer: Trainer, test_dataset: SimpleDataset, threshold: float = 0.
             pred_labels = np.argmax(
                 probs, axis=1) if logits.ndim > 1 else np.argmax(probs)
 
-        for i, data in enumerate(test_dataset):
-            id_ = data['id']
-            text = data['text']
+        # ids and texts are kept by the dataset, no need to tokenise every item again
+        for i, (id_, text) in enumerate(zip(test_dataset.ids, test_dataset.texts)):
             pred_label = pred_labels[i] if logits.ndim > 1 else int(
                 pred_labels)
             prob = probs[i].tolist() if logits.ndim > 1 else probs.tolist()
@@ -146,43 +198,195 @@ def predict(trainer: Trainer, test_dataset: SimpleDataset, threshold: float = 0.
     return df
 
 
-def load_model(model_path: str, task: str):
+def ner_predictions(logits: np.ndarray, test_dataset: SimpleDataset) -> pd.DataFrame:
+    """
+    Most likely label per token, as compact arrays per paper: character spans (token_start, token_end)
+    into the text, label ids (prediction) and their probabilities. Special tokens are dropped.
+    """
+    # logits: (num_samples, seq_len, num_labels), positions beyond a text's length are padding
+    probs, labels = F.softmax(torch.from_numpy(logits), dim=-1).max(dim=-1)
+    encodings = test_dataset.encodings
+    lengths = encodings.lengths()
+    valid = np.arange(logits.shape[1])[None, :] < lengths[:, None]
+
+    # Same order as the flat token arrays of the encodings
+    token_labels = labels.numpy()[valid].astype(np.int16)
+    token_probs = probs.numpy()[valid]
+    spans = np.asarray(encodings.char_offsets)
+    keep = spans[:, 1] > spans[:, 0]  # special tokens have an empty span
+
+    kept_counts = np.add.reduceat(keep, encodings.offsets[:-1]) if len(keep) else np.zeros(len(lengths), dtype=int)
+    kept_counts[lengths == 0] = 0
+    splits = np.cumsum(kept_counts)[:-1]
+    return pd.DataFrame({
+        'id': test_dataset.ids,
+        'text': test_dataset.texts,
+        'token_start': np.split(spans[keep, 0], splits),
+        'token_end': np.split(spans[keep, 1], splits),
+        'prediction': np.split(token_labels[keep], splits),
+        'probability': np.split(token_probs[keep], splits),
+    })
+
+
+def ner_token_rows(ner_df: pd.DataFrame, m: dict) -> pd.DataFrame:
+    """One row per token for the token table: (id, position_id, text, ner_tag, probability, task, model)"""
+    id2label = {int(k): v for k, v in m.get('id2label', {}).items()}
+    labels = np.array([id2label[i] for i in range(len(id2label))], dtype=object)
+    counts = ner_df['prediction'].map(len).to_numpy()
+    starts = np.concatenate(ner_df['token_start'].tolist()) if len(ner_df) else np.zeros(0, dtype=np.int32)
+    ends = np.concatenate(ner_df['token_end'].tolist()) if len(ner_df) else np.zeros(0, dtype=np.int32)
+    texts = np.repeat(ner_df['text'].to_numpy(), counts)
+    return pd.DataFrame({
+        'id': np.repeat(ner_df['id'].to_numpy(), counts),
+        'position_id': np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts),
+        'text': [text[start:end][:255] for text, start, end in zip(texts, starts, ends)],
+        'ner_tag': labels[np.concatenate(ner_df['prediction'].tolist())] if len(ner_df) else [],
+        'probability': np.concatenate(ner_df['probability'].tolist()).astype(np.float64) if len(ner_df) else [],
+        'task': m['task'],
+        'model': model_name(m),
+    })
+
+
+def load_model(model_path: str, task: str, backend: str = 'torch', tuned: bool = True):
+    # Batch size and thread count calibrated for this host by pipeline/autotune.py, if any
+    settings = tuned_settings(model_path, backend) if tuned and not torch.cuda.is_available() else None
+    if tuned and not torch.cuda.is_available():
+        set_threads(settings['num_threads'] if settings else None)
+
+    if backend in ('onnx', 'onnx-int8'):
+        # Exported once and cached next to the checkpoint, onnxruntime is only needed for this backend
+        from pipeline.onnx_backend import OnnxPredictor
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        return OnnxPredictor(model_path, task, quantize=backend == 'onnx-int8', tokenizer=tokenizer,
+                             data_collator=DynamicPaddingCollator(tokenizer),
+                             batch_size=settings['batch_size'] if settings else 8)
+
     # detect device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     if 'ner' in task.lower():
-        model = AutoModelForTokenClassification.from_pretrained(
-            model_path).to(device)
+        model_class = AutoModelForTokenClassification
     else:
-        model = AutoModelForSequenceClassification.from_pretrained(
-            model_path).to(device)
+        model_class = AutoModelForSequenceClassification
+    # The safetensors file is memory-mapped and copied into the model tensor by tensor,
+    # instead of unpickling the whole checkpoint next to a randomly initialised model
+    model = model_class.from_pretrained(
+        safetensors_checkpoint(model_path, model_class), low_cpu_mem_usage=True).to(device)
 
     tokenizer = AutoTokenizer.from_pretrained(model_path)
-    trainer = Trainer(model=model, tokenizer=tokenizer)
+    trainer = Trainer(model=model, tokenizer=tokenizer,
+                      data_collator=DynamicPaddingCollator(tokenizer))
+    if settings:
+        trainer.args.per_device_eval_batch_size = settings['batch_size']
     return trainer
 
 
 def get_latest_data(data_dir: str) -> str:
-    """Get lastest csv from data directory, taken the date in filename, e.g. pubmed_results_20250813_00:00:08"""
-    csv_files = [f for f in os.listdir(data_dir) if f.endswith('.csv')]
+    """
+    Get lastest csv/parquet from data directory, taken the date in filename, e.g. pubmed_results_20250813_00:00:08
+    or pubmed_results_20250813-060000_00:00:02 for the micro-batches of the watch mode
+    """
+    csv_files = [f for f in os.listdir(data_dir) if is_artifact(f)]
     if not csv_files:
         raise FileNotFoundError(
-            "No CSV files found in the specified directory.")
+            "No CSV or Parquet files found in the specified directory.")
 
     # Extract date from filenames and find the latest
-    latest_file = max(csv_files, key=lambda x: datetime.strptime(
-        x.split('_')[2], "%Y%m%d"))
+    latest_file = max(csv_files, key=lambda x: (datetime.strptime(
+        x.split('_')[2][:8], "%Y%m%d"), x.split('_')[2]))
     return os.path.join(data_dir, latest_file)
 
 
 def check_if_pred_exist(pred_dir: str, retrieval_date: str) -> str:
-    """Check if prediction file for the given retrieval date already exists."""
-    pred_files = [f for f in os.listdir(pred_dir) if f.endswith('.csv')]
+    """Check if prediction file for the given retrieval date already exists, Parquet files take precedence over CSV."""
+    pred_files = sorted((f for f in os.listdir(pred_dir) if is_artifact(f) and not f.startswith('.')),
+                        key=lambda f: not f.endswith('.parquet'))
     for f in pred_files:
         if retrieval_date in f:
             return os.path.join(pred_dir, f)
     return ""
 
-def main():
+
+def load_corpus_from_db() -> pd.DataFrame:
+    """All papers in the database with their prediction input, to score them with new or updated models."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from data.models import Paper, DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME
+
+    database_url = os.getenv(
+        "DATABASE_URL",
+        "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+            DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+    )
+    engine = create_engine(database_url, echo=False)
+    session = sessionmaker(bind=engine)()
+    try:
+        rows = session.query(Paper.id, Paper.prediction_input).order_by(Paper.id).all()
+    finally:
+        session.close()
+    return pd.DataFrame(rows, columns=['id', SimpleDataset.TEXT_COL])
+
+
+def run_model(m: dict, relevant_df: pd.DataFrame, backend: str = 'torch', cache: ModelCache = None) -> pd.DataFrame:
+    """
+    Run one classification/NER model from model_paths.json and return its predictions in long format,
+    for NER models one row per token (see ner_token_rows).
+    Without a cache the model is released as soon as it is done.
+    """
+    own_cache = cache is None
+    cache = cache or ModelCache()
+    started = time.perf_counter()
+    with cache.track(m['model_path']):
+        trainer = cache.get(m['model_path'], m['task'], backend=backend)
+        logging.info(f'Loaded model: {m["model_path"]} for task: {m["task"]}')
+        is_ner = 'ner' in m['task'].lower()
+        # Tokenised once per distinct tokenizer, shared by all models using it
+        encodings = get_encoded_texts(
+            trainer.tokenizer, relevant_df[SimpleDataset.TEXT_COL].tolist(), with_char_offsets=is_ner)
+        data = SimpleDataset(relevant_df, trainer.tokenizer,
+                            multilabel=m['is_multilabel'], is_ner=is_ner, encodings=encodings)
+        if is_ner:
+            # Token labels go to the token table instead of the predictions
+            ner_df = predict(trainer, data, threshold=m['prediction_threshold'])
+            result = ner_token_rows(ner_df, m)
+        else:
+            # Keep the probabilities as one matrix, no per-row lists
+            probs = predict_probabilities(trainer, data)
+            result = to_long_format(data.ids, probs, m)
+        logging.info(f'Completed predictions for model: {m["model_path"]}')
+    record('predict', model=model_name(m), rows=len(relevant_df), seconds=time.perf_counter() - started,
+           peak_rss_mb=cache.peak_rss[m['model_path']])
+
+    del trainer, data
+    if own_cache:
+        cache.release()
+    return result
+
+
+def model_name(m: dict) -> str:
+    """Name of a model in the predictions: the folder of its checkpoint, e.g. biobert_relevant_20250306"""
+    return os.path.basename(os.path.dirname(m['model_path']))
+
+
+def to_long_format(ids: np.ndarray, probs: np.ndarray, m: dict) -> pd.DataFrame:
+    """
+    Convert a (papers x labels) probability matrix to one row per paper and label:
+    (id, task, label, probability, is_multilabel, model)
+    """
+    n_papers, n_labels = probs.shape if probs.ndim == 2 else (len(ids), 0)
+    id2label = {int(k): v for k, v in m.get('id2label', {}).items()}
+    labels = np.array([id2label[i] for i in range(n_labels)], dtype=object)
+    return pd.DataFrame({
+        'id': np.repeat(ids, n_labels),
+        'task': m['task'],
+        'label': np.tile(labels, n_papers),
+        'probability': probs.astype(np.float64, copy=False).ravel(),
+        'is_multilabel': m['is_multilabel'],
+        'model': model_name(m),
+    })
+
+
+def main(workers: int = 1, max_resident: int = None, backend: str = 'torch', corpus: str = 'latest',
+         export_csv: bool = False, db_sink: bool = False, shards: int = 0, student: str = None):
     # Setup logging
     script_dir = os.path.dirname(os.path.abspath(__file__))
     log_dir = os.path.join(script_dir, 'log')
@@ -195,14 +399,15 @@ def main():
         format='%(asctime)s %(levelname)s %(message)s'
     )
     logging.info('Prediction process started.')
+    prune_token_cache()
     PUBMED_DATA_DIR = 'data/pubmed_fetch_results'
     MODEL_INFO = 'pipeline/model_paths.json'
     FINAL_PRED = 'data/predictions'
     RELEVANT_STUDIES = 'data/relevant_studies'
+    NER_TOKENS = 'data/ner_tokens'
 
+    sink = None
     try:
-        csv_file = get_latest_data(PUBMED_DATA_DIR)
-        logging.info(f'Loaded latest data file: {csv_file}')
         now = datetime.now(zurich)
         date = now.strftime("%Y-%m-%d")
         dfs = []
@@ -210,110 +415,214 @@ def main():
             model_info = json.load(file)
         logging.info(f'Loaded model info from {MODEL_INFO}')
 
-        # Check if predictions for this retrieval date already exist
-        rel_pred = check_if_pred_exist(RELEVANT_STUDIES, date)
-        if rel_pred:
-            logging.info(f'Relevance predictions for date {date} already exist. Skipping prediction.')
-            # load existing relevant predictions
-            relevant_df = pd.read_csv(rel_pred)
-            logging.info(f'Loaded existing relevant studies from {rel_pred}')
-        
+        if corpus == 'db':
+            # Papers in the database passed the relevance filter already, only the task models are run
+            relevant_df = load_corpus_from_db()
+            os.makedirs(FINAL_PRED, exist_ok=True)
+            relevant_file = write_table(relevant_df, os.path.join(
+                FINAL_PRED, f'.corpus_{now.strftime("%Y%m%d_%H%M%S")}.parquet'))
+            logging.info(f'Loaded {len(relevant_df)} papers from the database')
         else:
-            # Predict relevance first
-            relevant_model = next(
-                (m for m in model_info if m['task'].lower() == 'relevant'), None)
-            trainer = load_model(relevant_model['model_path'], relevant_model['task'])
-            logging.info(f'Loaded relevant model: {relevant_model["model_path"]}')
-            data = SimpleDataset(csv_file, trainer.tokenizer,
-                                multilabel=False, is_ner=False)
-            relevant_predictions_df = predict(
-                trainer, data, threshold=relevant_model['prediction_threshold'])
-            logging.info('Completed predictions for relevance model.')
-            relevant_label_id = next(
-                (k for k, v in relevant_model['id2label'].items() if v == 'relevant'), None)
-            relevant_df = relevant_predictions_df[relevant_predictions_df['prediction'] == int(
-                relevant_label_id)]
-
-            # Write relevant studies to a CSV, extract retrieval date from filename
-            retrieval_date = os.path.basename(csv_file).split('_')[2]  # yyyymmdd
-            relevant_output_file = f'studies_{retrieval_date}.csv'
+            csv_file = get_latest_data(PUBMED_DATA_DIR)
+            logging.info(f'Loaded latest data file: {csv_file}')
+            studies_df = read_table(csv_file)
+            if studies_df.empty:
+                # Articles already in the database are not fetched again, so a batch can be empty
+                logging.info('No new studies in latest data file. Skipping prediction.')
+                return
+
+            # Check if relevance predictions for this retrieval already exist
+            retrieval = os.path.splitext(os.path.basename(csv_file))[0].split('_', 2)[2]  # yyyymmdd_hh:mm:ss
             os.makedirs(RELEVANT_STUDIES, exist_ok=True)
-            relevant_df.to_csv(os.path.join(RELEVANT_STUDIES, relevant_output_file), index=False)
-            logging.info(f'Saved relevant studies to {os.path.join(RELEVANT_STUDIES, relevant_output_file)}')
-
-        clas_ner_pred = check_if_pred_exist(FINAL_PRED, date)
-        if clas_ner_pred:
-            logging.info(f'Classification/NER predictions for date {date} already exist. Skipping prediction.')
-            return
-        
-        else: 
-            for m in model_info:
-                if m['task'].lower() == 'relevant':
-                    continue  # already processed
-                trainer = load_model(m['model_path'], m['task'])
-                logging.info(f'Loaded model: {m["model_path"]} for task: {m["task"]}')
-                data = SimpleDataset(relevant_df, trainer.tokenizer,
-                                    multilabel=m['is_multilabel'], is_ner=('ner' in m['task'].lower()))
-                predictions_df = predict(
-                    trainer, data, threshold=m['prediction_threshold'])
-                logging.info(f'Completed predictions for model: {m["model_path"]}')
-                processed_data = []
-                for _, row in predictions_df.iterrows():
-                    # probability field can be a stringified list, a JSON list, a Python list, or a numpy array.
-                    prob_field = row.get('probability') if isinstance(row, dict) else row['probability']
-                    prob_values = []
-                    if isinstance(prob_field, str):
-                        # try ast.literal_eval first, then json as fallback
-                        try:
-                            prob_values = literal_eval(prob_field)
-                        except Exception:
-                            try:
-                                prob_values = json.loads(prob_field)
-                            except Exception:
-                                logging.warning(f"Could not parse probability field: {prob_field!r}")
-                                prob_values = []
-                    else:
-                        # list, tuple, numpy array, etc.
-                        prob_values = prob_field
-
-                    # Convert numpy arrays or other sequences to plain Python list
-                    try:
-                        # numpy arrays have tolist()
-                        if hasattr(prob_values, 'tolist'):
-                            prob_list = prob_values.tolist()
-                        else:
-                            prob_list = list(prob_values)
-                    except Exception:
-                        logging.warning(f"Unexpected probability format, using empty list: {type(prob_values)!r}")
-                        prob_list = []
-
-                    model_name = os.path.basename(os.path.dirname(m['model_path']))
-                    id2label = m.get('id2label', {})
-                    # make sure it's a int to string mapping
-                    id2label = {int(k): v for k, v in id2label.items()}
-
-                    for i, prob in enumerate(prob_list):
-                        pred_dict = {
-                            'id': row['id'],
-                            'task': m['task'],
-                            'label': id2label[i],
-                            'probability': prob,
-                            'is_multilabel': m['is_multilabel'],
-                            'model': model_name
-                        }
-                        processed_data.append(pred_dict)
-                dfs.append(pd.DataFrame(processed_data))
-
-            final_df = pd.concat(dfs, ignore_index=True)
-            time_passed = datetime.now(zurich) - now
-            pred_filename = f'predictions_{date}_{time_passed}.csv'
-            final_df.to_csv(os.path.join(FINAL_PRED, pred_filename), index=False)
+            rel_pred = check_if_pred_exist(RELEVANT_STUDIES, retrieval)
+            if rel_pred:
+                logging.info(f'Relevance predictions for retrieval {retrieval} already exist. Skipping prediction.')
+                # load existing relevant predictions
+                relevant_df = read_table(rel_pred)
+                relevant_file = rel_pred
+                logging.info(f'Loaded existing relevant studies from {rel_pred}')
+
+            else:
+                # Predict relevance first
+                relevant_model = next(
+                    (m for m in model_info if m['task'].lower() == 'relevant'), None)
+                started = time.perf_counter()
+                trainer = load_model(relevant_model['model_path'], relevant_model['task'], backend=backend)
+                logging.info(f'Loaded relevant model: {relevant_model["model_path"]}')
+                encodings = get_encoded_texts(
+                    trainer.tokenizer, studies_df[SimpleDataset.TEXT_COL].tolist())
+                data = SimpleDataset(studies_df, trainer.tokenizer,
+                                    multilabel=False, is_ner=False, encodings=encodings)
+                relevant_predictions_df = predict(
+                    trainer, data, threshold=relevant_model['prediction_threshold'])
+                logging.info('Completed predictions for relevance model.')
+                record('predict', model=model_name(relevant_model), rows=len(studies_df),
+                       seconds=time.perf_counter() - started)
+                relevant_label_id = next(
+                    (k for k, v in relevant_model['id2label'].items() if v == 'relevant'), None)
+                is_relevant = (relevant_predictions_df['prediction'] == int(relevant_label_id)).to_numpy()
+                # Keep all study columns, populate.py creates the papers from this file
+                relevant_df = studies_df.loc[is_relevant].reset_index(drop=True)
+                if 'id' not in relevant_df.columns:
+                    relevant_df.insert(0, 'id', data.ids[is_relevant])
+                # Free the relevance model before the other models are loaded
+                del trainer, data
+                release_memory()
+
+                # Write relevant studies, named after the retrieval (date and duration) like the fetch results
+                relevant_file = write_table(relevant_df, os.path.join(
+                    RELEVANT_STUDIES, f'studies_{retrieval}.parquet'), export_csv=export_csv)
+                logging.info(f'Saved relevant studies to {relevant_file}')
+
+            # No check for predictions of the same day, the watch mode runs several batches a day:
+            # papers that were scored already are skipped through the prediction ledger below
+
+            if db_sink:
+                # Stream the predictions of each model into the database as soon as it is done
+                from pipeline.db_sink import PredictionSink, parse_duration
+                sink = PredictionSink()
+                sink.begin(relevant_df, parse_duration(retrieval.split('_')[1]))
+
+        # Only score the papers that the current checkpoint of each model has not scored yet
+        ledger = PredictionLedger()
+        relevant_keys = np.array([paper_key(v) for v in relevant_df['id']], dtype=object)
+        models, checkpoints, unscored_ids = [], [], []
+        student_tasks = {}
+        if student:
+            # Tasks of the distilled student are scored by it, in one encoder pass, instead of their teachers
+            from pipeline.distill import STUDENT_CONFIG
+            with open(os.path.join(student, STUDENT_CONFIG), 'r', encoding='utf-8') as file:
+                student_tasks = {t['task']: {**t, 'model_path': student} for t in json.load(file)['tasks']}
+        for m in model_info:
+            if m['task'].lower() == 'relevant':
+                continue  # already processed
+            m = student_tasks.get(m['task'], m)
+            checkpoint = ledger.checkpoint_hash(m['model_path'])
+            unscored = ledger.unscored(m['task'], checkpoint, relevant_keys)
+            logging.info(f'{m["task"]}: {int(unscored.sum())} of {len(unscored)} papers '
+                         f'not scored yet by checkpoint {checkpoint}')
+            if unscored.any():
+                models.append(m)
+                checkpoints.append(checkpoint)
+                unscored_ids.append(relevant_df['id'][unscored].tolist())
+
+        token_dfs = []
+
+        def collect(df: pd.DataFrame):
+            if 'position_id' in df.columns:
+                token_dfs.append(df)  # NER output
+            elif sink:
+                sink.write(df)
+            else:
+                dfs.append(df)
+
+        by_student = [m['model_path'] == student for m in models]
+        if any(by_student):
+            from pipeline.distill import run_student
+            for df in run_student(student, [m for m, s in zip(models, by_student) if s], relevant_df,
+                                  [ids for ids, s in zip(unscored_ids, by_student) if s]):
+                collect(df)
+        teachers = [m for m, s in zip(models, by_student) if not s]
+        teacher_ids = [ids for ids, s in zip(unscored_ids, by_student) if not s]
+
+        if shards and teachers:
+            # Id-range shards in a durable work queue, claimed by local (and any external) worker processes
+            from pipeline.shards import run_sharded
+            for df in run_sharded(relevant_df, teachers, teacher_ids, shards, n_workers=workers,
+                                  backend=backend, max_resident=max_resident):
+                collect(df)
+        elif workers > 1 and teachers:
+            # The models are independent, run them side by side on pinned worker processes
+            from pipeline.scheduler import run_models_in_pool
+
+            def stream(df: pd.DataFrame):
+                # The sink and the NER tokens take each model as it finishes, the predictions file keeps
+                # the order of model_paths.json
+                if sink or 'position_id' in df.columns:
+                    collect(df)
+
+            results = run_models_in_pool(teachers, relevant_file, workers, max_resident=max_resident,
+                                         log_path=log_path, backend=backend, ids=teacher_ids, on_result=stream)
+            if not sink:
+                dfs.extend(df for df in results if 'position_id' not in df.columns)
+        else:
+            for m, ids in zip(teachers, teacher_ids):
+                collect(run_model(m, relevant_df[relevant_df['id'].isin(ids)], backend=backend))
+
+        time_passed = datetime.now(zurich) - now
+        if token_dfs:
+            # Token labels of the NER models, loaded into the token table by populate.py
+            os.makedirs(NER_TOKENS, exist_ok=True)
+            tokens_file = write_table(pd.concat(token_dfs, ignore_index=True), os.path.join(
+                NER_TOKENS, f'tokens_{date}_{time_passed}.parquet'), export_csv=export_csv)
+            logging.info(f'Saved NER token predictions to {tokens_file}')
+
+        if sink:
+            # Make the papers and all their predictions visible at once
+            sink.publish()
+        else:
+            final_df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(
+                columns=['id', 'task', 'label', 'probability', 'is_multilabel', 'model'])
+            pred_filename = f'predictions_{date}_{time_passed}.parquet'
+            os.makedirs(FINAL_PRED, exist_ok=True)
+            write_table(final_df, os.path.join(FINAL_PRED, pred_filename), export_csv=export_csv)
             logging.info(f'Saved final predictions to {os.path.join(FINAL_PRED, pred_filename)}')
-            logging.info('Prediction process completed successfully.')
+
+        # Papers count as scored once their predictions are in the database: right away with the sink,
+        # populate.py records those of the predictions file when it has ingested it
+        for m, checkpoint, ids in zip(models, checkpoints, unscored_ids):
+            keys = [paper_key(v) for v in ids]
+            if sink:
+                ledger.mark_scored(m['task'], checkpoint, keys)
+            else:
+                ledger.mark_pending(os.path.splitext(pred_filename)[0], m['task'], checkpoint, keys)
+        ledger.close()
+        if corpus == 'db':
+            os.remove(relevant_file)
+        record('predict', rows=len(relevant_df), retrieval_id=sink.retrieval_id if sink else None)
+        logging.info('Prediction process completed successfully.')
 
     except Exception as e:
         logging.error(f'Error during prediction process: {e}', exc_info=True)
+        if sink:
+            sink.discard()
+        # A non-zero exit code keeps run.py from ingesting or committing a failed batch
+        raise
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Predict relevance, classification and NER labels for the latest fetched studies')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes for the classification/NER models, '
+                                 'each pinned to its share of the CPU cores (1 runs them in this process)')
+    arg_parser.add_argument('--max_resident', type=int, default=None,
+                            help='Maximum number of models loaded at the same time, defaults to --workers')
+    arg_parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx', 'onnx-int8'],
+                            help='Inference backend, the ONNX models are exported once and cached next to the checkpoints')
+    arg_parser.add_argument('--corpus', type=str, default='latest', choices=['latest', 'db'],
+                            help='Predict the latest fetched studies, or all papers in the database '
+                                 '(e.g. after updating a model in model_paths.json)')
+    arg_parser.add_argument('--export_csv', action='store_true',
+                            help='Also write the relevant studies and predictions as CSV next to the Parquet files')
+    arg_parser.add_argument('--db_sink', action='store_true',
+                            help='Write the relevant papers and predictions straight into the database instead of '
+                                 'a predictions file for populate.py')
+    arg_parser.add_argument('--shards', type=int, default=0,
+                            help='Split the papers into this many id-range shards, scored by --workers local worker '
+                                 'processes and any workers started with pipeline/shards.py on the run directory')
+    arg_parser.add_argument('--student', type=str, default=None,
+                            help='Distilled multi-task student (see pipeline/distill.py) that predicts its tasks '
+                                 'in one encoder pass, the remaining models still run on their own')
+    return arg_parser
 
 
 if __name__ == "__main__":
-    main()
+    parser = init_args_parser()
+    args = parser.parse_args()
+    if args.db_sink and args.corpus == 'db':
+        parser.error('--db_sink stages the predictions of a retrieval, use it with --corpus latest')
+    main(workers=args.workers, max_resident=args.max_resident, backend=args.backend, corpus=args.corpus,
+         export_csv=args.export_csv, db_sink=args.db_sink, shards=args.shards,
+         student=args.student)
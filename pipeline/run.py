@@ -0,0 +1,355 @@
+"""
+Run the pipeline stages as a DAG.
+
+Each stage is a script run in its own process once the stages it depends on are done, stages
+without a dependency between them run in parallel. Before a stage runs, its inputs (data files,
+model checkpoints) and its code are fingerprinted, and if the fingerprint matches that of its
+last successful run and its outputs are still there, the stage is skipped. Wall time, CPU time
+and peak memory of each stage are taken from os.wait4 and, together with the metrics the stages
+report themselves, appended to pipeline/log/pipeline_runs.jsonl and saved to the pipeline_telemetry
+table (see pipeline/telemetry.py).
+
+With --watch the pipeline keeps running and polls PubMed at the given cadence, each poll fetches only
+the articles added since the last one and passes them through prediction and ingest as a micro-batch.
+
+    python pipeline/run.py
+    python pipeline/run.py --dry_run
+    python pipeline/run.py --force predict populate
+    python pipeline/run.py --watch 60
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import signal
+import hashlib
+import logging
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timezone
+from typing import Callable, Optional, Union
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from pipeline.artifacts import is_artifact
+from pipeline.telemetry import TELEMETRY_DIR_ENV, read_records, telemetry_rows, save_telemetry
+
+ROOT = parent_folder_path
+STATE_FILE = os.path.join(ROOT, 'data', '.pipeline_state.json')
+RUNS_LOG = os.path.join(ROOT, 'pipeline', 'log', 'pipeline_runs.jsonl')
+MODEL_INFO = os.path.join(ROOT, 'pipeline', 'model_paths.json')
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class Stage:
+    """
+    One script of the pipeline, cmd can be a function that returns the command once the dependencies are done.
+    inputs returns the files whose content decides whether the stage has to run again, it is only
+    evaluated once the dependencies are done; a stage without inputs (e.g. the fetch) always runs.
+    """
+
+    def __init__(self, name: str, cmd: Union[list[str], Callable[[], list[str]]], deps: tuple[str, ...] = (),
+                 code: tuple[str, ...] = (), inputs: Optional[Callable[[], list[str]]] = None, checkpoints: bool = False,
+                 outputs: Optional[Callable[[], list[str]]] = None):
+        self.name = name
+        self.cmd = cmd
+        self.deps = deps
+        self.code = code
+        self.inputs = inputs
+        self.checkpoints = checkpoints
+        self.outputs = outputs
+
+    def command(self) -> list[str]:
+        return self.cmd() if callable(self.cmd) else self.cmd
+
+
+def latest_artifact(directory: str) -> list[str]:
+    """Most recently written data file of a directory, as a list for the stage inputs."""
+    directory = os.path.join(ROOT, directory)
+    if not os.path.isdir(directory):
+        return []
+    files = [os.path.join(directory, f) for f in os.listdir(directory) if is_artifact(f)]
+    return [max(files, key=os.path.getmtime)] if files else []
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def checkpoint_hashes() -> list[str]:
+    """Hash of every checkpoint in model_paths.json, memoised in the prediction ledger."""
+    from pipeline.ledger import PredictionLedger
+
+    with open(MODEL_INFO, 'r', encoding='utf-8') as file:
+        model_info = json.load(file)
+    ledger = PredictionLedger()
+    hashes = [f"{m['task']}:{ledger.checkpoint_hash(m['model_path'])}" for m in model_info]
+    ledger.close()
+    return hashes
+
+
+def fingerprint(stage: Stage) -> Optional[str]:
+    """Hash of the stage's command, code, input files and checkpoints, None for stages that always run."""
+    if stage.inputs is None:
+        return None
+    h = hashlib.sha256(json.dumps(stage.command()).encode('utf-8'))
+    for pattern in stage.code:
+        for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            h.update(os.path.relpath(path, ROOT).encode('utf-8'))
+            h.update(file_hash(path).encode('utf-8'))
+    for path in stage.inputs():
+        h.update(os.path.relpath(path, ROOT).encode('utf-8'))
+        h.update(file_hash(path).encode('utf-8'))
+    if stage.checkpoints:
+        h.update('\n'.join(checkpoint_hashes()).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def pipeline_stages(db_sink: bool = False, delta: bool = False) -> list[Stage]:
+    """
+    fetch -> backfill -> predict -> populate, with the checkpoint conversion alongside fetch and backfill.
+    With delta, only the articles added to PubMed since the last fetch are fetched; if there are none, no new
+    fetch results are written and the other stages are skipped as unchanged. The fetch is recorded as done
+    (commit_fetch) only after the micro-batch was added to the database.
+    """
+    python = sys.executable
+    predict_cmd = [python, 'pipeline/predict.py'] + (['--db_sink'] if db_sink else [])
+    stages = [
+        Stage('fetch', [python, 'data/get_pubmed_data.py'] + (['--delta'] if delta else [])),
+        # Rewrites the fetch results in place, so relevance scoring has to wait for it
+        Stage('backfill', [python, 'data/backfill_abstracts.py'], deps=('fetch',),
+              code=('data/backfill_abstracts.py', 'data/data_pulling_helpers.py'),
+              inputs=lambda: latest_artifact('data/pubmed_fetch_results')),
+        # Only needs the checkpoints, runs while the data is fetched
+        Stage('prepare_models', [python, 'pipeline/model_cache.py'],
+              code=('pipeline/model_cache.py',), inputs=lambda: [MODEL_INFO], checkpoints=True),
+        Stage('predict', predict_cmd, deps=('backfill', 'prepare_models'),
+              code=('pipeline/*.py', 'data/paper_labels.py'),
+              inputs=lambda: latest_artifact('data/pubmed_fetch_results') + [MODEL_INFO],
+              checkpoints=True,
+              outputs=lambda: latest_artifact('data/relevant_studies') + latest_artifact('data/predictions')),
+    ]
+    if not db_sink:
+        # With the database sink, predict.py writes the papers and predictions itself
+        stages.append(Stage(
+            'populate', lambda: populate_command(python), deps=('predict',),
+            code=('data/populate.py', 'data/models.py', 'data/paper_labels.py'),
+            # The thresholds in model_paths.json decide the paper_label rows
+            inputs=lambda: (latest_artifact('data/relevant_studies') + latest_artifact('data/predictions')
+                            + latest_artifact('data/ner_tokens') + [MODEL_INFO])))
+    if delta:
+        # The fetched articles are only recorded once their micro-batch is in the database, so that the
+        # next poll fetches a failed micro-batch again
+        stages.append(Stage('commit_fetch', [python, 'data/get_pubmed_data.py', '--commit'],
+                            deps=(stages[-1].name,)))
+    return stages
+
+
+def populate_command(python: str) -> list[str]:
+    """populate.py with the files the predict stage has just written, instead of looking them up by date."""
+    cmd = [python, 'data/populate.py']
+    for flag, directory in (('-s', 'data/relevant_studies'), ('-p', 'data/predictions'), ('-t', 'data/ner_tokens')):
+        cmd += [item for path in latest_artifact(directory) for item in (flag, os.path.relpath(path, ROOT))]
+    return cmd
+
+
+def load_state(path: str = STATE_FILE) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state: dict, path: str = STATE_FILE):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def is_up_to_date(stage: Stage, state: dict) -> tuple[bool, Optional[str]]:
+    """Whether the stage can be skipped, and its current fingerprint."""
+    current = fingerprint(stage)
+    last = state.get(stage.name, {})
+    if current is None or last.get('fingerprint') != current:
+        return False, current
+    outputs = last.get('outputs', [])
+    return all(os.path.exists(os.path.join(ROOT, path)) for path in outputs), current
+
+
+def run_stages(stages: list[Stage], force: tuple[str, ...] = (), dry_run: bool = False,
+               env: Optional[dict] = None) -> dict[str, dict]:
+    """Run the stages in dependency order, in parallel where possible, and return the metrics of each stage."""
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = set(stage.deps) - names
+        if missing:
+            raise ValueError(f'Stage {stage.name} depends on unknown stages {missing}')
+
+    state = load_state()
+    pending = {stage.name: stage for stage in stages}
+    running: dict[int, tuple[Stage, subprocess.Popen, float]] = {}
+    done: set[str] = set()
+    failed: set[str] = set()
+    metrics: dict[str, dict] = {}
+
+    while pending or running:
+        # Start every stage whose dependencies are done, skip those that are unchanged
+        for name, stage in list(pending.items()):
+            if any(dep in failed for dep in stage.deps):
+                del pending[name]
+                failed.add(name)
+                metrics[name] = {'status': 'not run'}
+                continue
+            if not all(dep in done for dep in stage.deps):
+                continue
+            del pending[name]
+            up_to_date, current = is_up_to_date(stage, state)
+            if up_to_date and name not in force and 'all' not in force:
+                logging.info(f'Skipping {name}, unchanged since {state[name]["finished_at"]}')
+                metrics[name] = {'status': 'skipped'}
+                done.add(name)
+                continue
+            if dry_run:
+                logging.info(f'Would run {name}: {" ".join(stage.command())}')
+                metrics[name] = {'status': 'would run'}
+                done.add(name)
+                continue
+            cmd = stage.command()
+            logging.info(f'Starting {name}: {" ".join(cmd)}')
+            process = subprocess.Popen(cmd, cwd=ROOT, env={**os.environ, **(env or {})})
+            running[process.pid] = (stage, process, time.perf_counter())
+            metrics[name] = {'fingerprint': current}
+
+        if not running:
+            continue
+        # Resource usage of exactly this stage (and the children it waited for)
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        stage, process, started = running.pop(pid)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        metrics[stage.name].update({
+            'status': 'ok' if process.returncode == 0 else f'failed ({process.returncode})',
+            'wall_seconds': round(time.perf_counter() - started, 2),
+            'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+            'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),  # KB on Linux
+        })
+        logging.info(f'Finished {stage.name}: {metrics[stage.name]}')
+        if process.returncode != 0:
+            failed.add(stage.name)
+            continue
+        done.add(stage.name)
+        # Fingerprinted after the run, stages like the backfill change their own inputs
+        outputs = stage.outputs() if stage.outputs else []
+        state[stage.name] = {
+            'fingerprint': fingerprint(stage),
+            'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'outputs': [os.path.relpath(path, ROOT) for path in outputs],
+        }
+        save_state(state)
+    return metrics
+
+
+def run_pipeline(db_sink: bool = False, force: tuple[str, ...] = (), dry_run: bool = False,
+                 delta: bool = False) -> dict[str, dict]:
+    """One run of the pipeline, its metrics and those reported by the stages are logged and saved as telemetry."""
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime('%Y%m%dT%H%M%S')
+    stages = pipeline_stages(db_sink=db_sink, delta=delta)
+    if dry_run:
+        return run_stages(stages, force=force, dry_run=True)
+    # The stages report their own metrics (rows, HTTP requests, per-model throughput) into this directory
+    telemetry_dir = os.path.join(os.path.dirname(RUNS_LOG), 'telemetry', run_id)
+    os.makedirs(telemetry_dir, exist_ok=True)
+    metrics = run_stages(stages, force=force, env={TELEMETRY_DIR_ENV: telemetry_dir})
+    records = read_records(telemetry_dir)
+    # Copied into pipeline_runs.jsonl below, a watch would otherwise leave a directory per poll
+    shutil.rmtree(telemetry_dir, ignore_errors=True)
+    with open(RUNS_LOG, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'run_id': run_id, 'started_at': started_at.isoformat(timespec='seconds'),
+                            'stages': metrics, 'records': records}) + '\n')
+    rows, retrieval_id = telemetry_rows(run_id, metrics, records)
+    try:
+        save_telemetry(rows, retrieval_id)
+    except Exception as e:
+        # The telemetry of the run is still in pipeline_runs.jsonl
+        logging.warning(f'Could not save the telemetry to the database: {e}')
+    return metrics
+
+
+def failed_stages(metrics: dict[str, dict]) -> list[str]:
+    return [name for name, m in metrics.items() if m['status'] not in ('ok', 'skipped', 'would run')]
+
+
+def watch(interval_minutes: float, db_sink: bool = False, max_polls: Optional[int] = None):
+    """
+    Run the pipeline on the articles added since the last poll every interval_minutes, until SIGTERM/SIGINT.
+    Polls start at a fixed cadence (a long run delays the next poll, it does not shift the later ones), and
+    a stop signal lets the current micro-batch finish.
+    """
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    interval = interval_minutes * 60
+    next_poll = time.monotonic()
+    polls = 0
+    while not stop.is_set():
+        metrics = run_pipeline(db_sink=db_sink, delta=True)
+        failed = failed_stages(metrics)
+        if failed:
+            # A PubMed outage should not end the watch, the next poll fetches the same delta again
+            logging.error(f'Poll failed in {failed}, retrying at the next poll')
+        polls += 1
+        if max_polls and polls >= max_polls:
+            break
+        next_poll += interval
+        # Polls missed while a long micro-batch ran are dropped, not run back to back
+        while next_poll <= time.monotonic():
+            next_poll += interval
+        logging.info(f'Next poll in {(next_poll - time.monotonic()) / 60:.1f} minutes')
+        stop.wait(next_poll - time.monotonic())
+    logging.info(f'Stopped watching after {polls} polls')
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Run the pipeline stages, skipping those whose inputs and code did not change')
+    arg_parser.add_argument('--force', type=str, nargs='+', default=(),
+                            help='Stages to run even if unchanged, or all')
+    arg_parser.add_argument('--dry_run', action='store_true',
+                            help='Only show which stages would run')
+    arg_parser.add_argument('--db_sink', action='store_true', default=os.getenv('PREDICTION_SINK') == 'db',
+                            help='Write the predictions straight into the database (default with PREDICTION_SINK=db)')
+    arg_parser.add_argument('--watch', type=float, default=None, metavar='MINUTES',
+                            help='Keep running and poll PubMed every MINUTES minutes, each poll is a micro-batch')
+    arg_parser.add_argument('--max_polls', type=int, default=None,
+                            help='Stop watching after this many polls')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.watch:
+        watch(args.watch, db_sink=args.db_sink, max_polls=args.max_polls)
+        sys.exit(0)
+    metrics = run_pipeline(db_sink=args.db_sink, force=tuple(args.force), dry_run=args.dry_run)
+    for name, m in metrics.items():
+        print(f'{name:15} {m}')
+    if failed_stages(metrics):
+        sys.exit(1)
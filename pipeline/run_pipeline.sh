@@ -1,11 +1,7 @@
 #!/bin/sh
 set -e  # stop on first error
 
-echo "Fetching new PubMed data..."
-python /app/data/get_pubmed_data.py
-
-echo "Running relevance prediction..."
-python /app/pipeline/predict.py
-
-echo "Populating database..."
-python /app/data/populate.py
+# fetch -> backfill -> predict -> populate, unchanged stages are skipped (see pipeline/run.py).
+# With PREDICTION_SINK=db, predict.py writes the papers and predictions to the database itself
+# exec, so that docker stop reaches run.py (with --watch, the current micro-batch finishes first)
+exec python /app/pipeline/run.py "$@"
@@ -0,0 +1,106 @@
+"""
+Run the independent classification models of the prediction pipeline on a pool of worker processes.
+
+Each worker is pinned to its own share of the CPU cores and uses that many torch threads,
+so that workers do not compete for cores. At most `max_resident` models are submitted at a
+time; since every worker holds one model while it runs, this caps the number of models in
+memory and thereby the peak memory of the pipeline.
+"""
+
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Optional
+
+import pandas as pd
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: list[int], n_workers: int) -> list[list[int]]:
+    """Split the cores into n_workers contiguous, (nearly) equally sized groups."""
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, rest = divmod(len(cores), n_workers)
+    groups = []
+    start = 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < rest else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _init_worker(core_groups, log_path: Optional[str]):
+    """Take a group of cores for this worker process and set the torch thread count accordingly."""
+    import torch
+
+    cores = core_groups.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    if log_path:
+        logging.basicConfig(
+            filename=log_path,
+            level=logging.INFO,
+            format='%(asctime)s %(levelname)s %(message)s'
+        )
+    logging.info(f'Worker {os.getpid()} pinned to cores {cores}')
+
+
+def _run_model_task(m: dict, relevant_file: str, backend: str, ids: Optional[list]) -> pd.DataFrame:
+    # Imported here, the worker is a fresh (spawned) interpreter
+    from pipeline.predict import run_model
+    from pipeline.artifacts import read_table
+
+    relevant_df = read_table(relevant_file)
+    if ids is not None:
+        relevant_df = relevant_df[relevant_df['id'].isin(ids)]
+    return run_model(m, relevant_df, backend=backend)
+
+
+def run_models_in_pool(models: list[dict], relevant_file: str, n_workers: int,
+                       max_resident: Optional[int] = None, log_path: Optional[str] = None,
+                       backend: str = 'torch', ids: Optional[list[list]] = None,
+                       on_result: Optional[Callable[[pd.DataFrame], None]] = None) -> list[pd.DataFrame]:
+    """
+    Run every model in `models` on the studies in relevant_file (restricted to ids[i] for models[i]
+    if given) and return their predictions, in the order of `models`.
+    on_result is called with the predictions of each model as soon as it finishes.
+    """
+    core_groups = split_cores(available_cores(), n_workers)
+    n_workers = len(core_groups)
+    max_resident = min(max_resident or n_workers, n_workers)
+
+    # Spawn instead of fork: forking a process that already initialised torch is not safe
+    ctx = multiprocessing.get_context('spawn')
+    core_queue = ctx.Queue()
+    for group in core_groups:
+        core_queue.put(group)
+
+    logging.info(f'Running {len(models)} models on {n_workers} workers '
+                 f'(cores per worker: {[len(g) for g in core_groups]}, max resident models: {max_resident})')
+    results: dict[int, pd.DataFrame] = {}
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                             initializer=_init_worker, initargs=(core_queue, log_path)) as executor:
+        pending = {}
+        todo = list(enumerate(models))
+        while todo or pending:
+            # Only submit a new model when fewer than max_resident are loaded
+            while todo and len(pending) < max_resident:
+                i, m = todo.pop(0)
+                pending[executor.submit(_run_model_task, m, relevant_file, backend,
+                                        ids[i] if ids is not None else None)] = i
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                results[i] = future.result()
+                if on_result:
+                    on_result(results[i])
+                logging.info(f'Finished model {models[i]["model_path"]} ({len(results)}/{len(models)})')
+
+    return [results[i] for i in range(len(models))]
@@ -0,0 +1,299 @@
+"""
+Sharded prediction: a coordinator splits the relevant studies into id-range shards and puts them
+in a durable SQLite work queue, any number of worker processes (or containers sharing the run
+directory) claim shards, score them and write one output file per shard.
+
+A claimed shard is leased: its worker renews the lease with a heartbeat while it scores the shard.
+If the worker dies, the lease runs out and the shard is claimed again by another worker.
+The coordinator waits for all shards and merges their outputs.
+
+Run a worker against an existing run directory (e.g. from another container):
+    python pipeline/shards.py --run_dir data/shards/<run_id>
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import shutil
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+from pipeline.artifacts import read_table, write_table
+from pipeline.model_cache import ModelCache
+
+SHARD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'shards')
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 15
+MAX_ATTEMPTS = 3
+
+
+class ShardQueue:
+    """Work queue of id-range shards in a SQLite file, safe to use from several processes."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard (
+                id INTEGER PRIMARY KEY,
+                lo INTEGER NOT NULL,
+                hi INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                output TEXT,
+                error TEXT
+            )
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, ranges: list[tuple[int, int]]):
+        with self.conn:
+            self.conn.executemany('INSERT INTO shard (lo, hi) VALUES (?, ?)', ranges)
+
+    def claim(self, worker: str, lease_seconds: float = LEASE_SECONDS,
+              max_attempts: int = MAX_ATTEMPTS) -> Optional[tuple[int, int, int, int]]:
+        """Claim a pending shard, or one whose worker stopped renewing its lease. Returns (id, lo, hi, attempt)."""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute("""
+                SELECT id, lo, hi, attempts FROM shard
+                WHERE attempts < ? AND (status = 'pending' OR (status = 'claimed' AND lease_until < ?))
+                ORDER BY id LIMIT 1
+            """, (max_attempts, now)).fetchone()
+            if row:
+                self.conn.execute("""
+                    UPDATE shard SET status = 'claimed', worker = ?, lease_until = ?, attempts = attempts + 1
+                    WHERE id = ?
+                """, (worker, now + lease_seconds, row[0]))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return (row[0], row[1], row[2], row[3] + 1) if row else None
+
+    def heartbeat(self, shard_id: int, worker: str, lease_seconds: float = LEASE_SECONDS):
+        with self.conn:
+            self.conn.execute("UPDATE shard SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'claimed'",
+                              (time.time() + lease_seconds, shard_id, worker))
+
+    def complete(self, shard_id: int, worker: str, output: str) -> bool:
+        """Mark the shard done, unless its lease was lost to another worker in the meantime."""
+        with self.conn:
+            cursor = self.conn.execute("""
+                UPDATE shard SET status = 'done', output = ?, lease_until = NULL
+                WHERE id = ? AND worker = ? AND status = 'claimed'
+            """, (output, shard_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, shard_id: int, worker: str, error: str, max_attempts: int = MAX_ATTEMPTS):
+        """Put the shard back in the queue, or mark it failed after max_attempts."""
+        with self.conn:
+            self.conn.execute("""
+                UPDATE shard SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                                 error = ?, lease_until = NULL
+                WHERE id = ? AND worker = ? AND status = 'claimed'
+            """, (max_attempts, error, shard_id, worker))
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM shard GROUP BY status').fetchall())
+
+    def claimable(self, max_attempts: int = MAX_ATTEMPTS) -> int:
+        """Shards still waiting for a worker, including those whose lease ran out."""
+        return self.conn.execute("""
+            SELECT COUNT(*) FROM shard
+            WHERE attempts < ? AND (status = 'pending' OR (status = 'claimed' AND lease_until < ?))
+        """, (max_attempts, time.time())).fetchone()[0]
+
+    def stalled(self, max_attempts: int = MAX_ATTEMPTS) -> int:
+        """Shards whose lease ran out after the last attempt, nobody will claim them again."""
+        return self.conn.execute("""
+            SELECT COUNT(*) FROM shard WHERE attempts >= ? AND status = 'claimed' AND lease_until < ?
+        """, (max_attempts, time.time())).fetchone()[0]
+
+    def outputs(self) -> list[str]:
+        return [row[0] for row in self.conn.execute(
+            "SELECT output FROM shard WHERE status = 'done' ORDER BY id")]
+
+
+def id_ranges(ids: np.ndarray, n_shards: int) -> list[tuple[int, int]]:
+    """Split the sorted ids into n_shards contiguous (lo, hi) ranges of about equal size."""
+    ids = np.unique(ids.astype(np.int64))
+    return [(int(chunk[0]), int(chunk[-1])) for chunk in np.array_split(ids, min(n_shards, len(ids))) if len(chunk)]
+
+
+def prepare_run(relevant_df: pd.DataFrame, models: list[dict], unscored_ids: list[list],
+                n_shards: int, backend: str = 'torch', shard_dir: str = SHARD_DIR) -> str:
+    """Write the studies, the work per model and the shard queue of a new run, returns the run directory."""
+    run_dir = os.path.join(shard_dir, datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+    os.makedirs(run_dir)
+    write_table(relevant_df, os.path.join(run_dir, 'studies.parquet'))
+    # Which model still has to score which papers, from the prediction ledger
+    work = pd.DataFrame({
+        'task': np.repeat([m['task'] for m in models], [len(ids) for ids in unscored_ids]),
+        'id': np.concatenate([np.asarray(ids, dtype=np.int64) for ids in unscored_ids]) if models else [],
+    })
+    write_table(work, os.path.join(run_dir, 'work.parquet'))
+    with open(os.path.join(run_dir, 'job.json'), 'w', encoding='utf-8') as f:
+        json.dump({'models': models, 'backend': backend}, f)
+
+    queue = ShardQueue(os.path.join(run_dir, 'queue.sqlite'))
+    queue.enqueue(id_ranges(work['id'].to_numpy(), n_shards))
+    queue.close()
+    return run_dir
+
+
+def process_shard(run_dir: str, lo: int, hi: int, output_prefix: str, cache: Optional[ModelCache] = None) -> str:
+    """Score the ids lo..hi with every model that still has work in that range."""
+    from pipeline.predict import run_model
+
+    with open(os.path.join(run_dir, 'job.json'), 'r', encoding='utf-8') as f:
+        job = json.load(f)
+    studies = read_table(os.path.join(run_dir, 'studies.parquet'))
+    studies = studies[(studies['id'] >= lo) & (studies['id'] <= hi)]
+    work = read_table(os.path.join(run_dir, 'work.parquet'))
+    work = work[(work['id'] >= lo) & (work['id'] <= hi)]
+
+    predictions, tokens = [], []
+    for m in job['models']:
+        ids = work.loc[work['task'] == m['task'], 'id']
+        if ids.empty:
+            continue
+        df = run_model(m, studies[studies['id'].isin(ids)], backend=job['backend'], cache=cache)
+        (tokens if 'position_id' in df.columns else predictions).append(df)
+
+    outputs = {}
+    if predictions:
+        outputs['predictions'] = write_table(pd.concat(predictions, ignore_index=True),
+                                             f'{output_prefix}_predictions.parquet')
+    if tokens:
+        outputs['tokens'] = write_table(pd.concat(tokens, ignore_index=True), f'{output_prefix}_tokens.parquet')
+    return json.dumps(outputs)
+
+
+def run_worker(run_dir: str, worker: Optional[str] = None, max_resident: int = 1):
+    """Claim and score shards until none are left, keeping up to max_resident models loaded between shards."""
+    worker = worker or f'{os.uname().nodename}-{os.getpid()}'
+    cache = ModelCache(max_resident)
+    queue = ShardQueue(os.path.join(run_dir, 'queue.sqlite'))
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            break
+        shard_id, lo, hi, attempt = claimed
+        logging.info(f'Worker {worker} claimed shard {shard_id} (ids {lo}-{hi}, attempt {attempt})')
+
+        # Renew the lease while scoring, from a separate connection
+        stop = threading.Event()
+
+        def keep_lease():
+            heartbeat_queue = ShardQueue(os.path.join(run_dir, 'queue.sqlite'))
+            while not stop.wait(HEARTBEAT_SECONDS):
+                heartbeat_queue.heartbeat(shard_id, worker)
+            heartbeat_queue.close()
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+        try:
+            output = process_shard(run_dir, lo, hi, os.path.join(run_dir, f'shard_{shard_id}_{attempt}'), cache)
+        except Exception as e:
+            logging.error(f'Shard {shard_id} failed: {e}', exc_info=True)
+            stop.set()
+            queue.fail(shard_id, worker, str(e))
+            continue
+        stop.set()
+        heartbeat.join()
+        if not queue.complete(shard_id, worker, output):
+            logging.warning(f'Lease of shard {shard_id} was lost, its output is discarded')
+    cache.release()
+    queue.close()
+
+
+def run_sharded(relevant_df: pd.DataFrame, models: list[dict], unscored_ids: list[list], n_shards: int,
+                n_workers: int = 1, backend: str = 'torch', shard_dir: str = SHARD_DIR,
+                poll_seconds: float = 5, max_resident: Optional[int] = None) -> list[pd.DataFrame]:
+    """
+    Coordinate a sharded run with n_workers local worker processes (more workers can join
+    with the run directory), each keeping up to max_resident models loaded between shards,
+    and return the merged output of each model, in the order of models.
+    """
+    run_dir = prepare_run(relevant_df, models, unscored_ids, n_shards, backend=backend, shard_dir=shard_dir)
+    queue = ShardQueue(os.path.join(run_dir, 'queue.sqlite'))
+    logging.info(f'Sharded run in {run_dir}: {queue.counts()}')
+
+    command = [sys.executable, os.path.abspath(__file__), '--run_dir', run_dir]
+    if max_resident is not None:
+        command += ['--max_resident', str(max_resident)]
+    workers: list[subprocess.Popen] = []
+    try:
+        while True:
+            counts = queue.counts()
+            if counts.get('failed') or queue.stalled():
+                raise RuntimeError(f'Shards failed after {MAX_ATTEMPTS} attempts, see {run_dir}: {counts}')
+            if counts.get('done', 0) == sum(counts.values()):
+                break
+            # Replace local workers that exited (or died) while shards are still waiting for a worker
+            workers = [w for w in workers if w.poll() is None]
+            for _ in range(min(n_workers - len(workers), queue.claimable())):
+                workers.append(subprocess.Popen(command))
+            time.sleep(poll_seconds)
+        for w in workers:
+            w.wait()
+    finally:
+        # Local workers of a failed or interrupted run would keep their models in memory
+        for w in workers:
+            if w.poll() is None:
+                w.terminate()
+        for w in workers:
+            w.wait()
+    logging.info(f'All shards done: {queue.counts()}')
+
+    frames = []
+    for output in queue.outputs():
+        frames += [read_table(path) for path in json.loads(output).values()]
+    queue.close()
+    results = []
+    for m in models:
+        parts = [df[df['task'] == m['task']] for df in frames]
+        parts = [df for df in parts if not df.empty]
+        if parts:
+            results.append(pd.concat(parts, ignore_index=True))
+    shutil.rmtree(run_dir)
+    return results
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Claim and score shards of a sharded prediction run')
+    arg_parser.add_argument('--run_dir', type=str, required=True,
+                            help='Run directory created by predict.py --shards')
+    arg_parser.add_argument('--worker_id', type=str, required=False,
+                            help='Name of this worker, defaults to host and process id')
+    arg_parser.add_argument('--max_resident', type=int, default=1,
+                            help='Maximum number of models kept loaded between shards')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    run_worker(args.run_dir, args.worker_id, args.max_resident)
@@ -0,0 +1,191 @@
+"""
+Per-stage telemetry of the pipeline runs, stored in the pipeline_telemetry table with the BatchRetrieval of the run.
+
+The stage scripts report their own metrics (rows processed, HTTP requests and retries, per-model
+inference throughput) with record() into the telemetry directory that pipeline/run.py sets up for
+each run; run.py adds wall time, CPU time and peak RSS of each stage and saves everything at the end.
+
+Compare the last runs, regressions against the median of the earlier runs are flagged (exit code 1):
+    python pipeline/telemetry.py --runs 10 --threshold 0.25
+"""
+
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timezone
+from typing import Optional
+
+import pandas as pd
+from sqlalchemy import create_engine, insert, select
+
+# Add the parent folder to the Python search path
+parent_folder_path = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_folder_path)
+
+TELEMETRY_DIR_ENV = 'PIPELINE_TELEMETRY_DIR'
+METRICS_FILE = 'metrics.jsonl'
+
+
+def record(stage: str, model: Optional[str] = None, **metrics):
+    """Report metrics of a stage (or of one model in it) to the running pipeline, no-op outside of run.py."""
+    directory = os.getenv(TELEMETRY_DIR_ENV)
+    if not directory:
+        return
+    line = json.dumps({'stage': stage, 'model': model, **metrics}) + '\n'
+    # One short append per record, safe across the worker processes of a stage
+    with open(os.path.join(directory, METRICS_FILE), 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+def http_metrics() -> dict:
+    """Request counts of the shared HTTP response cache of the fetchers in data/."""
+    from data.http_cache import response_cache
+
+    return {'http_requests': response_cache.stats['network_requests'],
+            'http_cache_hits': response_cache.stats['hits'],
+            'http_retries': response_cache.stats['retries']}
+
+
+def read_records(directory: str) -> list[dict]:
+    path = os.path.join(directory, METRICS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def telemetry_rows(run_id: str, stage_metrics: dict[str, dict], records: list[dict]) -> tuple[list[dict], Optional[int]]:
+    """
+    One row per stage (run.py's resource usage merged with the stage's own metrics) and one per model,
+    plus the BatchRetrieval id reported by the stage that created it.
+    """
+    retrieval_id = next((r['retrieval_id'] for r in records if r.get('retrieval_id') is not None), None)
+    rows = []
+    for stage, usage in stage_metrics.items():
+        if 'wall_seconds' not in usage:
+            continue  # skipped or not run
+        row = {'run_id': run_id, 'stage': stage, 'model': None, 'status': usage['status'],
+               'wall_seconds': usage['wall_seconds'], 'cpu_seconds': usage['cpu_seconds'],
+               'peak_rss_mb': usage['peak_rss_mb']}
+        for r in records:
+            if r['stage'] == stage and r['model'] is None:
+                for key in ('rows', 'http_requests', 'http_cache_hits', 'http_retries'):
+                    if r.get(key) is not None:
+                        row[key] = row.get(key, 0) + r[key]
+        if row.get('rows') is not None and row['wall_seconds']:
+            row['rows_per_second'] = row['rows'] / row['wall_seconds']
+        rows.append(row)
+    for r in records:
+        if r['model'] is not None:
+            rows.append({'run_id': run_id, 'stage': r['stage'], 'model': r['model'], 'status': 'ok',
+                         'wall_seconds': r.get('seconds'), 'rows': r.get('rows'),
+                         'rows_per_second': r['rows'] / r['seconds'] if r.get('rows') and r.get('seconds') else None,
+                         'peak_rss_mb': r.get('peak_rss_mb')})
+    return rows, retrieval_id
+
+
+def get_engine():
+    from data.models import DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME
+
+    database_url = os.getenv(
+        "DATABASE_URL",
+        "postgresql://{0}:{1}@{2}:{3}/{4}".format(
+            DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT, DATABASE_NAME)
+    )
+    return create_engine(database_url, echo=False)
+
+
+def save_telemetry(rows: list[dict], retrieval_id: Optional[int], engine=None):
+    from data.models import PipelineTelemetry
+
+    if not rows:
+        return
+    engine = engine or get_engine()
+    PipelineTelemetry.__table__.create(engine, checkfirst=True)
+    recorded_at = datetime.now(timezone.utc)
+    # Every row needs the same keys for the executemany insert, metrics a stage did not report stay NULL
+    columns = [c.name for c in PipelineTelemetry.__table__.columns if c.name != 'id']
+    with engine.begin() as conn:
+        conn.execute(insert(PipelineTelemetry), [
+            {**dict.fromkeys(columns), **row, 'retrieval_id': retrieval_id, 'recorded_at': recorded_at}
+            for row in rows])
+
+
+def load_telemetry(n_runs: int, engine=None) -> pd.DataFrame:
+    """Telemetry of the last n_runs runs, oldest first."""
+    from data.models import PipelineTelemetry
+
+    engine = engine or get_engine()
+    with engine.connect() as conn:
+        df = pd.read_sql(select(PipelineTelemetry), conn)
+    if df.empty:
+        return df
+    runs = df.groupby('run_id')['recorded_at'].min().sort_values().index[-n_runs:]
+    df = df[df['run_id'].isin(runs)]
+    df['run_id'] = pd.Categorical(df['run_id'], categories=list(runs), ordered=True)
+    return df.sort_values('run_id')
+
+
+def regressions(df: pd.DataFrame, threshold: float = 0.25) -> list[str]:
+    """Stages and models of the latest run that are slower than the median of the earlier runs by more than threshold."""
+    latest = df['run_id'].cat.categories[-1]
+    found = []
+    for (stage, model), group in df.groupby(['stage', df['model'].fillna('')], observed=True):
+        current = group[group['run_id'] == latest]
+        history = group[group['run_id'] != latest]
+        if current.empty or history.empty:
+            continue
+        name = f'{stage}/{model}' if model else stage
+        wall, baseline = current['wall_seconds'].iloc[0], history['wall_seconds'].median()
+        # Throughput where the stage reports its rows, a bigger batch is not a regression
+        rate, baseline_rate = current['rows_per_second'].iloc[0], history['rows_per_second'].median()
+        if pd.notna(rate) and pd.notna(baseline_rate) and baseline_rate > 0:
+            if rate < baseline_rate * (1 - threshold):
+                found.append(f'{name}: {rate:.1f} rows/s, median of earlier runs {baseline_rate:.1f} rows/s')
+        elif pd.notna(wall) and pd.notna(baseline) and baseline > 0 and wall > baseline * (1 + threshold):
+            found.append(f'{name}: {wall:.1f} s, median of earlier runs {baseline:.1f} s')
+        peak, baseline_peak = current['peak_rss_mb'].iloc[0], history['peak_rss_mb'].median()
+        if pd.notna(peak) and pd.notna(baseline_peak) and baseline_peak > 0 and peak > baseline_peak * (1 + threshold):
+            found.append(f'{name}: peak RSS {peak:.0f} MB, median of earlier runs {baseline_peak:.0f} MB')
+    return found
+
+
+def report(df: pd.DataFrame) -> str:
+    """Stages and models (rows) by run (columns): wall time, throughput, peak RSS and HTTP requests/retries."""
+    df = df.assign(name=df['stage'] + df['model'].map(lambda m: f' / {m}' if pd.notna(m) else ''))
+    parts = []
+    for column, title in (('wall_seconds', 'Wall time (s)'), ('rows_per_second', 'Rows/s'),
+                          ('peak_rss_mb', 'Peak RSS (MB)'), ('http_requests', 'HTTP requests'),
+                          ('http_retries', 'HTTP retries')):
+        table = df.pivot_table(index='name', columns='run_id', values=column, aggfunc='first', observed=True)
+        table = table.dropna(how='all')
+        if not table.empty:
+            parts.append(f'{title}\n{table.round(1).to_string()}')
+    return '\n\n'.join(parts)
+
+
+def init_args_parser():
+    """Initialize and return the argument parser for the script."""
+    arg_parser = argparse.ArgumentParser(
+        description='Compare the telemetry of the last pipeline runs')
+    arg_parser.add_argument('--runs', type=int, default=10,
+                            help='Number of runs to compare')
+    arg_parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Relative slowdown against the median of the earlier runs that counts as a regression')
+    return arg_parser
+
+
+if __name__ == '__main__':
+    args = init_args_parser().parse_args()
+    df = load_telemetry(args.runs)
+    if df.empty:
+        print('No pipeline telemetry recorded yet')
+        sys.exit(0)
+    print(report(df))
+    found = regressions(df, args.threshold)
+    if found:
+        print('\nRegressions in the latest run:')
+        print('\n'.join(f'  {line}' for line in found))
+        sys.exit(1)
@@ -0,0 +1,172 @@
+"""
+Tokenisation shared across the models of the prediction pipeline.
+
+Many checkpoints in model_paths.json share a vocabulary (pubmedbert, biobert, ...).
+Texts are therefore tokenised once per distinct tokenizer, identified by a hash of its
+vocabulary and configuration, and the token ids are cached on disk as flat int32 arrays
+that are memory-mapped by every model (and worker process) using the same tokenizer.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import time
+import itertools
+
+import numpy as np
+from tokenizers import Tokenizer
+
+TOKEN_CACHE_DIR = os.getenv('TOKEN_CACHE_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.token_cache'))
+
+ENCODE_CHUNK_SIZE = 1000
+
+
+class EncodedTexts:
+    """
+    Token ids of many texts, stored as one flat int32 array plus offsets:
+    the ids of text i are input_ids[offsets[i]:offsets[i + 1]].
+    Optionally char_offsets holds the (start, end) character span of every token, (0, 0) for special tokens.
+    """
+
+    def __init__(self, input_ids: np.ndarray, offsets: np.ndarray, char_offsets: np.ndarray = None):
+        self.input_ids = input_ids
+        self.offsets = offsets
+        self.char_offsets = char_offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx) -> np.ndarray:
+        # A view into the (memory-mapped) array, nothing is copied
+        return self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def spans(self, idx) -> np.ndarray:
+        return self.char_offsets[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def save(self, directory: str):
+        np.save(os.path.join(directory, 'input_ids.npy'), self.input_ids)
+        if self.char_offsets is not None:
+            np.save(os.path.join(directory, 'char_offsets.npy'), self.char_offsets)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'EncodedTexts':
+        mode = 'r' if mmap else None
+        char_offsets_file = os.path.join(directory, 'char_offsets.npy')
+        return cls(np.load(os.path.join(directory, 'input_ids.npy'), mmap_mode=mode),
+                   np.load(os.path.join(directory, 'offsets.npy'), mmap_mode=mode),
+                   np.load(char_offsets_file, mmap_mode=mode) if os.path.exists(char_offsets_file) else None)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything that determines the token ids: vocabulary, normalisation and special tokens."""
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode('utf-8'))
+    if getattr(tokenizer, 'is_fast', False):
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        # Truncation and padding are (re)set on every call, they do not change the ids we cache
+        backend.pop('truncation', None)
+        backend.pop('padding', None)
+        h.update(json.dumps(backend, sort_keys=True).encode('utf-8'))
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8'))
+        init_kwargs = {k: v for k, v in tokenizer.init_kwargs.items()
+                       if isinstance(v, (str, int, float, bool, type(None)))}
+        h.update(json.dumps(init_kwargs, sort_keys=True).encode('utf-8'))
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def texts_fingerprint(texts: list[str], max_len: int) -> str:
+    h = hashlib.sha256(str(max_len).encode('utf-8'))
+    for text in texts:
+        h.update(text.encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()[:16]
+
+
+def encode_texts(tokenizer, texts: list[str], max_len: int = 512, with_char_offsets: bool = False) -> EncodedTexts:
+    """
+    Tokenise all texts (in chunks, to bound memory) into flat int32 ids.
+    Fast tokenizers are driven through their Rust backend directly, which encodes a whole
+    chunk in parallel and skips building Python BatchEncoding objects.
+    with_char_offsets also keeps the character span of every token (fast tokenizers only), used for NER.
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        # Work on a copy, the truncation/padding settings of the backend are shared state
+        backend = Tokenizer.from_str(tokenizer.backend_tokenizer.to_str())
+        backend.no_padding()
+        backend.enable_truncation(max_len)
+
+        def encode_chunk(chunk):
+            encodings = backend.encode_batch(chunk, add_special_tokens=True)
+            return [e.ids for e in encodings], [e.offsets for e in encodings]
+    elif with_char_offsets:
+        raise ValueError('Character offsets need a fast tokenizer')
+    else:
+        def encode_chunk(chunk):
+            return tokenizer(chunk, truncation=True, max_length=max_len)['input_ids'], None
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    chunks, span_chunks = [], []
+    for start in range(0, len(texts), ENCODE_CHUNK_SIZE):
+        encoded, spans = encode_chunk(texts[start:start + ENCODE_CHUNK_SIZE])
+        lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+        offsets[start + 1:start + 1 + len(encoded)] = lengths
+        chunks.append(np.fromiter(itertools.chain.from_iterable(encoded),
+                                  dtype=np.int32, count=int(lengths.sum())))
+        if with_char_offsets:
+            span_chunks.append(np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(spans)),
+                                           dtype=np.int32, count=2 * int(lengths.sum())).reshape(-1, 2))
+    np.cumsum(offsets, out=offsets)
+    input_ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+    char_offsets = None
+    if with_char_offsets:
+        char_offsets = np.concatenate(span_chunks) if span_chunks else np.zeros((0, 2), dtype=np.int32)
+    return EncodedTexts(input_ids, offsets, char_offsets)
+
+
+def get_encoded_texts(tokenizer, texts: list[str], max_len: int = 512,
+                      cache_dir: str = TOKEN_CACHE_DIR, with_char_offsets: bool = False) -> EncodedTexts:
+    """
+    Memory-mapped token ids of texts, tokenised only if no model with the
+    same tokenizer has done so before.
+    """
+    texts = [text if isinstance(text, str) else '' for text in texts]
+    directory = os.path.join(cache_dir, tokenizer_fingerprint(tokenizer),
+                             texts_fingerprint(texts, max_len) + ('-spans' if with_char_offsets else ''))
+    if os.path.exists(os.path.join(directory, 'offsets.npy')):
+        logging.info(f'Reusing cached tokenisation from {directory}')
+        return EncodedTexts.load(directory)
+
+    encoded = encode_texts(tokenizer, texts, max_len, with_char_offsets=with_char_offsets)
+    # Write to a temporary directory first, parallel workers may tokenise the same texts
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(directory))
+    encoded.save(tmp_dir)
+    try:
+        os.rename(tmp_dir, directory)
+        logging.info(f'Cached tokenisation of {len(texts)} texts in {directory}')
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # another process was faster
+    return EncodedTexts.load(directory)
+
+
+def prune_token_cache(max_age_days: float = 30, cache_dir: str = TOKEN_CACHE_DIR):
+    """Remove cached tokenisations that were not written for max_age_days."""
+    if not os.path.isdir(cache_dir):
+        return
+    for fingerprint in os.listdir(cache_dir):
+        tokenizer_dir = os.path.join(cache_dir, fingerprint)
+        for entry in os.listdir(tokenizer_dir):
+            path = os.path.join(tokenizer_dir, entry)
+            age_days = (time.time() - os.path.getmtime(path)) / 86400
+            if age_days > max_age_days:
+                shutil.rmtree(path, ignore_errors=True)